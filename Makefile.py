@@ -203,20 +203,64 @@ class pypi_upload(Task):
         webbrowser.open_new(url)
 
 class test(Task):
-    """Run all tests (except known failures)."""
+    """Run all tests (except known failures).
+
+    The test suite is run with each installed Python version concurrently,
+    at most one per CPU (or $TEST_JOBS) at a time. The output of each run
+    is printed when done, followed by a summary table.
+    """
     def make(self):
+        import subprocess
+        import tempfile
+        import time
+
+        pythons = []
         for ver, python in self._gen_pythons():
-            if ver < (2,3):
-                # Don't support Python < 2.3.
+            if ver < (3,9):
+                # Don't support Python < 3.9.
                 continue
-            #elif ver >= (3, 0):
-            #    # Don't yet support Python 3.
-            #    continue
-            ver_str = "%s.%s" % ver
-            print "-- test with Python %s (%s)" % (ver_str, python)
             assert ' ' not in python
-            sh.run_in_dir("%s test.py -- -knownfailure" % python,
-                join(self.dir, "test"))
+            pythons.append((ver, python))
+        max_jobs = int(os.environ.get("TEST_JOBS", 0)) or _cpu_count()
+
+        pending = list(pythons)
+        running = {}    # <process> -> (<ver>, <python>, <output>, <start>)
+        results = []    # [(<ver>, <python>, <retval>, <time>, <output>)]
+        while pending or running:
+            while pending and len(running) < max_jobs:
+                ver, python = pending.pop(0)
+                # Output to a file: a pipe could fill up and block the test.
+                output = tempfile.TemporaryFile()
+                argv = [python, "test.py", "--", "-knownfailure"]
+                p = subprocess.Popen(argv, cwd=join(self.dir, "test"),
+                                     stdout=output, stderr=subprocess.STDOUT)
+                running[p] = (ver, python, output, time.time())
+            time.sleep(0.1)
+            for p, (ver, python, output, start) in list(running.items()):
+                retval = p.poll()
+                if retval is None:
+                    continue
+                del running[p]
+                output.seek(0)
+                results.append((ver, python, retval, time.time() - start,
+                                output.read()))
+                output.close()
+
+        results.sort()
+        for ver, python, retval, elapsed, output in results:
+            print "-- test with Python %s.%s (%s)" % (ver + (python,))
+            sys.stdout.write(output)
+        print "-- summary"
+        print "%-8s %-6s %8s  %s" % ("python", "result", "time", "path")
+        failed = []
+        for ver, python, retval, elapsed, output in results:
+            ver_str = "%s.%s" % ver
+            if retval:
+                failed.append(ver_str)
+            print "%-8s %-6s %7.1fs  %s" % (ver_str,
+                retval and "FAIL" or "pass", elapsed, python)
+        if failed:
+            raise MkError("tests failed with Python %s" % ", ".join(failed))
 
     def _python_ver_from_python(self, python):
         assert ' ' not in python
@@ -228,7 +272,8 @@ class test(Task):
     
     def _gen_python_names(self):
         yield "python"
-        for ver in [(2,4), (2,5), (2,6), (2,7), (3,0), (3,1)]:
+        yield "python3"
+        for ver in [(3,9), (3,10), (3,11), (3,12), (3,13)]:
             yield "python%d.%d" % ver
             if sys.platform == "win32":
                 yield "python%d%d" % ver
@@ -270,6 +315,14 @@ class todo(Task):
 
 #---- internal support stuff
 
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
 ## {{{ http://code.activestate.com/recipes/577058/ (r2)
 def query_yes_no(question, default="yes"):
     """Ask a yes/no question via raw_input() and return their answer.
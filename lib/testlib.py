@@ -18,6 +18,58 @@
         -l, --list      Just list the available test modules. You can also
                         specify tags to play with module filtering.
         -n, --no-default-tags   Ignore default tags
+        --threads <n>   Run the test cases of modules tagged "concurrent"
+                        in a pool of <n> worker threads.
+        -x, --maxfail <n>   Stop the test run after the first (or <n>)
+                        failing tests. Queued worker thread tests are
+                        cancelled and the remaining tests reported as
+                        not run.
+        --rerun-failures <n>    Rerun each failing test up to <n> times
+                        (in a forked process, if possible). Tests that
+                        pass on a rerun are reported as flaky rather
+                        than failed.
+        --leak-check <mode>     Check each test for leaked threads, file
+                        descriptors, objects and modules and list the
+                        leaking tests, most leaking first. <mode> is
+                        "report" or "fail" (to also fail leaking tests).
+        --progress      Show the progress of the test run: completed
+                        tests, tests/sec, an ETA and the running tests.
+                        This is a status line on a terminal, else a
+                        progress line every 10 seconds.
+        --coverage      Record the source lines executed by each test
+                        (in ".testlib-coverage.json").
+        --covering <path>   Only run the tests that executed lines of the
+                        given source file in an earlier "--coverage" run
+                        (and tests new since). Can be used multiple times,
+                        e.g. for all files changed since the last run.
+        --update-golden Rewrite the golden files that do not match the
+                        output given to `testlib.assert_golden()` (or
+                        `assert_golden_file()`).
+        --isolate-timing    Run timing-sensitive tests (tagged "timing",
+                        e.g. by `testlib.timedtest()`) last, one test run
+                        at a time across processes, with garbage
+                        collection disabled, on a CPU reserved for them
+                        that the other tests don't use. (The module and
+                        class fixtures of their modules may be run again
+                        for this phase.)
+        --import-times  Report the time taken to import each test module.
+        --serve <socket>    Gather the tests once and serve test runs,
+                        each in a forked process, on the given Unix
+                        socket until interrupted.
+        --connect <socket>  Run the tests matching the given tags on a
+                        "--serve" server, streaming its output.
+        --watch         Run the tests, then keep watching the test dirs and
+                        the project sources for changes and rerun the
+                        affected tests. Changed modules are reloaded in
+                        the same (warm) process. Use Ctrl+C to stop.
+        --budget <seconds>  Run the most useful of the selected tests
+                        that fit in the given time, using test durations
+                        and failures recorded by earlier runs. Recently
+                        failing, changed and cheap tests are favored.
+        --order <order> The order in which to run test modules and
+                        TestCase classes: "module" (discovery order, the
+                        default) or "cost" (cheapest first, using test
+                        durations recorded by earlier runs).
         -L <directive>  Specify a logging level via
                             <logname>:<levelname>
                         For example:
@@ -31,6 +83,14 @@
         test python cpln    # run tests with both 'python' and 'cpln' tags
         test -- -python     # exclude tests with the 'python' tag
                             # (the '--' is necessary to end the option list)
+
+    Tags can be combined into boolean expressions with "and", "or", "not"
+    (or a '-' prefix) and parentheses. Adjacent tags are implicitly and'ed.
+    A tag with '*' or '?' is a glob pattern and "re:<regex>" is a regular
+    expression (both match if any tag of a test matches). For example:
+
+        test "python and (cpln or -slow)"
+        test "perf*" not "re:^win(32|64)$"
     
     The full name and base name of a test module are implicit tags for that
     module, e.g. module "test_xdebug.py" has tags "test_xdebug" and "xdebug".
@@ -38,10 +98,30 @@
     tag for an test_* methods. A "test_foo" method also has "test_foo"
     and "foo" implicit tags.
 
+    Each block of doctest examples in a "*.doctests" file in a test dir is
+    a test as well, e.g. the second block in "foo.doctests" is the test
+    "foo/doctests/2" with the implicit tags "foo", "foo.doctests",
+    "doctests" and "2".
+
     Tags can be added explicitly added:
     - to modules via a __tags__ global list; and
     - to individual test_* methods via a "tags" attribute list (you can
       use the testlib.tag() decorator for this).
+
+    Expensive resources can be shared between tests with cached fixtures,
+    see testlib.fixture(). A fixture is built lazily the first time a
+    running test asks for it and is torn down after its last user in the
+    current selection of tests. Large read-only data sets can be shared,
+    zero-copy, by the tests of all test processes, see
+    testlib.share_data().
+
+    Reporters, profilers and other instrumentation can hook into test
+    runs with a testlib.Plugin (see testlib.register_plugin()).
+
+    A test module tagged "concurrent" (via __tags__) declares that its
+    test cases are thread-safe. With "--threads <n>" the test cases of
+    such a module are run concurrently (results are still reported in
+    order).
 """
 #TODO:
 # - Document how tests are found (note the special "test_cases()" and
@@ -57,18 +137,32 @@ import os
 from os.path import join, basename, dirname, abspath, splitext, \
                     isfile, isdir, normpath, exists
 import sys
+import re
 import getopt
-import glob
+import fnmatch
 import time
 import types
 import tempfile
 import unittest
+import codecs
+import doctest
 from pprint import pprint
-import imp
+import importlib.util
+import json
 import optparse
 import logging
 import textwrap
+import threading
 import traceback
+import gc
+import collections
+import collections.abc
+import shutil
+import mmap
+import difflib
+import functools
+import math
+import struct
 
 
 
@@ -110,14 +204,633 @@ def tag(*tags):
     return decorate
 
 
+#---- golden files
+# Compare generated output with an expected "golden" file. Large files are
+# compared chunk by chunk through mmap and only the regions around the
+# first few differences are diffed.
+
+# Set during a test run with "--update-golden" (see `run_tests()`):
+# `assert_golden()` (and `assert_golden_file()`) then rewrite a golden file
+# that does not match instead of failing.
+_update_golden = False
+
+_GOLDEN_CHUNK_SIZE = 1024 * 1024
+_GOLDEN_DIFF_WINDOW = 1000   # max lines per side diffed for a region
+
+def assert_golden(actual, golden_path, max_regions=3, context=3):
+    """Assert that the given output matches the golden file.
+
+    "actual" is the actual output: bytes, or a str (encoded as UTF-8).
+    "golden_path" is the path of the golden file with the expected output.
+    "max_regions" (optional, default 3) is the maximum number of regions
+        of differences shown in the unified diff in the failure message.
+    "context" (optional, default 3) is the number of lines of context
+        around each difference.
+
+    The golden file is not read into memory as a whole: it is compared
+    through mmap, one chunk at a time, and only on a mismatch is a diff
+    computed (of a window of lines around each differing region).
+    """
+    if isinstance(actual, str):
+        actual = actual.encode("utf-8")
+    _assert_golden(actual, None, golden_path, max_regions, context)
+
+def assert_golden_file(actual_path, golden_path, max_regions=3,
+                       context=3):
+    """Assert that the given file of output matches the golden file.
+
+    Like `assert_golden()`, but for output written to a file (at
+    "actual_path"). Neither file is read into memory as a whole.
+    """
+    _assert_golden(None, actual_path, golden_path, max_regions, context)
+
+def _assert_golden(actual, actual_path, golden_path, max_regions, context):
+    if not exists(golden_path):
+        if _update_golden:
+            _write_golden(golden_path, actual, actual_path)
+            return
+        raise AssertionError("golden file '%s' does not exist (use "
+                             "'--update-golden' to create it)" % golden_path)
+
+    to_close = []
+    try:
+        if actual_path is None:
+            a = actual
+        else:
+            f = open(actual_path, 'rb')
+            to_close.append(f)
+            a = _mmap_file(f)
+            to_close.append(a)
+        f = open(golden_path, 'rb')
+        to_close.append(f)
+        b = _mmap_file(f)
+        to_close.append(b)
+        if len(a) == len(b) and _first_difference(b, 0, a, 0) is None:
+            return
+        if not _update_golden:
+            diff = _golden_diff(b, a, golden_path, actual_path or "<actual>",
+                                max_regions, context)
+    finally:
+        for obj in reversed(to_close):
+            if not isinstance(obj, bytes):
+                obj.close()
+    if _update_golden:
+        _write_golden(golden_path, actual, actual_path)
+        return
+    raise AssertionError("output does not match golden file '%s' (use "
+                         "'--update-golden' to update it):\n%s"
+                         % (golden_path, diff))
+
+def _mmap_file(f):
+    """Return a read-only mmap of the given open file (or b"" if empty)."""
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _write_golden(golden_path, actual, actual_path):
+    log.info("update golden file '%s'", golden_path)
+    if not exists(dirname(abspath(golden_path))):
+        os.makedirs(dirname(abspath(golden_path)))
+    if actual_path is not None:
+        shutil.copyfile(actual_path, golden_path)
+    else:
+        f = open(golden_path, 'wb')
+        try:
+            f.write(actual)
+        finally:
+            f.close()
+
+def _first_difference(a, a_start, b, b_start):
+    """Return the offset (from the given starts) of the first byte
+    differing between the given buffers, or None if the rest of them is
+    the same.
+    """
+    a_len = len(a) - a_start
+    b_len = len(b) - b_start
+    offset = 0
+    n = min(a_len, b_len)
+    while offset < n:
+        size = min(_GOLDEN_CHUNK_SIZE, n - offset)
+        if a[a_start+offset:a_start+offset+size] \
+           != b[b_start+offset:b_start+offset+size]:
+            # Bisect down to the differing byte.
+            while size > 1:
+                half = size // 2
+                if a[a_start+offset:a_start+offset+half] \
+                   == b[b_start+offset:b_start+offset+half]:
+                    offset += half
+                    size -= half
+                else:
+                    size = half
+            return offset
+        offset += size
+    if a_len != b_len:
+        return n
+    return None
+
+def _read_lines(buf, start, max_lines):
+    """Return up to "max_lines" lines of the buffer from the given start
+    and the offset after them.
+    """
+    lines = []
+    pos = start
+    end = len(buf)
+    while pos < end and len(lines) < max_lines:
+        eol = buf.find(b"\n", pos)
+        eol = end if eol == -1 else eol + 1
+        lines.append(buf[pos:eol])
+        pos = eol
+    return lines, pos
+
+def _golden_diff(a, b, a_name, b_name, max_regions, context):
+    """Return a unified diff of the first "max_regions" regions of
+    differences between the given buffers.
+
+    The lines are compared by hash. Only a window of lines around each
+    difference is diffed: the rest is compared byte for byte.
+    """
+    out = ["--- %s\n" % a_name, "+++ %s\n" % b_name]
+    num_regions = 0
+    a_pos = b_pos = 0       # at the start of a line, same content before
+    a_lineno = b_lineno = 0
+    while True:
+        offset = _first_difference(a, a_pos, b, b_pos)
+        if offset is None:
+            break
+        if num_regions >= max_regions:
+            out.append("(more differences not shown)\n")
+            break
+
+        # Start the window "context" lines before the differing line.
+        start = _line_start(a, a_pos, a_pos + offset)
+        for i in range(context):
+            if start <= a_pos:
+                break
+            start = _line_start(a, a_pos, start - 1)
+        num_lines = a[a_pos:start].count(b"\n")
+        a_lineno += num_lines
+        b_lineno += num_lines
+        b_pos += start - a_pos
+        a_pos = start
+
+        a_lines, a_end = _read_lines(a, a_pos, _GOLDEN_DIFF_WINDOW)
+        b_lines, b_end = _read_lines(b, b_pos, _GOLDEN_DIFF_WINDOW)
+        a_hashes = [hash(line) for line in a_lines]
+        b_hashes = [hash(line) for line in b_lines]
+        matcher = difflib.SequenceMatcher(None, a_hashes, b_hashes,
+                                          autojunk=False)
+        opcodes = matcher.get_opcodes()
+        in_sync = opcodes[-1][0] == "equal" \
+                  or (a_end == len(a) and b_end == len(b))
+        if not in_sync:
+            # Cut the window back to the end of its last run of equal
+            # lines (if any) and carry on comparing from there.
+            equal = [op for op in opcodes[1:] if op[0] == "equal"]
+            if equal:
+                i2, j2 = equal[-1][2], equal[-1][4]
+                a_end = a_pos + sum(len(l) for l in a_lines[:i2])
+                b_end = b_pos + sum(len(l) for l in b_lines[:j2])
+                a_lines, b_lines = a_lines[:i2], b_lines[:j2]
+                matcher = difflib.SequenceMatcher(None, a_hashes[:i2],
+                    b_hashes[:j2], autojunk=False)
+                in_sync = True
+        for group in matcher.get_grouped_opcodes(context):
+            if num_regions >= max_regions:
+                out.append("(more differences not shown)\n")
+                return ''.join(out)
+            num_regions += 1
+            i1, i2 = group[0][1], group[-1][2]
+            j1, j2 = group[0][3], group[-1][4]
+            out.append("@@ -%s +%s @@\n" % (
+                _unified_range(a_lineno + i1, i2 - i1),
+                _unified_range(b_lineno + j1, j2 - j1)))
+            for tag, i1, i2, j1, j2 in group:
+                if tag == "equal":
+                    out += [" " + _golden_line(l) for l in a_lines[i1:i2]]
+                    continue
+                out += ["-" + _golden_line(l) for l in a_lines[i1:i2]]
+                out += ["+" + _golden_line(l) for l in b_lines[j1:j2]]
+
+        if not in_sync:
+            # Not back in sync by the end of the window.
+            out.append("(differences after line %d not diffed)\n"
+                       % (a_lineno + len(a_lines)))
+            break
+        a_lineno += len(a_lines)
+        b_lineno += len(b_lines)
+        a_pos, b_pos = a_end, b_end
+    return ''.join(out)
+
+def _line_start(buf, start, pos):
+    """Return the offset of the start of the line at "pos" in the buffer,
+    but not before "start".
+    """
+    nl = buf.rfind(b"\n", start, pos)
+    return nl + 1 if nl != -1 else start
+
+def _unified_range(start, length):
+    # As in `difflib.unified_diff()`: line numbers are 1-based.
+    if length == 1:
+        return "%d" % (start + 1)
+    if not length:
+        return "%d,0" % start
+    return "%d,%d" % (start + 1, length)
+
+def _golden_line(line):
+    line = line.decode("utf-8", "replace")
+    if not line.endswith("\n"):
+        line += "\n\\ No newline at end of file\n"
+    return line
+
+
+#---- cached fixtures
+# A fixture is a resource (a server, a database, a large parsed data set)
+# that can be shared by many tests. Register one with the `fixture()`
+# decorator, declare that tests use it (a "__fixtures__" list on the test
+# module or TestCase class, or the `uses()` decorator on test_* methods) and
+# get its value in a test with `fixture_value()`.
+
+FIXTURE_SCOPES = ("session", "namespace", "module")
+
+# <fixture name> -> {<name of the defining module>: _Fixture}
+_fixtures_from_name = {}
+_fixture_manager = None   # the FixtureManager for the current test run
+
+class _Fixture(object):
+    def __init__(self, name, func, scope):
+        self.name = name
+        self.func = func
+        self.scope = scope
+    def __str__(self):
+        return self.name
+
+def _find_fixture(name, module_name):
+    """Return the named fixture for the tests of the given module.
+
+    That is the fixture of that name defined in the module itself, if
+    any, else the only one defined elsewhere (e.g. in a shared helper
+    module). Returns None if there is none, or more than one elsewhere.
+    """
+    fixture_from_module = _fixtures_from_name.get(name, {})
+    if module_name in fixture_from_module:
+        return fixture_from_module[module_name]
+    if len(fixture_from_module) == 1:
+        return list(fixture_from_module.values())[0]
+    return None
+
+def fixture(scope="session", name=None):
+    """Decorator to register a cached test fixture.
+
+    "scope" is one of "session" (one instance for the whole run),
+        "namespace" (one instance per test namespace) or "module" (one
+        instance per test module).
+    "name" (optional) is the fixture name. By default the name of the
+        decorated function is used. Fixtures of the same name can be
+        defined in different test modules: tests use the one in their own
+        module (see `_find_fixture()`).
+
+    The decorated function is called with no arguments to build the
+    fixture. If it is a generator function, the first yielded value is the
+    fixture and the rest of the generator is run to tear it down.
+
+    Example:
+        @testlib.fixture(scope="module")
+        def server():
+            s = start_server()
+            yield s
+            s.stop()
+
+        class ServerTestCase(unittest.TestCase):
+            __fixtures__ = ["server"]
+            def test_ping(self):
+                testlib.fixture_value("server").ping()
+    """
+    if scope not in FIXTURE_SCOPES:
+        raise TestError("invalid fixture scope: %r (must be one of: %s)"
+                        % (scope, ', '.join(FIXTURE_SCOPES)))
+    def decorate(f):
+        fixture_name = name or f.__name__
+        _fixtures_from_name.setdefault(fixture_name, {})[f.__module__] \
+            = _Fixture(fixture_name, f, scope)
+        return f
+    return decorate
+
+def uses(*names):
+    """Decorator to declare the fixtures used by test_* functions.
+    
+    Example:
+        class MyTestCase(unittest.TestCase):
+            @testlib.uses("server")
+            def test_foo(self):
+                #...
+    """
+    def decorate(f):
+        if not hasattr(f, "fixtures"):
+            f.fixtures = []
+        f.fixtures += names
+        return f
+    return decorate
+
+def fixture_value(name):
+    """Return the value of the named fixture for the running test.
+
+    The fixture is built on first use. Tests should declare the fixtures
+    they use (see `uses()`) so that they can be torn down as soon as their
+    last user has run. Undeclared fixtures are torn down at the end of the
+    test run.
+    """
+    if _fixture_manager is None:
+        raise TestError("cannot get fixture %r: no test run in progress"
+                        % name)
+    return _fixture_manager.get(name)
+
+
+#---- shared test data
+# A large read-only data set (e.g. loaded by a harness "setup_func") can be
+# shared by the tests of all test processes: `share_data()` writes it once
+# to a file in shared memory (in "/dev/shm", if available) that each
+# process maps, and tests get a zero-copy, read-only view of it with
+# `shared_data()`. Each process holds a shared flock on the file while it
+# uses it: the last one to release it removes the file.
+
+_shared_data_from_name = {}   # <name> -> _SharedData
+_shared_data_lock = threading.Lock()
+_shared_data_atexit = False
+
+class _SharedData(object):
+    def __init__(self, path, f, buf):
+        self.path = path
+        self.f = f
+        self.buf = buf
+        self.pid = os.getpid()
+
+def share_data(name, loader):
+    """Share the named read-only data set with tests of all test processes.
+
+    "name" identifies the data set (across the test processes of a user).
+    "loader" is a callable returning the data as a bytes-like object
+        (bytes, bytearray, an array.array, ...). It is only called if no
+        running test process has shared the data yet.
+
+    Call this in the harness "setup_func" and get the data in tests with
+    `shared_data()`. The data is written to a memory-mapped file that is
+    removed when the last process using it releases it (at the end of the
+    test run, see `release_shared_data()`).
+    """
+    global _shared_data_atexit
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    with _shared_data_lock:
+        if name in _shared_data_from_name:
+            return
+        if not _shared_data_atexit:
+            import atexit
+            atexit.register(release_shared_data)
+            _shared_data_atexit = True
+        path = _shared_data_path(name)
+        if fcntl is None:
+            # No locking: don't share with other processes.
+            path += ".%d" % os.getpid()
+            f = _write_shared_data(path, loader, fcntl)
+        else:
+            # Serialize loading the data set among test processes with a
+            # lock file (left in place: removing it would be racy).
+            lock_f = open(path + ".lock", 'a')
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX)
+                f = _open_shared_data(path, fcntl)
+                if f is None:
+                    log.debug("load shared data '%s' to '%s'", name, path)
+                    f = _write_shared_data(path, loader, fcntl)
+            finally:
+                lock_f.close()
+        if os.fstat(f.fileno()).st_size:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = b""   # can't mmap an empty file
+        _shared_data_from_name[name] = _SharedData(path, f, buf)
+
+def shared_data(name, typecode=None):
+    """Return a read-only memoryview of the named shared data set.
+
+    "typecode" (optional) is an `array` module type code (e.g. "d") to
+        get a view of the data as items of that type (see
+        `memoryview.cast()`).
+    """
+    data = _shared_data_from_name.get(name)
+    if data is None:
+        raise TestError("no shared data %r (see `testlib.share_data()`)"
+                        % name)
+    view = memoryview(data.buf)
+    if typecode is not None:
+        view = view.cast(typecode)
+    return view
+
+def release_shared_data():
+    """Release the data sets shared by this process with `share_data()`.
+
+    The file of a data set is removed unless another test process still
+    uses it. This is called at the end of `harness()` and at exit.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    with _shared_data_lock:
+        for name, data in list(_shared_data_from_name.items()):
+            del _shared_data_from_name[name]
+            if data.pid != os.getpid():
+                continue    # inherited by a forked process: not ours
+            if not isinstance(data.buf, bytes):
+                try:
+                    data.buf.close()
+                except BufferError:
+                    # A test still holds a view: the mapping stays until
+                    # exit, but the file can still be removed.
+                    log.debug("shared data '%s' still in use", name)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(data.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(data.path)
+            except EnvironmentError:
+                pass    # still used by another test process
+            data.f.close()
+
+def _user_id():
+    """Return an id of the current user, for per-user temporary files."""
+    if hasattr(os, "getuid"):
+        return str(os.getuid())
+    return os.environ.get("USERNAME", "")
+
+def _shared_data_path(name):
+    shm_dir = "/dev/shm"
+    if not (isdir(shm_dir) and os.access(shm_dir, os.W_OK)):
+        shm_dir = tempfile.gettempdir()
+    return join(shm_dir, "testlib-%s-%s"
+                % (_user_id(), re.sub(r"[^\w.-]", "_", name)))
+
+def _open_shared_data(path, fcntl):
+    """Open (and lock for reading) the data file at the given path, if a
+    running process is using it. A file that no process is using is left
+    over from a test run that did not clean up (it was killed, say) and
+    may be out of date: that is removed.
+    """
+    try:
+        f = open(path, 'rb')
+    except EnvironmentError:
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except EnvironmentError:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return f
+    os.remove(path)
+    f.close()
+    return None
+
+def _write_shared_data(path, loader, fcntl):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    f = open(tmp_path, 'w+b')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH)
+        f.write(memoryview(loader()).cast("B"))
+        f.flush()
+        os.rename(tmp_path, path)
+    except:
+        f.close()
+        os.remove(tmp_path)
+        raise
+    return f
+
+
+#---- parametrized tests
+
+class Param(object):
+    """The arguments, and optional tags and name, for one test case of a
+    `params()`-decorated test function.
+    """
+    def __init__(self, args=(), kwargs=None, tags=None, name=None):
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.tags = list(tags or [])
+        self.name = name
+    def __repr__(self):
+        return "<Param %r %r>" % (self.args, self.kwargs)
+
+def params(cases):
+    """Decorator to run a test_* function for each of the given cases.
+
+    "cases" is one of:
+    - a list (or any iterable) of cases;
+    - a callable returning such an iterable, called when tests are
+      gathered; or
+    - the path to a data file (relative to the test module) with the
+      cases: a ".json" file with a list of cases, a ".jsonl" file with a
+      case per line or a ".csv" file with a header row and a case per row.
+
+    A case is a tuple or list of positional arguments, a dict of keyword
+    arguments, a `Param` or a single positional argument. In a dict, the
+    special "_tags" (a list, or a space-separated string) and "_name" keys
+    give the tags and the name of the case.
+
+    Each case becomes a separate test, named and tagged by its index or
+    name, e.g. "foo/bar/add[3]" for case 3 of `BarTestCase.test_add` in
+    "test_foo.py". The TestCase instance for a case is only created if the
+    case is selected to be run.
+
+    Example:
+        class BarTestCase(unittest.TestCase):
+            @testlib.params([(1, 2, 3), (2, 2, 4),
+                             testlib.Param((1, -1, 0), tags=["negative"])])
+            def test_add(self, a, b, expected):
+                self.assertEqual(a + b, expected)
+
+            @testlib.params("parse_cases.jsonl")
+            def test_parse(self, text, ast):
+                #...
+
+    Outside of testlib (e.g. when run by plain unittest) the decorated test
+    function runs all cases as subtests.
+    """
+    def decorate(f):
+        def run_all_cases(self):
+            for index, param in enumerate(_params_from_cases(cases, f)):
+                if param.name is None:
+                    name = index
+                else:
+                    name = param.name
+                with self.subTest(name):
+                    f(self, *param.args, **param.kwargs)
+        run_all_cases.__name__ = f.__name__
+        run_all_cases.__module__ = f.__module__
+        run_all_cases.__doc__ = f.__doc__
+        run_all_cases.__dict__.update(f.__dict__)   # e.g. tags
+        run_all_cases._testlib_params_ = cases
+        run_all_cases._testlib_params_func_ = f
+        return run_all_cases
+    return decorate
+
+def _param_from_case(case):
+    if isinstance(case, Param):
+        return case
+    elif isinstance(case, (tuple, list)):
+        return Param(case)
+    elif isinstance(case, dict):
+        kwargs = dict(case)
+        tags = kwargs.pop("_tags", None)
+        if isinstance(tags, str):
+            tags = tags.split()
+        return Param(kwargs=kwargs, tags=tags, name=kwargs.pop("_name", None))
+    else:
+        return Param((case,))
+
+def _cases_from_path(path):
+    ext = splitext(path)[1]
+    f = open(path)
+    try:
+        if ext == ".json":
+            return json.load(f)
+        elif ext == ".jsonl":
+            return [json.loads(line) for line in f if line.strip()]
+        elif ext == ".csv":
+            import csv
+            return [dict((k, v) for k, v in row.items() if v is not None)
+                    for row in csv.DictReader(f)]
+        else:
+            raise TestError("unknown test cases file type (expected .json, "
+                            ".jsonl or .csv): '%s'" % path)
+    finally:
+        f.close()
+
+def _params_from_cases(cases, testfn):
+    """Generate a `Param` for each of the cases given to `params()`."""
+    if isinstance(cases, str):
+        path = cases
+        if not os.path.isabs(path):
+            testmod = sys.modules.get(testfn.__module__)
+            testmod_file = getattr(testmod, "__file__", None)
+            if testmod_file:
+                path = join(dirname(testmod_file), path)
+        cases = _cases_from_path(path)
+    elif callable(cases):
+        cases = cases()
+    for case in cases:
+        yield _param_from_case(case)
+
+
 #---- timedtest decorator
 # Use this to assert that a test completes in a given amount of time.
 # This is from http://www.artima.com/forums/flat.jsp?forum=122&thread=129497
 # Including here, becase it might be useful.
-# NOTE: Untested and I suspect some breakage.
 
 TOLERANCE = 0.05
 
+# The tag of timing-sensitive tests (see "--isolate-timing").
+TIMING_TAG = "timing"
+
 class DurationError(AssertionError): pass
 
 def timedtest(max_time, tolerance=TOLERANCE):
@@ -125,23 +838,216 @@ def timedtest(max_time, tolerance=TOLERANCE):
     decorates the test method with a timer
     when the time spent by the test exceeds
     max_time in seconds, an Assertion error is thrown.
+
+    The test is tagged "timing" (see "--isolate-timing") and garbage
+    collection is disabled while it runs.
     """
     def _timedtest(function):
+        @functools.wraps(function)
         def wrapper(*args, **kw):
-            start_time = time.time()
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            start_time = time.perf_counter()
             try:
                 function(*args, **kw)
             finally:
-                total_time = time.time() - start_time
+                total_time = time.perf_counter() - start_time
+                if gc_was_enabled:
+                    gc.enable()
                 if total_time > max_time + tolerance:
                     raise DurationError(('Test was too long (%.2f s)'
                                            % total_time))
+        wrapper.tags = list(getattr(function, "tags", [])) + [TIMING_TAG]
         return wrapper
 
     return _timedtest
 
 
 
+#---- concurrent load tests
+
+def concurrent(num_workers, calls=1, processes=False, min_throughput=None):
+    """Decorator to run a test_* method concurrently as a load test.
+
+    "num_workers" is the number of worker threads (or processes) that each
+        call the test method, all starting together behind a barrier.
+    "calls" (optional, default 1) is the number of calls per worker.
+    "processes" (optional, default False) can be set true to run the
+        workers in forked processes (on platforms with fork) instead of
+        threads, e.g. to load a server without contending for the GIL.
+        This is not supported for tests run in worker threads ("--threads",
+        see ThreadedTestSuite).
+    "min_throughput" (optional) is the minimum number of calls per second
+        (across all workers). The test fails if the throughput is lower.
+
+    The throughput and the 50th and 99th percentile call latencies are
+    reported after the test. An exception in any worker is re-raised, as
+    the test's failure or error.
+
+    Example:
+        class CacheTestCase(unittest.TestCase):
+            @testlib.concurrent(8, calls=1000, min_throughput=50000)
+            def test_get(self):
+                cache.get("foo")
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kw):
+            call = lambda: function(self, *args, **kw)
+            if processes:
+                start, end, latencies, errors \
+                    = _run_worker_processes(call, num_workers, calls)
+            else:
+                start, end, latencies, errors \
+                    = _run_worker_threads(call, num_workers, calls)
+            if errors:
+                raise errors[0]
+            latencies.sort()
+            elapsed = max(end - start, 1e-9)
+            stats = {
+                "workers": "%d %s" % (num_workers,
+                                      processes and "processes" or "threads"),
+                "calls": len(latencies),
+                "throughput": len(latencies) / elapsed,
+                "p50": _percentile(latencies, 0.50),
+                "p99": _percentile(latencies, 0.99),
+            }
+            self._testlib_load_stats_ = stats
+            if min_throughput is not None \
+               and stats["throughput"] < min_throughput:
+                raise AssertionError(
+                    "throughput of %.0f calls/s is below the minimum of "
+                    "%g calls/s" % (stats["throughput"], min_throughput))
+        return wrapper
+    return decorate
+
+def _run_worker_threads(call, num_workers, calls):
+    """Run "calls" calls of the given function in each of "num_workers"
+    threads started together.
+
+    Returns (<start time>, <end time>, <call latencies>, <exceptions>).
+    """
+    barrier = threading.Barrier(num_workers)
+    spans = [None] * num_workers
+    latencies_from_worker = [[] for i in range(num_workers)]
+    errors = [None] * num_workers
+    def work(index):
+        latencies = latencies_from_worker[index]
+        barrier.wait()
+        start = time.time()
+        try:
+            for i in range(calls):
+                call_start = time.perf_counter()
+                call()
+                latencies.append(time.perf_counter() - call_start)
+        except BaseException:
+            errors[index] = sys.exc_info()[1]
+        spans[index] = (start, time.time())
+    threads = [threading.Thread(target=work, args=(i,),
+                                name="load-worker-%d" % i)
+               for i in range(num_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (min(s[0] for s in spans), max(s[1] for s in spans),
+            sum(latencies_from_worker, []), [e for e in errors if e])
+
+def _run_worker_processes(call, num_workers, calls):
+    """Like `_run_worker_threads()`, but in forked worker processes.
+
+    Each worker waits on a pipe for the start signal (once all are forked)
+    and sends back its results, pickled, on another pipe. An exception in
+    a worker is re-raised with its traceback text as the cause.
+    """
+    import pickle
+    if not hasattr(os, "fork"):
+        raise TestError("concurrent load tests in processes are not "
+                        "supported on this platform (requires fork)")
+    if threading.current_thread() is not threading.main_thread():
+        # Other tests running in threads could hold locks the forked
+        # workers would then wait on forever.
+        raise TestError("concurrent load tests in processes cannot be run "
+                        "in a worker thread (e.g. with '--threads')")
+    start_r, start_w = os.pipe()
+    workers = []    # [(<pid>, <results read fd>), ...]
+    try:
+        for index in range(num_workers):
+            r, w = os.pipe()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    os.close(r)
+                    os.close(start_w)
+                    os.read(start_r, 1)
+                    latencies = []
+                    error = None
+                    start = time.time()
+                    try:
+                        for i in range(calls):
+                            call_start = time.perf_counter()
+                            call()
+                            latencies.append(time.perf_counter()
+                                             - call_start)
+                    except BaseException:
+                        _, ex, _ = sys.exc_info()
+                        error = (ex, traceback.format_exc())
+                    end = time.time()
+                    try:
+                        data = pickle.dumps((start, end, latencies, error))
+                    except Exception:
+                        error = error and (None, error[1])
+                        data = pickle.dumps((start, end, latencies, error))
+                    with os.fdopen(w, 'wb') as f:
+                        f.write(data)
+                except BaseException:
+                    status = 1
+                os._exit(status)
+            os.close(w)
+            workers.append((pid, r))
+    finally:
+        os.close(start_r)
+        os.write(start_w, b"x" * len(workers))
+        os.close(start_w)
+
+    spans = []
+    latencies = []
+    errors = []
+    for index, (pid, r) in enumerate(workers):
+        with os.fdopen(r, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        if not data:
+            errors.append(TestError("load test worker process %d died"
+                                    % index))
+            continue
+        start, end, worker_latencies, error = pickle.loads(data)
+        spans.append((start, end))
+        latencies += worker_latencies
+        if error is not None:
+            ex, tb = error
+            if ex is None:
+                ex = TestError("load test worker process %d failed" % index)
+            ex.__cause__ = TestError("traceback in load test worker "
+                                     "process %d:\n\n%s" % (index, tb))
+            errors.append(ex)
+    if not spans:
+        spans = [(0.0, 0.0)]
+    return (min(s[0] for s in spans), max(s[1] for s in spans),
+            latencies, errors)
+
+def _percentile(sorted_values, fraction):
+    """Return the given percentile (nearest rank) of the sorted values."""
+    if not sorted_values:
+        return 0.0
+    index = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(index, 0)]
+
+
+
 #---- module api
 
 class Test(object):
@@ -150,20 +1056,45 @@ class Test(object):
         self.ns = ns
         self.testmod = testmod
         self.testcase = testcase
+        self.testcase_class = testcase.__class__
         self.testfn_name = testfn_name
         self.testsuite_class = testsuite_class
+        self._tag_set = None
+        self._init_testcase(testcase)
+    def _init_testcase(self, testcase):
         # Give each testcase some extra testlib attributes for useful
         # introspection on TestCase instances later on.
-        self.testcase._testlib_shortname_ = self.shortname()
-        self.testcase._testlib_explicit_tags_ = self.explicit_tags()
-        self.testcase._testlib_implicit_tags_ = self.implicit_tags()
+        testcase._testlib_shortname_ = self.shortname()
+        testcase._testlib_explicit_tags_ = self.explicit_tags()
+        testcase._testlib_implicit_tags_ = self.implicit_tags()
+        testcase._testlib_fixtures_ = self.fixture_names()
+        testcase._testlib_scope_ = self.scope()
+        testcase._testlib_module_ = self.testmod.__name__
+        testcase._testlib_test_ = self
+    def new_testcase(self):
+        """Return a new TestCase instance for this test (e.g. to rerun
+        it).
+        """
+        testcase = self.testcase_class(self.testfn_name)
+        self._init_testcase(testcase)
+        return testcase
     def __str__(self):
         return self.shortname()
     def __repr__(self):
         return "<Test %s>" % self.shortname()
+    def testmod_name(self):
+        """The name of the test module, e.g. "test_foo".
+
+        This is the module's name in its test dir, which can differ from
+        the name under which it was imported (see `testmods_from_testdir`).
+        """
+        return getattr(self.testmod, "_testlib_name_", self.testmod.__name__)
+    def scope(self):
+        """The (<namespace>, <test module name>) of this test."""
+        return (self.ns, self.testmod_name())
     def shortname(self):
-        bits = [self._normname(self.testmod.__name__),
-                self._normname(self.testcase.__class__.__name__),
+        bits = [self._normname(self.testmod_name()),
+                self._normname(self.testcase_class.__name__),
                 self._normname(self.testfn_name)]
         if self.ns:
             bits.insert(0, self.ns)
@@ -184,18 +1115,18 @@ class Test(object):
         tags = []
         if hasattr(self.testmod, "__tags__"):
             tags += self.testmod.__tags__
-        if hasattr(self.testcase, "__tags__"):
-            tags += self.testcase.__tags__
-        testfn = getattr(self.testcase, self.testfn_name)
+        if hasattr(self.testcase_class, "__tags__"):
+            tags += self.testcase_class.__tags__
+        testfn = getattr(self.testcase_class, self.testfn_name)
         if hasattr(testfn, "tags"):
             tags += testfn.tags
         return self._flatten_tags(tags)
     def implicit_tags(self):
         tags = [
-            self.testmod.__name__.lower(),
-            self._normname(self.testmod.__name__),
-            self.testcase.__class__.__name__.lower(),
-            self._normname(self.testcase.__class__.__name__),
+            self.testmod_name().lower(),
+            self._normname(self.testmod_name()),
+            self.testcase_class.__name__.lower(),
+            self._normname(self.testcase_class.__name__),
             self.testfn_name,
             self._normname(self.testfn_name),
         ]
@@ -204,8 +1135,23 @@ class Test(object):
         return self._flatten_tags(tags)
     def tags(self):
         return self.explicit_tags() + self.implicit_tags()
+    def tag_set(self):
+        """The set of (lowercased) tags, for tag filtering."""
+        if self._tag_set is None:
+            self._tag_set = frozenset(t.lower() for t in self.tags())
+        return self._tag_set
+    def fixture_names(self):
+        names = []
+        if hasattr(self.testmod, "__fixtures__"):
+            names += self.testmod.__fixtures__
+        if hasattr(self.testcase_class, "__fixtures__"):
+            names += self.testcase_class.__fixtures__
+        testfn = getattr(self.testcase_class, self.testfn_name)
+        if hasattr(testfn, "fixtures"):
+            names += testfn.fixtures
+        return names
     def doc(self):
-        testfn = getattr(self.testcase, self.testfn_name)
+        testfn = getattr(self.testcase_class, self.testfn_name)
         return testfn.__doc__ or ""
     def _normname(self, name):
         if name.startswith("test_"):
@@ -217,49 +1163,419 @@ class Test(object):
         else:
             return name
 
+class ParamTest(Test):
+    """A test for one case of a `params()`-decorated test function.
 
-def testmod_paths_from_testdir(testdir):
-    """Generate test module paths in the given dir."""
-    for path in glob.glob(join(testdir, "test_*.py")):
-        yield path
+    The TestCase instance for the case is only created when the
+    "testcase" attribute is first used, i.e. typically only if the test
+    is selected to be run.
+    """
+    def __init__(self, ns, testmod, testcase_class, testfn_name, index,
+                 param, testsuite_class=None):
+        self.ns = ns
+        self.testmod = testmod
+        self.testcase_class = testcase_class
+        self.testfn_name = testfn_name
+        self.index = index
+        self.param = param
+        self.testsuite_class = testsuite_class
+        self._tag_set = None
+        self._testcase = None
+    @property
+    def testcase(self):
+        if self._testcase is None:
+            self._testcase = self.new_testcase()
+        return self._testcase
+    def new_testcase(self):
+        testcase = self.testcase_class(self.testfn_name)
+        testfn = getattr(self.testcase_class,
+                         self.testfn_name)._testlib_params_func_
+        args, kwargs = self.param.args, self.param.kwargs
+        def run_case():
+            return testfn(testcase, *args, **kwargs)
+        # An instance attribute, this is what TestCase.run() calls.
+        setattr(testcase, self.testfn_name, run_case)
+        self._init_testcase(testcase)
+        return testcase
+    def case_name(self):
+        """The name of this case: its given name or its index."""
+        if self.param.name is not None:
+            return str(self.param.name)
+        return str(self.index)
+    def shortname(self):
+        return "%s[%s]" % (Test.shortname(self), self.case_name())
+    def explicit_tags(self):
+        return Test.explicit_tags(self) + self._flatten_tags(self.param.tags)
+    def implicit_tags(self):
+        return Test.implicit_tags(self) + self._flatten_tags([
+            "%s[%s]" % (self._normname(self.testfn_name), self.case_name())])
 
-    for path in glob.glob(join(testdir, "test_*")):
-        if not isdir(path): continue
-        if not isfile(join(path, "__init__.py")): continue
-        yield path
+class _DocTestBlocks(object):
+    """The blocks of doctest examples in a doctests file (or docstring).
 
-def testmods_from_testdir(testdir):
-    """Generate test modules in the given test dir.
-    
-    Modules are imported with 'testdir' first on sys.path.
+    A block is a run of examples not separated by any prose. All blocks
+    share one set of globals, as they would if the file were run with
+    doctest.DocFileTest.
     """
-    testdir = normpath(testdir)
-    for testmod_path in testmod_paths_from_testdir(testdir):
-        testmod_name = splitext(basename(testmod_path))[0]
-        log.debug("import test module '%s'", testmod_path)
+    def __init__(self, name, path, text, globs, lineno=0):
+        self.name = name
+        self.path = path
+        self.globs = globs
+        self.lineno = lineno
+        self.blocks = []
+        block = []
+        for piece in doctest.DocTestParser().parse(text, name):
+            if isinstance(piece, doctest.Example):
+                block.append(piece)
+            elif piece.strip() and block:
+                self.blocks.append(block)
+                block = []
+        if block:
+            self.blocks.append(block)
+        self._num_run = 0
+
+    def _run_examples(self, examples, out):
+        runner = doctest.DocTestRunner(verbose=False)
+        test = doctest.DocTest(examples, self.globs, self.name, self.path,
+                               self.lineno, None)
+        num_failed, _ = runner.run(test, out=out, clear_globs=False)
+        self.globs = test.globs  # DocTest() works on a copy
+        return num_failed
+
+    def run_block(self, index):
+        """Run the examples of the given block.
+
+        Blocks before it that haven't been run (e.g. because they weren't
+        selected) are first run quietly, because later blocks typically
+        depend on their imports and variables. Returns the doctest report
+        for failing examples, or None if all passed.
+        """
+        while self._num_run < index:
+            self._run_examples(self.blocks[self._num_run], lambda s: None)
+            self._num_run += 1
+        report = []
+        num_failed = self._run_examples(self.blocks[index], report.append)
+        self._num_run = max(self._num_run, index + 1)
+        if num_failed:
+            return ''.join(report)
+        return None
+
+class DocTestBlockTestCase(unittest.TestCase):
+    """A TestCase running one block of doctest examples."""
+    def __init__(self, blocks, index):
+        unittest.TestCase.__init__(self, "runTest")
+        self.blocks = blocks
+        self.index = index
+    def runTest(self):
+        report = self.blocks.run_block(self.index)
+        if report is not None:
+            raise self.failureException("\n" + report)
+
+class DocTestsTest(Test):
+    """A test for one block of doctest examples.
+
+    These are gathered from "*.doctests" files in the test dirs and from
+    the docstring of test modules that set `__doctests__ = True`. A file
+    "foo.doctests" has the implicit tags "foo", "foo.doctests", "doctests"
+    and "block<N>" for the block number (from 1). Tests from a
+    "test_foo.py" docstring have the implicit tags "test_foo", "foo",
+    "docstring" and "block<N>". For example the shortname of the third
+    block of "foo.doctests" is "foo/doctests/block3".
+
+    The DocTestBlockTestCase for a block is only created when the
+    "testcase" attribute is first used.
+    """
+    testcase_class = DocTestBlockTestCase
+    testfn_name = "runTest"
+
+    def __init__(self, ns, testmod, blocks, index, kind="doctests",
+                 testsuite_class=None):
+        self.ns = ns
+        self.testmod = testmod
+        self.blocks = blocks
+        self.index = index
+        self.kind = kind
+        self.testsuite_class = testsuite_class
+        self._tag_set = None
+        self._testcase = None
+    @property
+    def testcase(self):
+        if self._testcase is None:
+            self._testcase = self.new_testcase()
+        return self._testcase
+    def new_testcase(self):
+        testcase = DocTestBlockTestCase(self.blocks, self.index)
+        self._init_testcase(testcase)
+        return testcase
+    def block_name(self):
+        return "block%d" % (self.index + 1)
+    def shortname(self):
+        bits = [self._normname(self.testmod_name()), self.kind,
+                self.block_name()]
+        if self.ns:
+            bits.insert(0, self.ns)
+        return '/'.join(bits)
+    def explicit_tags(self):
+        return self._flatten_tags(getattr(self.testmod, "__tags__", []))
+    def implicit_tags(self):
+        tags = [self.testmod_name().lower(),
+                self._normname(self.testmod_name()),
+                self.kind, self.block_name()]
+        if self.kind == "doctests":
+            tags.insert(1, self.testmod_name().lower() + ".doctests")
+        if self.ns:
+            tags.insert(0, self.ns)
+        return self._flatten_tags(tags)
+    def fixture_names(self):
+        return list(getattr(self.testmod, "__fixtures__", []))
+    def doc(self):
+        return ""
+
+def doctests_tests_from_testdir(testdir, ns=None):
+    """Generate a `DocTestsTest` for each example block in each
+    "*.doctests" file in the given test dir.
+    """
+    _, _, doctests_paths, _ = _scan_testdir(testdir)
+    for path in doctests_paths:
+        path = abspath(path)
+        name = basename(path)
+        # A stand-in test module, for grouping and naming the tests.
+        testmod = types.ModuleType(name)
+        testmod.__file__ = path
+        testmod._testlib_name_ = splitext(name)[0]
+        testmod._testlib_path_ = path
         try:
-            iinfo = imp.find_module(testmod_name, [dirname(testmod_path)])
-            testabsdir = abspath(testdir)
-            sys.path.insert(0, testabsdir)
-            old_dir = os.getcwd()
-            os.chdir(testdir)
+            f = open(path)
             try:
-                testmod = imp.load_module(testmod_name, *iinfo)
+                text = f.read()
             finally:
-                os.chdir(old_dir)
-                sys.path.remove(testabsdir)
-        except TestSkipped:
-            _, ex, _ = sys.exc_info()
-            log.warn("'%s' module skipped: %s", testmod_name, ex)
+                f.close()
+            blocks = _DocTestBlocks(name, path, text,
+                {"__name__": "__main__", "__file__": path})
         except Exception:
             _, ex, _ = sys.exc_info()
-            log.warn("could not import test module '%s': %s (skipping, "
-                     "run with '-d' for full traceback)",
-                     testmod_path, ex)
+            log.warn("could not load doctests file '%s': %s (skipping, "
+                     "run with '-d' for full traceback)", path, ex)
             if log.isEnabledFor(logging.DEBUG):
                 traceback.print_exc()
-        else:
-            yield testmod
+            continue
+        for index in range(len(blocks.blocks)):
+            yield DocTestsTest(ns, testmod, blocks, index)
+
+def _docstring_tests_from_testmod(ns, testmod, testsuite_class=None):
+    """Generate a `DocTestsTest` for each example block in the docstring
+    of the given test module.
+    """
+    if not testmod.__doc__:
+        return
+    try:
+        blocks = _DocTestBlocks(testmod.__name__, testmod.__file__,
+                                testmod.__doc__, testmod.__dict__.copy())
+    except ValueError:
+        _, ex, _ = sys.exc_info()
+        log.warn("could not parse doctests in '%s' docstring: %s "
+                 "(skipping)", testmod.__file__, ex)
+        return
+    for index in range(len(blocks.blocks)):
+        yield DocTestsTest(ns, testmod, blocks, index, "docstring",
+                           testsuite_class)
+
+
+def _scan_testdir(testdir):
+    """Scan the given dir for test modules and doctests files.
+
+    Returns a 4-tuple: (<test module paths>, <test package paths>,
+    <doctests file paths>, <other subdir paths>), each sorted.
+    """
+    testmod_paths = []
+    testpkg_paths = []
+    doctests_paths = []
+    subdir_paths = []
+    for entry in os.scandir(testdir):
+        name = entry.name
+        if entry.is_dir():
+            if name.startswith("test_") \
+               and isfile(join(entry.path, "__init__.py")):
+                testpkg_paths.append(entry.path)
+            else:
+                subdir_paths.append(entry.path)
+        elif name.startswith("test_") and name.endswith(".py"):
+            testmod_paths.append(entry.path)
+        elif name.endswith(".doctests"):
+            doctests_paths.append(entry.path)
+    testmod_paths.sort()
+    testpkg_paths.sort()
+    doctests_paths.sort()
+    subdir_paths.sort()
+    return testmod_paths, testpkg_paths, doctests_paths, subdir_paths
+
+def testmod_paths_from_testdir(testdir):
+    """Generate test module paths in the given dir."""
+    testmod_paths, testpkg_paths, _, _ = _scan_testdir(testdir)
+    for path in testmod_paths:
+        yield path
+    for path in testpkg_paths:
+        yield path
+
+def _regex_from_globs(globs):
+    """Return a compiled regex matching any of the given glob patterns,
+    or None if there are none.
+    """
+    if not globs:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(g)
+                               for g in globs))
+
+def recursive_testdir_from_ns(testdir_from_ns, includes=None, excludes=None):
+    """Return a test manifest including sub-namespaces for all test dirs
+    under the dirs in the given manifest.
+
+    Each subdir (at any depth) that contains tests becomes a test
+    dir in the returned manifest. Its namespace is the parent namespace
+    plus the relative path of the subdir, e.g. with:
+        {"foo": "test"}
+    and test modules in "test/unit/parser" this returns:
+        {"foo": "test", "foo/unit/parser": "test/unit/parser"}
+
+    "includes" (optional) is a list of glob patterns for subdirs (relative
+        to the top test dir, using '/' as separator) to include. By default
+        all subdirs with test modules are included.
+    "excludes" (optional) is a list of glob patterns for subdirs to skip
+        (including their subdirs). A pattern is matched against both the
+        relative path and the base name of a subdir, e.g. "fixtures"
+        excludes any "fixtures" dir. Hidden dirs and "__pycache__" dirs are
+        always skipped.
+
+    Symlinked subdirs are followed, but each dir is only walked once (so
+    that a symlink to a parent dir doesn't loop).
+    """
+    include_re = _regex_from_globs(includes)
+    exclude_re = _regex_from_globs(excludes)
+    recursive_testdir_from_ns = {}
+    for ns, testdir in testdir_from_ns.items():
+        recursive_testdir_from_ns[ns] = testdir
+        # Iterative walk, each dir is only listed once.
+        todo = [(testdir, None)]
+        seen = set()    # (<st_dev>, <st_ino>) of walked dirs
+        while todo:
+            dir, relpath = todo.pop()
+            try:
+                st = os.stat(dir)
+            except EnvironmentError:
+                continue    # e.g. a dangling symlink
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            testmod_paths, testpkg_paths, doctests_paths, subdir_paths \
+                = _scan_testdir(dir)
+            if relpath is not None \
+               and (testmod_paths or testpkg_paths or doctests_paths) \
+               and (include_re is None or include_re.match(relpath)):
+                sub_ns = ns and "%s/%s" % (ns, relpath) or relpath
+                recursive_testdir_from_ns[sub_ns] = dir
+            for subdir_path in reversed(subdir_paths):
+                name = basename(subdir_path)
+                if name.startswith('.') or name == "__pycache__":
+                    continue
+                sub_relpath = relpath and "%s/%s" % (relpath, name) or name
+                if exclude_re is not None and (exclude_re.match(name)
+                        or exclude_re.match(sub_relpath)):
+                    continue
+                todo.append((subdir_path, sub_relpath))
+    return recursive_testdir_from_ns
+
+def _import_name_from_testmod_name(ns, testmod_name):
+    """Return the name under which to import the given test module.
+
+    Test modules in the default (empty) namespace keep their name, so they
+    can import each other. Those in other namespaces get a name unique to
+    the namespace so that, e.g., "test_basic.py" can be in many test dirs.
+    """
+    if not ns:
+        return testmod_name
+    return "_testlib_%s__%s" % (re.sub(r'\W', '_', ns), testmod_name)
+
+# Imported test modules, (<ns>, <path>) -> <module>, to reuse between
+# test runs in the same process. This is None (no caching) except in
+# "--watch" mode.
+_testmod_cache = None
+
+def _import_testmod(ns, testmod_path):
+    """Import and return the test module at the given (absolute) path.
+
+    This is a test module file or a test package dir.
+    """
+    if _testmod_cache is not None and (ns, testmod_path) in _testmod_cache:
+        return _testmod_cache[(ns, testmod_path)]
+    testmod_name = splitext(basename(testmod_path))[0]
+    import_name = _import_name_from_testmod_name(ns, testmod_name)
+    if isdir(testmod_path):
+        spec = importlib.util.spec_from_file_location(import_name,
+            join(testmod_path, "__init__.py"),
+            submodule_search_locations=[testmod_path])
+    else:
+        spec = importlib.util.spec_from_file_location(import_name,
+                                                      testmod_path)
+    testmod = importlib.util.module_from_spec(spec)
+    testmod._testlib_name_ = testmod_name
+    testmod._testlib_path_ = testmod_path
+    sys.modules[import_name] = testmod
+    try:
+        spec.loader.exec_module(testmod)
+    except:
+        del sys.modules[import_name]
+        raise
+    if _testmod_cache is not None:
+        _testmod_cache[(ns, testmod_path)] = testmod
+    return testmod
+
+def testmods_from_testdir(testdir, ns=None, import_time_from_path=None):
+    """Generate test modules in the given test dir.
+    
+    Modules are imported with 'testdir' first on sys.path and as the
+    current dir. Modules in namespace "ns" are imported with a name
+    unique to that namespace.
+
+    If "import_time_from_path" is given, the time taken to import each
+    test module is stored in it.
+
+    All test modules in the dir are imported before the first is
+    generated, so that sys.path and the current dir are only changed once
+    (and not while the caller handles a test module). A test module that
+    raises TestSkipped or fails to import is skipped with a warning.
+    """
+    testdir = normpath(testdir)
+    testabsdir = abspath(testdir)
+    testmod_paths = [abspath(p) for p in testmod_paths_from_testdir(testdir)]
+    testmods = []
+    sys.path.insert(0, testabsdir)
+    old_dir = os.getcwd()
+    os.chdir(testdir)
+    try:
+        for testmod_path in testmod_paths:
+            log.debug("import test module '%s'", testmod_path)
+            start_time = time.time()
+            try:
+                testmods.append(_import_testmod(ns, testmod_path))
+            except TestSkipped:
+                _, ex, _ = sys.exc_info()
+                log.warn("'%s' module skipped: %s",
+                         splitext(basename(testmod_path))[0], ex)
+            except Exception:
+                _, ex, _ = sys.exc_info()
+                log.warn("could not import test module '%s': %s (skipping, "
+                         "run with '-d' for full traceback)",
+                         testmod_path, ex)
+                if log.isEnabledFor(logging.DEBUG):
+                    traceback.print_exc()
+            if import_time_from_path is not None:
+                import_time_from_path[testmod_path] \
+                    = time.time() - start_time
+    finally:
+        os.chdir(old_dir)
+        sys.path.remove(testabsdir)
+    for testmod in testmods:
+        yield testmod
 
 def testcases_from_testmod(testmod):
     """Gather tests from a 'test_*' module.
@@ -315,7 +1631,7 @@ def testcases_from_testmod(testmod):
                     yield testcase
 
 
-def tests_from_manifest(testdir_from_ns):
+def tests_from_manifest(testdir_from_ns, import_time_from_path=None):
     """Return a list of `testlib.Test` instances for each test found in
     the manifest.
     
@@ -324,13 +1640,21 @@ def tests_from_manifest(testdir_from_ns):
     (b) each TestCase-subclass in
     (c) each "test_*" Python module in
     (d) each test dir in the manifest.
+
+    There will also be a test for each block of doctest examples in each
+    "*.doctests" file in each test dir and in the docstring of each
+    "test_*" module that sets `__doctests__ = True` (see `DocTestsTest`).
     
     If a "test_*" module has a top-level "test_suite_class", it will later
     be used to group all test cases from that module into an instance of that
     TestSuite subclass. This allows for overriding of test running behaviour.
+
+    If "import_time_from_path" is given, the time taken to import each
+    test module is stored in it.
     """
     for ns, testdir in testdir_from_ns.items():
-        for testmod in testmods_from_testdir(testdir):
+        for testmod in testmods_from_testdir(testdir, ns,
+                                             import_time_from_path):
             if hasattr(testmod, "test_suite_class"):
                 testsuite_class = testmod.test_suite_class
                 if not issubclass(testsuite_class, unittest.TestSuite):
@@ -344,68 +1668,1161 @@ def tests_from_manifest(testdir_from_ns):
                 testsuite_class = None
             for testcase in testcases_from_testmod(testmod):
                 try:
-                    yield Test(ns, testmod, testcase,
-                               testcase._testMethodName,
-                               testsuite_class)
+                    testfn_name = testcase._testMethodName
                 except AttributeError:
                     # Python 2.4 and older:
-                    yield Test(ns, testmod, testcase,
-                               testcase._TestCase__testMethodName,
+                    testfn_name = testcase._TestCase__testMethodName
+                testfn = getattr(testcase.__class__, testfn_name, None)
+                if hasattr(testfn, "_testlib_params_"):
+                    # Only the (small) Param data for each case is loaded
+                    # here. See `ParamTest`.
+                    try:
+                        params = list(_params_from_cases(
+                            testfn._testlib_params_,
+                            testfn._testlib_params_func_))
+                    except Exception:
+                        _, ex, _ = sys.exc_info()
+                        log.warn("error loading test cases for '%s.%s' in "
+                                 "'%s': %s (skipping, run with '-d' for "
+                                 "full traceback)",
+                                 testcase.__class__.__name__, testfn_name,
+                                 testmod.__file__, ex)
+                        if log.isEnabledFor(logging.DEBUG):
+                            traceback.print_exc()
+                        continue
+                    for index, param in enumerate(params):
+                        yield ParamTest(ns, testmod, testcase.__class__,
+                                        testfn_name, index, param,
+                                        testsuite_class)
+                else:
+                    yield Test(ns, testmod, testcase, testfn_name,
                                testsuite_class)
+            if getattr(testmod, "__doctests__", False):
+                for test in _docstring_tests_from_testmod(ns, testmod,
+                                                          testsuite_class):
+                    yield test
+        for test in doctests_tests_from_testdir(testdir, ns):
+            yield test
 
-def tests_from_manifest_and_tags(testdir_from_ns, tags):
-    include_tags = [tag.lower() for tag in tags if not tag.startswith('-')]
-    exclude_tags = [tag[1:].lower() for tag in tags if tag.startswith('-')]
+class TagExpr(object):
+    """A tag selection expression compiled to a predicate on tag sets.
 
-    for test in tests_from_manifest(testdir_from_ns):
-        test_tags = [t.lower() for t in test.tags()]
+    The expression is given as a list of tags/tokens (e.g. from the command
+    line) which are joined into one expression. The syntax is:
+    - "foo": matches tests with the "foo" tag (case-insensitive);
+    - "foo*", "f?o": glob patterns matching if any tag matches;
+    - "re:<regex>": a regular expression matching if it is found in any
+      tag (case-insensitive). The regex ends at whitespace or at a ')'
+      that closes a group of the expression, e.g. "(re:^(win|mac) or x)";
+    - "tag:<tag>": matches tests with exactly that tag, e.g. to select
+      tags named like an operator ("tag:and", "tag:not") or starting
+      with '-' or "re:";
+    - "-<expr>", "not <expr>": negation;
+    - "<expr> and <expr>" or just "<expr> <expr>": conjunction;
+    - "<expr> or <expr>": disjunction;
+    - parentheses for grouping.
 
-        matching_exclude_tags = [t for t in exclude_tags if t in test_tags]
-        if matching_exclude_tags:
-            #log.debug("test '%s' matches exclude tag(s) '%s': skipping",
-            #          test.shortname(), "', '".join(matching_exclude_tags))
-            continue
+        >>> expr = TagExpr(["python and (cpln or -slow)"])
+        >>> expr.matches(frozenset(["python", "slow"]))
+        False
+        >>> expr.matches(frozenset(["python", "slow", "cpln"]))
+        True
+        >>> TagExpr(["perf*", "-", "re:^win"]).matches(frozenset(["perf2"]))
+        True
+        >>> TagExpr([]).matches(frozenset())
+        True
+    """
+    _token_re = re.compile(r'\s+|[()]|-?re:|[^\s()]+')
+
+    def __init__(self, tags):
+        self.tags = list(tags)
+        self._tokens = self._tokenize(' '.join(self.tags))
+        self._pos = 0
+        if not self._tokens:
+            ast = ("true",)
+        else:
+            ast = self._parse_or()
+            if self._pos < len(self._tokens):
+                self._error("unexpected '%s'" % self._tokens[self._pos])
+        del self._tokens
+        self.matches = self._compile(ast)
+
+    def __repr__(self):
+        return "<TagExpr %r>" % ' '.join(self.tags)
+
+    def _tokenize(self, s):
+        tokens = []
+        pos = 0
+        while pos < len(s):
+            token = self._token_re.match(s, pos).group(0)
+            if token in ("re:", "-re:"):
+                end = self._regex_end(s, pos + len(token))
+                token = s[pos:end]
+            if not token.isspace():
+                tokens.append(token)
+            pos += len(token)
+        return tokens
+
+    def _regex_end(self, s, pos):
+        """Return the end of the regex starting at the given position: the
+        next whitespace or unbalanced ')' (not escaped or in a character
+        class).
+        """
+        depth = 0
+        in_class = False
+        while pos < len(s):
+            ch = s[pos]
+            if ch == '\\':
+                pos += 1
+            elif in_class:
+                if ch == ']':
+                    in_class = False
+            elif ch == '[':
+                in_class = True
+                if s.startswith(']', pos + 1):
+                    pos += 1    # a literal ']' first in the class
+            elif ch == '(':
+                depth += 1
+            elif ch == ')':
+                if not depth:
+                    break
+                depth -= 1
+            elif ch.isspace():
+                break
+            pos += 1
+        return min(pos, len(s))
 
-        if not include_tags:
+    def _error(self, msg):
+        raise TestError("invalid tag expression, %s: %r"
+                        % (msg, ' '.join(self.tags)))
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            self._error("unexpected end")
+        self._pos += 1
+        return token
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._peek() is not None and self._peek().lower() == "or":
+            self._next()
+            operands.append(self._parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return ("or", operands)
+
+    def _parse_and(self):
+        operands = [self._parse_not()]
+        while True:
+            token = self._peek()
+            if token is None or token == ')' or token.lower() == "or":
+                break
+            if token.lower() == "and":
+                self._next()
+            operands.append(self._parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        return ("and", operands)
+
+    def _parse_not(self):
+        token = self._next()
+        if token == '-' or token.lower() == "not":
+            return ("not", self._parse_not())
+        elif token == '(':
+            ast = self._parse_or()
+            if self._next() != ')':
+                self._error("expected ')'")
+            return ast
+        elif token == ')' or token.lower() in ("and", "or"):
+            self._error("unexpected '%s'" % token)
+        elif token.startswith('-'):
+            return ("not", self._atom(token[1:]))
+        return self._atom(token)
+
+    def _atom(self, token):
+        if token.startswith("tag:"):
+            return ("tag", token[4:].lower())
+        elif token.startswith("re:"):
+            try:
+                return ("match", re.compile(token[3:], re.I).search)
+            except re.error:
+                _, ex, _ = sys.exc_info()
+                self._error("bad regex '%s' (%s)" % (token[3:], ex))
+        elif '*' in token or '?' in token:
+            glob_re = re.compile(fnmatch.translate(token.lower()))
+            return ("match", glob_re.match)
+        return ("tag", token.lower())
+
+    def _compile(self, ast):
+        kind = ast[0]
+        if kind == "true":
+            return lambda tag_set: True
+        elif kind == "tag":
+            tag = ast[1]
+            return lambda tag_set: tag in tag_set
+        elif kind == "match":
+            # Results are cached per distinct tag: the set of all tags is
+            # typically much smaller than the number of tests.
+            match = ast[1]
+            match_from_tag = {}
+            def matches_any(tag_set):
+                for tag in tag_set:
+                    try:
+                        m = match_from_tag[tag]
+                    except KeyError:
+                        m = match_from_tag[tag] = match(tag) is not None
+                    if m:
+                        return True
+                return False
+            return matches_any
+        elif kind == "not":
+            operand = self._compile(ast[1])
+            return lambda tag_set: not operand(tag_set)
+        elif kind == "and":
+            # Plain tags and negated plain tags are checked with single set
+            # operations, as for the common "foo bar -baz" selections.
+            includes = frozenset(a[1] for a in ast[1] if a[0] == "tag")
+            excludes = frozenset(a[1][1] for a in ast[1]
+                                 if a[0] == "not" and a[1][0] == "tag")
+            others = tuple(self._compile(a) for a in ast[1]
+                           if a[0] != "tag" and
+                              not (a[0] == "not" and a[1][0] == "tag"))
+            def matches_all(tag_set):
+                if not includes <= tag_set or not excludes.isdisjoint(tag_set):
+                    return False
+                for operand in others:
+                    if not operand(tag_set):
+                        return False
+                return True
+            return matches_all
+        elif kind == "or":
+            operands = tuple(self._compile(a) for a in ast[1])
+            def matches_one(tag_set):
+                for operand in operands:
+                    if operand(tag_set):
+                        return True
+                return False
+            return matches_one
+        raise TestError("unexpected tag expression node: %r" % (ast,))
+
+def tests_from_manifest_and_tags(testdir_from_ns, tags,
+                                 import_time_from_path=None):
+    """Generate the tests in the manifest matching the given tags.
+
+    "tags" is a list of tags (see `TagExpr` for the syntax) or a
+    `TagExpr` instance.
+    """
+    if not isinstance(tags, TagExpr):
+        tags = TagExpr(tags)
+    matches = tags.matches
+    for test in tests_from_manifest(testdir_from_ns, import_time_from_path):
+        if matches(test.tag_set()):
             yield test
+
+
+class FixtureManager(object):
+    """Builds fixtures lazily and tears them down after their last user.
+
+    A fixture instance is identified by the fixture and a scope key
+    (None for "session" scope, the namespace for "namespace" scope and
+    the (namespace, module name) for "module" scope). The number of
+    selected tests declaring the use of each instance is counted up front
+    so that an instance can be torn down as soon as the last of them has
+    run.
+    """
+    def __init__(self, tests):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._users = {}     # <instance key> -> <num tests still to run>
+        self._values = {}    # <instance key> -> (<value>, <teardown gen>)
+        self._order = []     # instance keys in build order
+        for test in tests:
+            for name in test.fixture_names():
+                ikey = self._instance_key(name, test.scope(),
+                                          test.testmod.__name__)
+                if ikey is None:
+                    log.warn("test '%s' uses unknown fixture '%s'%s",
+                             test.shortname(), name,
+                             name in _fixtures_from_name
+                             and " (defined in more than one other module)"
+                             or "")
+                    continue
+                self._users[ikey] = self._users.get(ikey, 0) + 1
+
+    def _instance_key(self, name, scope, module_name):
+        fix = _find_fixture(name, module_name)
+        if fix is None:
+            return None
+        ns, testmod_name = scope
+        if fix.scope == "module":
+            return (fix, (ns, testmod_name))
+        elif fix.scope == "namespace":
+            return (fix, ns)
+        else:
+            return (fix, None)
+
+    def start_test(self, testcase):
+        """Note the running test (for the current thread)."""
+        self._local.testcase = testcase
+
+    def stop_test(self, testcase, release=True):
+        """Tear down fixture instances of which this was the last user.
+
+        If "release" is false the test is not counted as having run (e.g.
+        because it will be rerun): its fixtures are kept.
+        """
+        self._local.testcase = None
+        if not release:
+            return
+        for name in getattr(testcase, "_testlib_fixtures_", ()):
+            ikey = self._instance_key(name, testcase._testlib_scope_,
+                                      testcase._testlib_module_)
+            with self._lock:
+                if ikey not in self._users:
+                    continue
+                self._users[ikey] -= 1
+                if self._users[ikey] <= 0:
+                    del self._users[ikey]
+                    self._teardown(ikey)
+
+    def get(self, name):
+        testcase = getattr(self._local, "testcase", None)
+        if testcase is None:
+            raise TestError("cannot get fixture %r: no running test" % name)
+        ikey = self._instance_key(name, testcase._testlib_scope_,
+                                  testcase._testlib_module_)
+        if ikey is None:
+            raise TestError("unknown fixture: %r" % name)
+        with self._lock:
+            if ikey not in self._values:
+                log.debug("build fixture '%s' (scope key %r)", *ikey)
+                value = ikey[0].func()
+                gen = None
+                if isinstance(value, types.GeneratorType):
+                    gen = value
+                    value = next(gen)
+                self._values[ikey] = (value, gen)
+                self._order.append(ikey)
+            return self._values[ikey][0]
+
+    def _teardown(self, ikey):
+        if ikey not in self._values:
+            return  # never built
+        log.debug("tear down fixture '%s' (scope key %r)", *ikey)
+        value, gen = self._values.pop(ikey)
+        self._order.remove(ikey)
+        if gen is None:
+            return
+        try:
+            next(gen)
+        except StopIteration:
+            pass
+        except Exception:
+            _, ex, _ = sys.exc_info()
+            log.warn("error tearing down fixture '%s': %s (run with '-d' "
+                     "for full traceback)", ikey[0], ex)
+            if log.isEnabledFor(logging.DEBUG):
+                traceback.print_exc()
+        else:
+            log.warn("fixture '%s' yielded more than once", ikey[0])
+
+    def teardown_all(self):
+        """Tear down all remaining fixture instances."""
+        with self._lock:
+            for ikey in reversed(self._order[:]):
+                self._teardown(ikey)
+            self._users = {}
+
+class TestHistory(object):
+    """Per-test data recorded by earlier test runs.
+
+    This is stored as JSON in the given file and holds, for each test (by
+    shortname), the duration of its last run, the number of runs in which
+    it was run ("runs"), failed ("failures") or failed and then passed on
+    a rerun ("flaky", see "--rerun-failures"), and the time of its last
+    run ("last_run") and last failing (or flaky) run ("last_failure").
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data_from_shortname = {}
+        if exists(path):
+            try:
+                f = open(path)
+                try:
+                    self.data_from_shortname = json.load(f)["tests"]
+                finally:
+                    f.close()
+            except (ValueError, KeyError, EnvironmentError):
+                _, ex, _ = sys.exc_info()
+                log.warn("could not load test history from '%s': %s "
+                         "(ignoring)", path, ex)
+
+    def duration(self, shortname):
+        """Return the last recorded duration of the test, or None."""
+        data = self.data_from_shortname.get(shortname)
+        return data and data.get("duration")
+
+    def get(self, shortname, key, default=None):
+        """Return the recorded value of the given key for the test."""
+        return self.data_from_shortname.get(shortname, {}).get(key, default)
+
+    def update(self, result):
+        """Update the history with the results of a test run."""
+        failed = set()
+        for errors in (result.errors, result.failures):
+            for test, err in errors:
+                if _is_subtest(test):
+                    test = test.test_case
+                failed.add(getattr(test, "_testlib_shortname_", None))
+        reruns = getattr(result, "reruns", {})
+        now = int(time.time())
+        for shortname, duration in result.durations.items():
+            data = self.data_from_shortname.setdefault(shortname, {})
+            data["duration"] = round(duration, 6)
+            data["runs"] = data.get("runs", 0) + 1
+            data["last_run"] = now
+            if shortname in failed:
+                data["failures"] = data.get("failures", 0) + 1
+                data["last_failure"] = now
+            elif reruns.get(shortname):
+                data["flaky"] = data.get("flaky", 0) + 1
+                data["last_failure"] = now
+
+    def save(self):
+        # Write to a temp file and rename to not leave a partial file for
+        # concurrent test runs.
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        f = open(tmp_path, 'w')
+        try:
+            json.dump({"tests": self.data_from_shortname}, f,
+                      separators=(',', ':'))
+        finally:
+            f.close()
+        if sys.platform == "win32" and exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+
+def ordered_tests(tests, order="module", history=None):
+    """Return the given tests ordered for running.
+
+    The tests of each test module, and within that of each TestCase class,
+    are made adjacent. This ensures that module and class fixtures
+    (setUpModule, setUpClass, etc.) are only run once per test run (or
+    per phase, see "--isolate-timing"), even if tag filtering or a
+    "test_cases()" hook yields tests in some interleaved order.
+
+    "order" is one of:
+        "module"    Modules and classes are in order of first appearance.
+        "cost"      Modules and classes are ordered by expected cost
+                    (cheapest first). The cost of a test is its last
+                    duration in the given "history", or the mean of
+                    known durations if it has none.
+    """
+    if order not in ("module", "cost"):
+        raise TestError("invalid test order: %r (must be 'module' or "
+                        "'cost')" % order)
+
+    # {<testmod>: {<testcase class>: [<test>, ...]}}, each level kept in
+    # order of first appearance.
+    modules = []
+    classes_from_testmod = {}
+    tests_from_class_from_testmod = {}
+    for test in tests:
+        testmod = test.testmod
+        if testmod not in tests_from_class_from_testmod:
+            modules.append(testmod)
+            classes_from_testmod[testmod] = []
+            tests_from_class_from_testmod[testmod] = {}
+        tests_from_class = tests_from_class_from_testmod[testmod]
+        testcase_class = test.testcase_class
+        if testcase_class not in tests_from_class:
+            classes_from_testmod[testmod].append(testcase_class)
+            tests_from_class[testcase_class] = []
+        tests_from_class[testcase_class].append(test)
+
+    if order == "cost":
+        known = {}
+        if history is not None:
+            for test in tests:
+                duration = history.duration(test.shortname())
+                if duration is not None:
+                    known[test] = duration
+        default_cost = known and sum(known.values()) / len(known) or 0.0
+        def class_cost(testmod, testcase_class):
+            return sum(known.get(t, default_cost) for t in
+                       tests_from_class_from_testmod[testmod][testcase_class])
+        def module_cost(testmod):
+            return sum(class_cost(testmod, c)
+                       for c in classes_from_testmod[testmod])
+        # Note: sort() is stable, ties keep discovery order.
+        modules.sort(key=module_cost)
+        for testmod in modules:
+            classes_from_testmod[testmod].sort(
+                key=lambda c: class_cost(testmod, c))
+
+    ordered = []
+    for testmod in modules:
+        tests_from_class = tests_from_class_from_testmod[testmod]
+        for testcase_class in classes_from_testmod[testmod]:
+            ordered += tests_from_class[testcase_class]
+    return ordered
+
+def budgeted_tests(tests, budget, history):
+    """Choose the most useful of the given tests that fit in a time budget.
+
+    "budget" is a number of seconds. The cost of a test is its last
+    duration in the given TestHistory, or the mean of known durations if
+    it has none. The tests are chosen by value per cost (cheap tests
+    first) until the budget is used up. A test's value is:
+    - 1,
+    - plus up to 10 if it failed (or was flaky) recently (halving for
+      each day since),
+    - plus 5 if its test module changed since it was last run (or it
+      never ran),
+    - doubled for the cheapest test of each test module, to spread a tight
+      budget over all modules.
+
+    Returns a 2-tuple of the chosen tests and the left out ones (each in
+    the given order).
+    """
+    cost_from_test = _test_costs(tests, history)
+    now = time.time()
+    mtime_from_path = {}
+
+    value_from_test = {}
+    cheapest_from_testmod = {}
+    for test in tests:
+        shortname = test.shortname()
+        value = 1.0
+        last_failure = history.get(shortname, "last_failure")
+        if last_failure is not None:
+            age_days = max(now - last_failure, 0) / (24 * 60 * 60)
+            value += 10 * 0.5 ** age_days
+        last_run = history.get(shortname, "last_run")
+        path = getattr(test.testmod, "_testlib_path_", None)
+        if path is not None and path not in mtime_from_path:
+            try:
+                mtime_from_path[path] = os.stat(path).st_mtime
+            except EnvironmentError:
+                mtime_from_path[path] = None
+        mtime = mtime_from_path.get(path)
+        if last_run is None or (mtime is not None and mtime > last_run):
+            value += 5
+        value_from_test[test] = value
+        cheapest = cheapest_from_testmod.get(test.testmod)
+        if cheapest is None \
+           or cost_from_test[test] < cost_from_test[cheapest]:
+            cheapest_from_testmod[test.testmod] = test
+    for test in cheapest_from_testmod.values():
+        value_from_test[test] *= 2
+
+    def usefulness(test):
+        cost = cost_from_test[test]
+        if cost <= 0:
+            return float("inf")
+        return value_from_test[test] / cost
+    chosen = set()
+    total = 0.0
+    # Note: sort() is stable, ties keep the given order.
+    for test in sorted(tests, key=usefulness, reverse=True):
+        cost = cost_from_test[test]
+        if total + cost <= budget:
+            chosen.add(test)
+            total += cost
+    return ([t for t in tests if t in chosen],
+            [t for t in tests if t not in chosen])
+
+def _test_costs(tests, history):
+    """Return the expected duration of each of the given tests: its last
+    duration in the given TestHistory, else the mean of known durations.
+    """
+    known = {}
+    for test in tests:
+        duration = history.duration(test.shortname())
+        if duration is not None:
+            known[test] = duration
+    default_cost = known and sum(known.values()) / len(known) or 0.0
+    return dict((t, known.get(t, default_cost)) for t in tests)
+
+def test(testdir_from_ns, tags=[], setup_func=None, num_threads=None,
+         order="module", history_path=None, import_times=False,
+         testmod_paths=None, maxfail=None, rerun_failures=0,
+         leak_check=None, progress=False, budget=None, coverage=False,
+         coverage_path=None, covering=None, isolate_timing=False,
+         update_golden=False):
+    """Run the tests in the given manifest matching the given tags.
+
+    Returns the ConsoleTestResult, or None if no tests were run.
+
+    "testmod_paths" (optional) is a collection of test module (or doctests
+        file) paths to which to further limit the tests run.
+    "covering" (optional) is a list of source file paths to which to
+        further limit the tests run: only tests that executed any of their
+        lines in an earlier "--coverage" run (as recorded in the coverage
+        map at "coverage_path") and tests not in that map are run.
+    See `harness()` and `_parse_opts()` for the other arguments.
+    """
+    log.debug("test(testdir_from_ns=%r, tags=%r, ...)",
+              testdir_from_ns, tags)
+    if covering and coverage_path is None:
+        raise TestError("cannot select tests covering the given files: "
+                        "no coverage map path ('coverage_path') given")
+    if setup_func is not None:
+        setup_func()
+    import_time_from_path = {} if import_times else None
+    tests = list(tests_from_manifest_and_tags(testdir_from_ns, tags,
+                                              import_time_from_path))
+    if testmod_paths is not None:
+        tests = [t for t in tests
+                 if getattr(t.testmod, "_testlib_path_", None)
+                    in testmod_paths]
+    if covering:
+        coverage_map = CoverageMap(coverage_path)
+        covering_shortnames = coverage_map.tests_covering(covering)
+        tests = [t for t in tests
+                 if t.shortname() in covering_shortnames
+                    or t.shortname() not in coverage_map.lines_from_shortname]
+    result = run_tests(tests, num_threads=num_threads, order=order,
+                       history_path=history_path, maxfail=maxfail,
+                       rerun_failures=rerun_failures, leak_check=leak_check,
+                       progress=progress, budget=budget, coverage=coverage,
+                       coverage_path=coverage_path,
+                       isolate_timing=isolate_timing,
+                       update_golden=update_golden)
+    if import_time_from_path is not None:
+        _print_import_times(import_time_from_path, sys.stdout)
+    return result
+
+def run_tests(tests, num_threads=None, order="module", history_path=None,
+              maxfail=None, rerun_failures=0, leak_check=None,
+              progress=False, budget=None, coverage=False,
+              coverage_path=None, isolate_timing=False,
+              update_golden=False):
+    """Run the given tests (a list of `Test` instances).
+
+    Returns the ConsoleTestResult, or None if there are no tests.
+    See `harness()` and `_parse_opts()` for the other arguments.
+    """
+    if not tests:
+        return None
+    history = None
+    if history_path:
+        history = TestHistory(history_path)
+    if budget is not None:
+        if history is None:
+            log.warn("no test history to choose tests for a %gs budget: "
+                     "running all tests", budget)
         else:
-            for tag in include_tags:
-                if tag not in test_tags:
-                    #log.debug("test '%s' does not match tag '%s': skipping",
-                    #          test.shortname(), tag)
+            tests = _report_budgeted_tests(tests, budget, history)
+            if not tests:
+                return None
+    tests = ordered_tests(tests, order, history)
+    for hook in _plugin_hooks.discovered:
+        hook(tests)
+    if not tests:
+        return None
+
+    timing_tests = []
+    if isolate_timing:
+        # Timing-sensitive tests are run last, in a phase of their own.
+        # (Only explicit tags count: not e.g. a "test_timing.py" module.)
+        other_tests = []
+        for test in tests:
+            if TIMING_TAG in (t.lower() for t in test.explicit_tags()):
+                timing_tests.append(test)
+            else:
+                other_tests.append(test)
+        tests = other_tests
+    suite = _suite_from_tests(tests, num_threads)
+    cpus = timing_cpu = None
+    if isolate_timing:
+        # The CPU is reserved even without timing tests in this run: the
+        # timing phase of a concurrent run (e.g. of a test suite split over
+        # a number of harness processes) may be using it.
+        cpus, timing_cpu = _timing_cpus()
+    if timing_tests:
+        suite.addTest(_TimingPhaseSuite([_suite_from_tests(timing_tests)],
+                                        cpu=timing_cpu))
+        tests += timing_tests
+    
+    global _fixture_manager, _update_golden
+    # Restored after the run, e.g. for a run from within a test.
+    old_state = (_fixture_manager, _update_golden)
+    _fixture_manager = FixtureManager(tests)
+    _update_golden = update_golden
+    if cpus is not None:
+        # Keep the other tests (and their worker threads) off the CPU
+        # reserved for timing phases.
+        os.sched_setaffinity(0, cpus - set([timing_cpu]))
+    try:
+        stream = sys.stdout
+        if progress:
+            stream = ProgressReporter(stream, tests, history)
+        collector = None
+        if coverage and coverage_path:
+            collector = CoverageCollector()
+        runner = ConsoleTestRunner(stream, fixtures=_fixture_manager,
+                                   maxfail=maxfail,
+                                   rerun_failures=rerun_failures,
+                                   leak_check=leak_check,
+                                   coverage=collector)
+        result = runner.run(suite)
+    finally:
+        _fixture_manager, _update_golden = old_state
+        if cpus is not None:
+            os.sched_setaffinity(0, cpus)
+    if collector is not None:
+        coverage_map = CoverageMap(coverage_path)
+        coverage_map.update(collector.lines_from_shortname)
+        try:
+            coverage_map.save()
+        except EnvironmentError:
+            _, ex, _ = sys.exc_info()
+            log.warn("could not save coverage map to '%s': %s",
+                     coverage_path, ex)
+    if history is not None:
+        history.update(result)
+        try:
+            history.save()
+        except EnvironmentError:
+            _, ex, _ = sys.exc_info()
+            log.warn("could not save test history to '%s': %s",
+                     history_path, ex)
+    return result
+
+def _suite_from_tests(tests, num_threads=None):
+    """Return a test suite of the given tests' test cases.
+
+    Groups test cases into a test suite class given by their test module's
+    "test_suite_class" hook, if any. Test cases of "concurrent" modules
+    are run in a thread pool if so requested, except for doctest blocks:
+    these share their globals and depend on earlier blocks, so they are
+    always run in order.
+    """
+    suite = unittest.TestSuite()
+    suite_for_testmod = None
+    key = None
+    for test in tests:
+        threaded = test.testsuite_class is None \
+            and num_threads and num_threads > 1 \
+            and "concurrent" in getattr(test.testmod, "__tags__", []) \
+            and not isinstance(test, DocTestsTest)
+        if (test.testmod, threaded) != key:
+            if suite_for_testmod is not None:
+                suite.addTest(suite_for_testmod)
+            if test.testsuite_class is not None:
+                suite_for_testmod = test.testsuite_class()
+            elif threaded:
+                suite_for_testmod = ThreadedTestSuite(num_threads=num_threads)
+            else:
+                suite_for_testmod = unittest.TestSuite()
+            key = (test.testmod, threaded)
+        suite_for_testmod.addTest(test.testcase)
+    if suite_for_testmod is not None:
+        suite.addTest(suite_for_testmod)
+    return suite
+
+def _print_import_times(import_time_from_path, stream):
+    items = sorted(import_time_from_path.items(),
+                   key=lambda item: item[1], reverse=True)
+    stream.write("\nTest module import times (slowest first):\n")
+    for path, import_time in items:
+        stream.write("  %8.3fs  %s\n" % (import_time, _relpath(path)))
+    stream.write("  %8.3fs  total\n" % sum(t for p, t in items))
+
+def _is_project_module(module):
+    """Return true if the given module is from the project being tested,
+    i.e. is not a test module, the main script, from the Python
+    installation or testlib.
+    """
+    path = getattr(module, "__file__", None)
+    if not path or hasattr(module, "_testlib_name_"):
+        return False
+    if path == __file__ or module.__name__ in (__name__, "__main__"):
+        return False
+    for prefix in _python_install_prefixes():
+        if path.startswith(prefix):
+            return False
+    return True
+
+_g_python_install_prefixes = None
+def _python_install_prefixes():
+    global _g_python_install_prefixes
+    if _g_python_install_prefixes is None:
+        import sysconfig
+        paths = sysconfig.get_paths()
+        prefixes = set([sys.prefix, sys.exec_prefix,
+                        getattr(sys, "base_prefix", sys.prefix)])
+        for key in ("stdlib", "platstdlib", "purelib", "platlib"):
+            if key in paths:
+                prefixes.add(paths[key])
+        _g_python_install_prefixes = tuple(
+            normpath(abspath(p)) + os.sep for p in prefixes)
+    return _g_python_install_prefixes
+
+def _watched_mtimes(testdir_from_ns):
+    """Return a dict of the mtimes of the watched files, and a dict of the
+    project modules for each of those files.
+
+    Watched are the test modules (and the files of test packages) and
+    doctests files in the test dirs and the source files of the loaded
+    project modules (see `_is_project_module()`).
+    """
+    mtime_from_path = {}
+    module_from_path = {}
+    def add(path):
+        try:
+            mtime_from_path[path] = os.stat(path).st_mtime
+        except EnvironmentError:
+            pass
+    for testdir in testdir_from_ns.values():
+        testmod_paths, testpkg_paths, doctests_paths, _ \
+            = _scan_testdir(testdir)
+        for path in testmod_paths + doctests_paths:
+            add(abspath(path))
+        for testpkg_path in testpkg_paths:
+            for dirpath, dirnames, filenames in os.walk(testpkg_path):
+                for filename in filenames:
+                    if filename.endswith(".py"):
+                        add(abspath(join(dirpath, filename)))
+    for module in list(sys.modules.values()):
+        if module is None or not _is_project_module(module):
+            continue
+        path = module.__file__
+        if path.endswith((".pyc", ".pyo")):
+            path = path[:-1]
+        module_from_path[path] = module
+        add(path)
+    return mtime_from_path, module_from_path
+
+def _testmod_path_from_path(path, testmod_paths):
+    """Return the test module path (a file, or a test package dir) that
+    the given watched path is part of, or None.
+    """
+    while path not in testmod_paths:
+        parent = dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return path
+
+def _changed_testmod_paths(changed_paths, testdir_from_ns):
+    """Return the set of test module paths (files, test package dirs and
+    doctests files) that the given changed paths are part of.
+
+    Only test modules and doctests files directly in the test dirs (and
+    those already imported) are candidates, so that a changed file in a
+    test package maps to the package dir rather than to itself.
+    """
+    candidates = set(p for ns, p in _testmod_cache or ())
+    for testdir in testdir_from_ns.values():
+        testmod_paths, testpkg_paths, doctests_paths, _ \
+            = _scan_testdir(testdir)
+        candidates.update(abspath(p) for p in
+                          testmod_paths + testpkg_paths + doctests_paths)
+    testmod_paths = set()
+    for path in changed_paths:
+        testmod_path = _testmod_path_from_path(path, candidates)
+        if testmod_path is not None:
+            testmod_paths.add(testmod_path)
+    return testmod_paths
+
+def watch(testdir_from_ns, tags=[], setup_func=None, interval=0.25,
+          **test_opts):
+    """Run the tests, then rerun them as files change until interrupted.
+
+    This polls the test dirs and the source files of loaded project
+    modules every "interval" seconds. On changes:
+    - changed project modules are reloaded, test modules are re-imported
+      and the whole tag selection is rerun;
+    - if only test modules (or doctests files) changed, just those are
+      re-imported and only their tests (in the selection) are rerun.
+    Unchanged test modules are not re-imported.
+
+    Other keyword arguments are passed on to `test()`. Returns the number
+    of failures and errors in the last test run.
+    """
+    global _testmod_cache
+    _testmod_cache = {}
+    if setup_func is not None:
+        setup_func()
+    result = test(testdir_from_ns, tags, **test_opts)
+    mtime_from_path, module_from_path = _watched_mtimes(testdir_from_ns)
+    sys.stdout.write("\n-- watching for changes (Ctrl+C to stop)\n")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(interval)
+            new_mtime_from_path, new_module_from_path \
+                = _watched_mtimes(testdir_from_ns)
+            changed_paths = set(
+                p for p, mtime in new_mtime_from_path.items()
+                if mtime_from_path.get(p) != mtime)
+            changed_paths.update(set(mtime_from_path)
+                                 - set(new_mtime_from_path))
+            mtime_from_path = new_mtime_from_path
+            if not changed_paths:
+                continue
+
+            # Reload changed project modules.
+            reloaded = False
+            for path in sorted(changed_paths):
+                module = module_from_path.get(path)
+                if module is None:
+                    continue
+                log.info("reload '%s'", module.__name__)
+                try:
+                    importlib.reload(module)
+                except Exception:
+                    _, ex, _ = sys.exc_info()
+                    log.error("could not reload '%s': %s",
+                              module.__name__, ex)
+                reloaded = True
+
+            # Forget changed test modules (or all of them if project
+            # modules were reloaded, as test modules reference them).
+            if reloaded:
+                _testmod_cache.clear()
+                testmod_paths = None
+            else:
+                testmod_paths = _changed_testmod_paths(changed_paths,
+                                                       testdir_from_ns)
+                for key in list(_testmod_cache):
+                    if key[1] in testmod_paths:
+                        del _testmod_cache[key]
+
+            sys.stdout.write("\n-- %s changed: %s\n" % (
+                time.strftime("%H:%M:%S"),
+                ', '.join(_relpath(p) for p in sorted(changed_paths))))
+            result = test(testdir_from_ns, tags,
+                          testmod_paths=testmod_paths, **test_opts)
+            mtime_from_path, module_from_path \
+                = _watched_mtimes(testdir_from_ns)
+            sys.stdout.write("\n-- watching for changes (Ctrl+C to stop)\n")
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _testmod_cache = None
+    if result is None:
+        return None
+    return result.failureCount()
+
+# A `serve()` child process sends its output to the client in frames:
+# a kind byte, the payload length (4 bytes, big-endian) and the payload.
+# Output frames (b"o") carry test output bytes, the last frame (b"x") the
+# exit value of the test run (as ASCII digits).
+_serve_frame_header = struct.Struct(">cI")
+
+def _serve_frame(kind, payload):
+    return _serve_frame_header.pack(kind, len(payload)) + payload
+
+def serve(testdir_from_ns, socket_path, setup_func=None, **run_opts):
+    """Serve test runs on the given Unix socket until interrupted.
+
+    The tests are gathered (and the test modules imported) once up front.
+    A client (see `connect()`) sends a line of JSON with the tags for a test
+    run: {"tags": [<tag>, ...]}. Each request is run in a forked child
+    process, so test runs don't affect each other or the server, and the
+    test output (in the usual ConsoleTestResult format) is streamed back
+    to the client. The socket is only accessible by the current user.
+
+    "setup_func" (optional) is called once, in the server process, before
+    gathering tests. Other keyword arguments are passed to `run_tests()`.
+    """
+    import socket
+    import signal
+    if not hasattr(os, "fork") or not hasattr(socket, "AF_UNIX"):
+        raise TestError("serving test runs is not supported on this "
+                        "platform (requires fork and Unix sockets)")
+    run_opts.pop("import_times", None)
+    run_opts.pop("covering", None)
+    global _testmod_cache
+    _testmod_cache = {}
+    if setup_func is not None:
+        setup_func()
+    start_time = time.time()
+    tests = list(tests_from_manifest(testdir_from_ns))
+    sys.stdout.write("-- gathered %d tests in %.3fs, serving test runs on "
+                     "'%s' (Ctrl+C to stop)\n"
+                     % (len(tests), time.time() - start_time, socket_path))
+    sys.stdout.flush()
+
+    # Only the request children are reaped: not e.g. subprocesses started
+    # by "setup_func", which it may still wait for.
+    child_pids = set()
+    def reap_children(signum=None, frame=None):
+        for pid in list(child_pids):
+            try:
+                if not os.waitpid(pid, os.WNOHANG)[0]:
+                    continue
+            except OSError:  # already reaped
+                pass
+            child_pids.discard(pid)
+
+    if exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Also stop cleanly (removing the socket) when terminated, and reap
+    # finished children as they exit.
+    old_sigterm_handler = signal.signal(signal.SIGTERM,
+                                        signal.default_int_handler)
+    old_sigchld_handler = signal.signal(signal.SIGCHLD, reap_children)
+    try:
+        old_umask = os.umask(0o177)
+        try:
+            listener.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(16)
+        while True:
+            conn, _ = listener.accept()
+            try:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, old_sigterm_handler)
+                    signal.signal(signal.SIGCHLD, old_sigchld_handler)
+                    listener.close()
+                    _serve_request(conn, tests, run_opts)  # never returns
+                child_pids.add(pid)
+                # In case it exited before it was added.
+                reap_children()
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, old_sigterm_handler)
+        signal.signal(signal.SIGCHLD, old_sigchld_handler)
+        listener.close()
+        if exists(socket_path):
+            os.remove(socket_path)
+        _testmod_cache = None
+
+def _forward_output(fd, conn):
+    """Send everything read from the given fd to the client as output
+    frames, until EOF.
+    """
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        conn.sendall(_serve_frame(b"o", data))
+    os.close(fd)
+
+def _serve_request(conn, tests, run_opts):
+    """Handle one test run request in a `serve()` child process."""
+    import io
+    retval = 1
+    forwarder = None
+    try:
+        request = b""
+        while not request.endswith(b"\n"):
+            data = conn.recv(4096)
+            if not data:
+                break
+            request += data
+
+        # Send all output, including that of the logging module and
+        # subprocesses, to the client via a pipe.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        forwarder = threading.Thread(target=_forward_output,
+                                     args=(read_fd, conn))
+        forwarder.daemon = True
+        forwarder.start()
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        sys.stdout = io.TextIOWrapper(io.FileIO(1, "w", closefd=False),
+                                      write_through=True)
+
+        tags = json.loads(request.decode("utf-8"))["tags"]
+        log.debug("serve test run: tags=%r", tags)
+        matches = TagExpr(tags).matches
+        result = run_tests([t for t in tests if matches(t.tag_set())],
+                           **run_opts)
+        if result is None:
+            retval = 0
+        else:
+            retval = result.failureCount()
+    except Exception:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if forwarder is not None:
+                # Close the pipe's write end (stdout and stderr) to end
+                # the forwarding.
+                null_fd = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(null_fd, 1)
+                os.dup2(null_fd, 2)
+                forwarder.join()
+            conn.sendall(_serve_frame(b"x", str(retval).encode("ascii")))
+        finally:
+            os._exit(0)
+
+def connect(socket_path, tags=[], stream=None):
+    """Run the tests matching the given tags on a `serve()` server.
+
+    The test output is written to the given stream (stdout by default).
+    Returns the number of failures and errors.
+    """
+    import socket
+    if stream is None:
+        stream = sys.stdout
+    if isinstance(tags, TagExpr):
+        tags = tags.tags
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    retval = None
+    try:
+        try:
+            conn.connect(socket_path)
+        except socket.error:
+            _, ex, _ = sys.exc_info()
+            raise TestError("could not connect to test server on '%s': %s "
+                            "(is it running?)" % (socket_path, ex))
+        conn.sendall(json.dumps({"tags": list(tags)}).encode("utf-8")
+                     + b"\n")
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        buf = b""
+        header_size = _serve_frame_header.size
+        while retval is None:
+            data = conn.recv(65536)
+            if not data:
+                break
+            buf += data
+            # Handle all complete frames in the buffer.
+            while len(buf) >= header_size:
+                kind, length = _serve_frame_header.unpack(
+                    buf[:header_size])
+                if len(buf) < header_size + length:
                     break
-            else:
-                #log.debug("test '%s' matches tags: %s", test.shortname(),
-                #          ' '.join(tags))
-                yield test
-                
-def test(testdir_from_ns, tags=[], setup_func=None):
-    log.debug("test(testdir_from_ns=%r, tags=%r, ...)",
-              testdir_from_ns, tags)
-    if setup_func is not None:
-        setup_func()
-    tests = list(tests_from_manifest_and_tags(testdir_from_ns, tags))
-    if not tests:
-        return None
-    
-    # Groups test cases into a test suite class given by their test module's
-    # "test_suite_class" hook, if any.
-    suite = unittest.TestSuite()
-    suite_for_testmod = None
-    testmod = None
-    for test in tests:
-        if test.testmod != testmod:
-            if suite_for_testmod is not None:
-                suite.addTest(suite_for_testmod)
-            suite_for_testmod = (test.testsuite_class or unittest.TestSuite)()
-            testmod = test.testmod
-        suite_for_testmod.addTest(test.testcase)
-    if suite_for_testmod is not None:
-        suite.addTest(suite_for_testmod)
-    
-    runner = ConsoleTestRunner(sys.stdout)
-    result = runner.run(suite)
-    return result
+                payload = buf[header_size:header_size + length]
+                buf = buf[header_size + length:]
+                if kind == b"o":
+                    stream.write(decoder.decode(payload))
+                elif kind == b"x":
+                    retval = int(payload.decode("ascii"))
+                    break
+            stream.flush()
+        stream.write(decoder.decode(b"", True))
+        stream.flush()
+    finally:
+        conn.close()
+    if retval is None:
+        raise TestError("test server on '%s' ended without an exit value"
+                        % socket_path)
+    return retval
 
 def list_tests(testdir_from_ns, tags):
     # Say I have two test_* modules:
@@ -451,7 +2868,7 @@ def list_tests(testdir_from_ns, tags):
                 testfile = testfile[:-1]
             print("%s:" % t.shortname())
             print("  from: %s#%s.%s" % (testfile,
-                t.testcase.__class__.__name__, t.testfn_name))
+                t.testcase_class.__name__, t.testfn_name))
             wrapped = textwrap.fill(' '.join(t.tags()), WIDTH-10)
             print("  tags: %s" % _indent(wrapped, 8, True))
             if t.doc():
@@ -464,8 +2881,571 @@ def list_tests(testdir_from_ns, tags):
             print(line)
 
 
+#---- per-test coverage
+
+class CoverageCollector(object):
+    """Collects the source lines executed by each test.
+
+    Uses `sys.monitoring` (Python >=3.12): a line event is disabled once
+    it has fired, and all are re-enabled at the start of each test, so
+    each line costs one callback per test. Otherwise falls back to
+    `sys.settrace()`, tracing only frames of included files.
+
+    Lines of the Python installation and of testlib itself are not
+    collected. Lines are attributed to the test running in the current
+    thread. Note that with concurrently run tests (see ThreadedTestSuite)
+    a line run by one test may then not be recorded for another.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._include_from_filename = {}
+        self._tool_id = None
+        # The trace functions replaced by `start()` (without monitoring).
+        self._old_trace = None
+        self._old_thread_trace = None
+        # <test shortname> -> {<path>: <compact line ranges>}
+        self.lines_from_shortname = {}
+
+    def _include(self, filename):
+        include = self._include_from_filename.get(filename)
+        if include is None:
+            path = normpath(abspath(filename))
+            include = not (filename.startswith("<")
+                or splitext(path)[0] == splitext(abspath(__file__))[0]
+                or path.startswith(_python_install_prefixes()))
+            self._include_from_filename[filename] = include
+        return include
+
+    def start(self):
+        monitoring = getattr(sys, "monitoring", None)
+        if monitoring is not None:
+            try:
+                monitoring.use_tool_id(monitoring.COVERAGE_ID, "testlib")
+            except ValueError:
+                _, ex, _ = sys.exc_info()
+                raise TestError("cannot collect coverage: %s" % ex)
+            self._tool_id = monitoring.COVERAGE_ID
+            monitoring.register_callback(self._tool_id,
+                monitoring.events.LINE, self._monitor_line)
+            monitoring.set_events(self._tool_id, monitoring.events.LINE)
+        else:
+            self._old_trace = sys.gettrace()
+            # No threading.gettrace() before Python 3.10.
+            self._old_thread_trace = getattr(threading, "gettrace",
+                                             lambda: None)()
+            threading.settrace(self._trace)
+            sys.settrace(self._trace)
+
+    def stop(self):
+        if self._tool_id is not None:
+            monitoring = sys.monitoring
+            monitoring.set_events(self._tool_id, 0)
+            monitoring.register_callback(self._tool_id,
+                monitoring.events.LINE, None)
+            monitoring.free_tool_id(self._tool_id)
+            self._tool_id = None
+        else:
+            sys.settrace(self._old_trace)
+            threading.settrace(self._old_thread_trace)
+            self._old_trace = self._old_thread_trace = None
+
+    def _monitor_line(self, code, line):
+        lines = getattr(self._local, "lines", None)
+        if lines is not None and self._include(code.co_filename):
+            lines.add((code.co_filename, line))
+        return sys.monitoring.DISABLE
+
+    def _trace(self, frame, event, arg):
+        if self._include(frame.f_code.co_filename):
+            return self._trace_lines
+        return None
+
+    def _trace_lines(self, frame, event, arg):
+        if event == "line":
+            lines = getattr(self._local, "lines", None)
+            if lines is not None:
+                lines.add((frame.f_code.co_filename, frame.f_lineno))
+        return self._trace_lines
+
+    def start_test(self, test):
+        self._local.lines = set()
+        if self._tool_id is not None:
+            sys.monitoring.restart_events()
+
+    def stop_test(self, test):
+        lines = getattr(self._local, "lines", None)
+        self._local.lines = None
+        if lines is None:
+            return
+        lines_from_path = {}
+        for filename, line in lines:
+            path = normpath(abspath(filename))
+            lines_from_path.setdefault(path, []).append(line)
+        self.lines_from_shortname[test._testlib_shortname_] = dict(
+            (path, _ranges_from_lines(lines))
+            for path, lines in lines_from_path.items())
+
+
+class CoverageMap(object):
+    """The source lines executed by each test, as recorded by "--coverage"
+    runs.
+
+    This is stored as JSON in the given file, compactly: each path is
+    stored once and the lines of a file are a string of line ranges,
+    e.g. "1-5,8,10-12":
+
+        {"files": [<path>, ...],
+         "tests": {<test shortname>: {<index in files>: <ranges>, ...}}}
+    """
+    def __init__(self, path):
+        self.path = path
+        # <test shortname> -> {<path>: <ranges>}
+        self.lines_from_shortname = {}
+        if exists(path):
+            try:
+                f = open(path)
+                try:
+                    data = json.load(f)
+                finally:
+                    f.close()
+                files = data["files"]
+                for shortname, ranges_from_index in data["tests"].items():
+                    self.lines_from_shortname[shortname] = dict(
+                        (files[int(i)], ranges)
+                        for i, ranges in ranges_from_index.items())
+            except (ValueError, KeyError, IndexError, EnvironmentError):
+                _, ex, _ = sys.exc_info()
+                log.warn("could not load coverage map from '%s': %s "
+                         "(ignoring)", path, ex)
+
+    def update(self, lines_from_shortname):
+        """Update the map with the lines collected by a CoverageCollector
+        (replacing those of the same tests).
+        """
+        self.lines_from_shortname.update(lines_from_shortname)
+
+    def save(self):
+        files = []
+        index_from_path = {}
+        tests = {}
+        for shortname, ranges_from_path \
+                in sorted(self.lines_from_shortname.items()):
+            ranges_from_index = {}
+            for path, ranges in ranges_from_path.items():
+                if path not in index_from_path:
+                    index_from_path[path] = len(files)
+                    files.append(path)
+                ranges_from_index[index_from_path[path]] = ranges
+            tests[shortname] = ranges_from_index
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        f = open(tmp_path, 'w')
+        try:
+            json.dump({"files": files, "tests": tests}, f,
+                      separators=(',', ':'))
+        finally:
+            f.close()
+        if sys.platform == "win32" and exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    def covered_lines(self):
+        """Return the lines executed by any test: {<path>: set(<lines>)}"""
+        lines_from_path = {}
+        for ranges_from_path in self.lines_from_shortname.values():
+            for path, ranges in ranges_from_path.items():
+                lines_from_path.setdefault(path, set()).update(
+                    _lines_from_ranges(ranges))
+        return lines_from_path
+
+    def tests_covering(self, paths, lines_from_path=None):
+        """Return the shortnames of the tests that executed any line of
+        the given source files (e.g. the files changed since the last run).
+
+        "lines_from_path" (optional) limits this to the tests executing
+            one of the given lines of a file: {<path>: <lines>}.
+        """
+        wanted = {}
+        for path in paths:
+            path = normpath(abspath(path))
+            wanted[path] = None
+        for path, lines in (lines_from_path or {}).items():
+            wanted[normpath(abspath(path))] = set(lines)
+        shortnames = set()
+        for shortname, ranges_from_path in self.lines_from_shortname.items():
+            for path, ranges in ranges_from_path.items():
+                if path not in wanted:
+                    continue
+                if wanted[path] is None \
+                   or wanted[path].intersection(_lines_from_ranges(ranges)):
+                    shortnames.add(shortname)
+                    break
+        return shortnames
+
+
+def _ranges_from_lines(lines):
+    """Return a compact string for the given line numbers, e.g.
+    "1-5,8,10-12".
+    """
+    ranges = []
+    start = end = None
+    for line in sorted(lines):
+        if end is not None and line == end + 1:
+            end = line
+            continue
+        if start is not None:
+            ranges.append(start == end and str(start)
+                          or "%d-%d" % (start, end))
+        start = end = line
+    if start is not None:
+        ranges.append(start == end and str(start) or "%d-%d" % (start, end))
+    return ','.join(ranges)
+
+def _lines_from_ranges(ranges):
+    """Generate the line numbers in a string of line ranges."""
+    for bit in ranges.split(','):
+        if '-' in bit:
+            start, end = bit.split('-')
+            for line in range(int(start), int(end) + 1):
+                yield line
+        elif bit:
+            yield int(bit)
+
+
+
+#---- plugins
+# Reporters, profilers and other instrumentation can attach to test runs
+# as a `Plugin`, registered with `register_plugin()`. For each hook the
+# bound methods of the plugins overriding it are gathered up front (see
+# `_PluginHooks`), so hooks that no plugin uses cost nothing more than
+# looping over an empty tuple.
+
+class Plugin(object):
+    """Base class for test run plugins: override the hooks of interest.
+
+    The hooks are called, in this order, for a test run:
+        discovered(tests)
+        suite_start(result)
+            module_start(ns, testmod_name)
+                test_start(testcase)
+                test_end(testcase)
+                test_result(testcase, outcome, err)
+            module_end(ns, testmod_name)
+        suite_end(result)
+
+    For tests run in worker threads (see "--threads"), "test_start" and
+    "test_end" are called in the worker thread, as the test runs: these
+    calls for different tests can overlap. All other hooks, including
+    "test_result", are always called in the main thread, in the order
+    that results are reported (for threaded tests, after "test_end").
+    Reruns of failed tests ("--rerun-failures", possibly in forked child
+    processes) don't call any hooks: only the first run of a test is
+    reported. Exceptions raised by hooks are not caught; "suite_end" is
+    still called if the run is interrupted.
+    """
+    def discovered(self, tests):
+        """Called with the list of `Test`s selected for a test run, in the
+        order in which they will be run. The list can be changed in place
+        (e.g. to drop tests).
+        """
+    def suite_start(self, result):
+        """Called with the ConsoleTestResult before any tests are run."""
+    def suite_end(self, result):
+        """Called with the ConsoleTestResult after all tests have run,
+        before the summary is printed.
+        """
+    def module_start(self, ns, testmod_name):
+        """Called before the results of the tests of a test module."""
+    def module_end(self, ns, testmod_name):
+        """Called after the results of the tests of a test module."""
+    def test_start(self, testcase):
+        """Called as the given unittest.TestCase starts running, in the
+        thread that runs it.
+        """
+    def test_end(self, testcase):
+        """Called as the given unittest.TestCase has stopped running, in
+        the thread that ran it.
+        """
+    def test_result(self, testcase, outcome, err):
+        """Called with the outcome of a test: one of "ok", "FAIL",
+        "ERROR", "skipped", "expected failure" and "unexpected success".
+        "err" is the exc_info tuple for a failure or error, the reason
+        for a skip, or None.
+        """
+
+PLUGIN_HOOKS = ("discovered", "suite_start", "suite_end", "module_start",
+                "module_end", "test_start", "test_end", "test_result")
+
+class _PluginHooks(object):
+    """The hooks to call: for each hook name, a tuple of the bound methods
+    of the given plugins that override it.
+    """
+    def __init__(self, plugins=()):
+        for name in PLUGIN_HOOKS:
+            default = getattr(Plugin, name)
+            setattr(self, name, tuple(
+                getattr(plugin, name) for plugin in plugins
+                if getattr(type(plugin), name, default) is not default))
+
+_plugins = []
+_plugin_hooks = _PluginHooks()
+
+def register_plugin(plugin):
+    """Register the given `Plugin` instance for all following test runs.
+
+    Example (in a "test.py" harness script):
+        class SlowTestsPlugin(testlib.Plugin):
+            def test_start(self, testcase):
+                self.start_time = time.time()
+            def test_end(self, testcase):
+                if time.time() - self.start_time > 1.0:
+                    log.warn("slow test: %s", testcase.id())
+
+        testlib.register_plugin(SlowTestsPlugin())
+        sys.exit(testlib.harness())
+    """
+    global _plugin_hooks
+    _plugins.append(plugin)
+    _plugin_hooks = _PluginHooks(_plugins)
+
+def unregister_plugin(plugin):
+    """Unregister the given `Plugin` instance."""
+    global _plugin_hooks
+    _plugins.remove(plugin)
+    _plugin_hooks = _PluginHooks(_plugins)
+
+
+
 #---- text test runner that can handle TestSkipped reasonably
 
+class ProgressReporter(object):
+    """A stream wrapper that reports the progress of a test run.
+
+    Pass it as the stream of a ConsoleTestRunner. The test result then
+    tells it when tests start and stop, possibly from worker threads (see
+    ThreadedTestSuite). The progress -- tests completed of the total, the
+    current tests/sec, an ETA and the test being run by each worker -- is
+    shown at most every "interval" seconds, and only between lines of the
+    test output:
+
+    - If the stream is a TTY, as a status line below the test output that
+      is erased before the next test output is written.
+    - Otherwise as plain "progress: ..." lines (every 10s by default).
+
+    The ETA uses the durations of the tests recorded by earlier runs (in
+    the given TestHistory, if any), scaled by the speed of this run so
+    far, else just the test rate.
+    """
+    def __init__(self, stream, tests, history=None, interval=None):
+        self.stream = stream
+        self.is_tty = hasattr(stream, "isatty") and stream.isatty()
+        if interval is None:
+            interval = self.is_tty and 0.2 or 10.0
+        self.interval = interval
+        self.total = len(tests)
+        self.completed = 0
+        self._completed_time = 0.0
+
+        # The expected duration of each test, if known. Others count as
+        # the mean of the known durations.
+        self._expected_from_shortname = {}
+        if history is not None:
+            for test in tests:
+                duration = history.duration(test.shortname())
+                if duration is not None:
+                    self._expected_from_shortname[test.shortname()] \
+                        = duration
+        durations = list(self._expected_from_shortname.values())
+        self._default_expected = durations \
+            and sum(durations) / len(durations) or None
+        self._expected_remaining = self._default_expected is not None \
+            and sum(self._expected(t.shortname()) for t in tests) or None
+        self._expected_completed = 0.0
+
+        self._lock = threading.RLock()
+        self._current_from_worker = {}  # <thread name> -> <test shortname>
+        self._start_time = time.time()
+        self._last_update_time = self._start_time
+        self._at_line_start = True
+        self._status_shown = False
+
+    def _expected(self, shortname):
+        return self._expected_from_shortname.get(shortname,
+                                                 self._default_expected)
+
+    def write(self, data):
+        with self._lock:
+            if self._status_shown:
+                self.stream.write("\r\x1b[K")
+                self._status_shown = False
+            self.stream.write(data)
+            if data:
+                self._at_line_start = data.endswith("\n")
+
+    def flush(self):
+        self.stream.flush()
+
+    def start_test(self, test):
+        with self._lock:
+            self._current_from_worker[threading.current_thread().name] \
+                = test._testlib_shortname_
+            self._update()
+
+    def stop_test(self, test):
+        with self._lock:
+            self._current_from_worker.pop(threading.current_thread().name,
+                                          None)
+            self.completed += 1
+            self._completed_time = time.time() - self._start_time
+            if self._expected_remaining is not None:
+                expected = self._expected(test._testlib_shortname_)
+                self._expected_remaining -= expected
+                self._expected_completed += expected
+            self._update()
+
+    def eta(self):
+        """Return the estimated number of seconds left, or None."""
+        if not self.completed:
+            return None
+        elapsed = self._completed_time
+        if self._expected_remaining is not None and self._expected_completed:
+            return max(self._expected_remaining, 0.0) \
+                   * elapsed / self._expected_completed
+        return (self.total - self.completed) * elapsed / self.completed
+
+    def status(self):
+        """Return a one line description of the progress."""
+        elapsed = time.time() - self._start_time
+        parts = ["%d/%d tests" % (self.completed, self.total)]
+        if elapsed > 0:
+            parts.append("%.1f tests/s" % (self.completed / elapsed))
+        eta = self.eta()
+        if eta is not None:
+            parts.append("ETA %s" % _format_seconds(eta))
+        status = ", ".join(parts)
+        workers = sorted(self._current_from_worker.items())
+        if len(workers) == 1:
+            status += " | %s" % workers[0][1]
+        elif workers:
+            status += " | " + " ".join("%s: %s" % (name, shortname)
+                for name, shortname in workers)
+        return status
+
+    def _update(self):
+        now = time.time()
+        if now - self._last_update_time < self.interval \
+           or not self._at_line_start:
+            return
+        self._last_update_time = now
+        if self.is_tty:
+            width = shutil.get_terminal_size().columns - 1
+            self.stream.write("\r\x1b[K" + self.status()[:width])
+            self._status_shown = True
+        else:
+            self.stream.write("progress: %s\n" % self.status())
+        self.stream.flush()
+
+
+class _TestRecord(object):
+    """A compact stand-in for a finished test (or subtest) in the results.
+
+    It has the test's (or, for a subtest, its test's) "_testlib_shortname_"
+    and "_testlib_explicit_tags_" attributes and its description.
+    """
+    __slots__ = ("_testlib_shortname_", "_testlib_explicit_tags_",
+                 "description")
+
+    def __init__(self, test, description):
+        if _is_subtest(test):
+            test = test.test_case
+        self._testlib_shortname_ \
+            = getattr(test, "_testlib_shortname_", None) or test.id()
+        self._testlib_explicit_tags_ \
+            = getattr(test, "_testlib_explicit_tags_", [])
+        self.description = description
+
+    def __str__(self):
+        return self.description
+
+    def __repr__(self):
+        return "<_TestRecord %s>" % self.description
+
+
+class _FailureRecords(collections.abc.Sequence):
+    """The list of errors (or failures) of a ConsoleTestResult.
+
+    Like the lists of a unittest.TestResult this holds (<test>,
+    <formatted traceback>) 2-tuples, except that the tests are stored as
+    _TestRecord's (so that the test cases can be freed) and that, once
+    the tracebacks kept in memory exceed "max_memory" characters, further
+    tracebacks are spilled to a temporary file. These are read back when
+    iterating over the list. Slicing it, or adding it to a list, gives a
+    plain list of the 2-tuples.
+    """
+    def __init__(self, describe, max_memory=None):
+        self.describe = describe    # a callable returning a description
+        self.max_memory = max_memory
+        # [(<record>, <traceback or (offset, length) in spill file>), ...]
+        self._entries = []
+        self._memory = 0
+        self._spill_file = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        for record, err in self._entries:
+            yield record, self._load(err)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [(record, self._load(err))
+                    for record, err in self._entries[index]]
+        record, err = self._entries[index]
+        return record, self._load(err)
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def append(self, entry):
+        test, err = entry
+        if not isinstance(test, _TestRecord):
+            test = _TestRecord(test, self.describe(test))
+        if self.max_memory is not None \
+           and self._memory + len(err) > self.max_memory:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile()
+            data = err.encode("utf-8", "surrogatepass")
+            self._spill_file.seek(0, os.SEEK_END)
+            err = (self._spill_file.tell(), len(data))
+            self._spill_file.write(data)
+        else:
+            self._memory += len(err)
+        self._entries.append((test, err))
+
+    def _load(self, err):
+        if isinstance(err, tuple):
+            offset, length = err
+            self._spill_file.seek(offset)
+            err = self._spill_file.read(length).decode("utf-8",
+                                                       "surrogatepass")
+        return err
+
+    def remove_test(self, shortname):
+        """Remove and return the entries for the given test."""
+        removed = []
+        entries = []
+        for record, err in self._entries:
+            if record._testlib_shortname_ == shortname:
+                removed.append((record, self._load(err)))
+            else:
+                entries.append((record, err))
+        self._entries = entries
+        return removed
+
+
 class ConsoleTestResult(unittest.TestResult):
     """A test result class that can print formatted text results to a stream.
 
@@ -474,57 +3454,685 @@ class ConsoleTestResult(unittest.TestResult):
     separator1 = '=' * 70
     separator2 = '-' * 70
 
+    # A FixtureManager for the current test run, if any.
+    fixtures = None
+
+    # The maximum number of failing subtests (per test) for which the
+    # traceback is kept for the summary. Further failing subtests are just
+    # counted, to bound memory for tests looping over many subtests.
+    max_subtest_failures = 10
+
+    # Stop the test run (see `unittest.TestResult.stop()`) once this many
+    # tests have failed or errored. None means no limit.
+    maxfail = None
+
+    # Rerun each failing or erroring test up to this many times. A test
+    # that passes on a rerun is moved from `failures`/`errors` to `flaky`.
+    # See `_startRerun()`.
+    rerun_failures = 0
+
+    # Check each test for leaked resources: None (no checks), "report" or
+    # "fail" (also fail an otherwise passing leaking test, i.e. it counts
+    # for `maxfail` and `rerun_failures`). See `_leak_snapshot()`.
+    # A test leaks if one of the counts grew by more than its threshold
+    # while running it. Note that resources kept by fixtures are counted
+    # against the test that first used them, and that tests run in worker
+    # threads (see ThreadedTestSuite) are not checked.
+    leak_check = None
+    leak_thresholds = {"threads": 0, "fds": 0, "objects": 1000,
+                       "modules": 10}
+
+    # A ProgressReporter to tell about started and stopped tests, if any.
+    progress = None
+
+    # A CoverageCollector to collect the lines executed by each test, if any.
+    coverage = None
+
+    # Set while `_RecordingTestResult.replay()` replays a test run earlier.
+    _replaying = False
+
+    # The maximum number of characters of error and failure tracebacks
+    # (each) kept in memory. Further tracebacks are spilled to a temporary
+    # file and read back for the summary. See `_FailureRecords`.
+    max_failure_memory = 10 * 1024 * 1024
+
     def __init__(self, stream):
         unittest.TestResult.__init__(self)
+        self.errors = _FailureRecords(self.getDescription,
+                                      self.max_failure_memory)
+        self.failures = _FailureRecords(self.getDescription,
+                                        self.max_failure_memory)
         self.skips = []
+        self.flaky = []
+        # <test shortname> -> (<number of reruns>, <passed on a rerun>)
+        self.reruns = {}
+        self._pending_reruns = []   # [(<test>, <pid>, <fd>), ...]
+        self._serial_reruns = []    # [<test>, ...]
+        # [(<score>, <shortname>, <growth from kind>, <top types>), ...]
+        self.leaks = []
+        self._leak_snapshot_before = None
+        self.durations = {}  # <test shortname> -> <duration in seconds>
+        self.subtestsRun = 0
+        self.subtestFailuresNotShown = 0
+        # <test shortname> -> <number of its subtest failures not shown>
+        self._subtest_failures_not_shown = {}
         self.stream = stream
+        self._test_start_time = None
+        self._test_duration_added = False
+        self._test_outcome_written = False
+        self._test_subtest_counts = None
+        self._test_failed = False
+        self._module_scope = None
 
     def getDescription(self, test):
-        if test._testlib_explicit_tags_:
+        if isinstance(test, _TestRecord):
+            return test.description
+        elif _is_subtest(test):
+            return "%s %s" % (self.getDescription(test.test_case),
+                              test._subDescription())
+        elif not hasattr(test, "_testlib_shortname_"):
+            # E.g. the unittest stand-in for a failing setUpClass().
+            return str(test)
+        elif test._testlib_explicit_tags_:
             return "%s [%s]" % (test._testlib_shortname_,
                                 ', '.join(test._testlib_explicit_tags_))
         else:
             return test._testlib_shortname_
 
+    def startTestRun(self):
+        for hook in _plugin_hooks.suite_start:
+            hook(self)
+
+    def stopTestRun(self):
+        if self._module_scope is not None:
+            for hook in _plugin_hooks.module_end:
+                hook(*self._module_scope)
+            self._module_scope = None
+        for hook in _plugin_hooks.suite_end:
+            hook(self)
+
     def startTest(self, test):
         unittest.TestResult.startTest(self, test)
+        if _plugin_hooks.module_start or _plugin_hooks.module_end:
+            self._startModule(getattr(test, "_testlib_scope_", None))
+        if self.fixtures is not None:
+            self.fixtures.start_test(test)
+        self._test_start_time = time.time()
+        self._test_duration_added = False
+        self._test_outcome_written = False
+        self._test_subtest_counts = None
+        self._test_failed = False
         self.stream.write(self.getDescription(test))
         self.stream.write(" ... ")
+        if self.leak_check and not self._replaying:
+            self._leak_snapshot_before = _leak_snapshot()
+        if self.progress is not None and not self._replaying:
+            self.progress.start_test(test)
+        if self.coverage is not None and not self._replaying:
+            self.coverage.start_test(test)
+        if not self._replaying:
+            for hook in _plugin_hooks.test_start:
+                hook(test)
+
+    def _startModule(self, scope):
+        # E.g. the unittest stand-in for a failing setUpModule() has no
+        # scope: count it with the current module.
+        if scope is None or scope == self._module_scope:
+            return
+        if self._module_scope is not None:
+            for hook in _plugin_hooks.module_end:
+                hook(*self._module_scope)
+        self._module_scope = scope
+        for hook in _plugin_hooks.module_start:
+            hook(*scope)
+
+    def _reportResult(self, test, outcome, err=None):
+        for hook in _plugin_hooks.test_result:
+            hook(test, outcome, err)
+
+    def _writeOutcome(self, outcome):
+        counts = self._test_subtest_counts
+        if counts is not None:
+            num_passed, num_failed, num_errors, num_skips = counts
+            num_subtests = sum(counts)
+            details = ["%d subtest%s" % (num_subtests,
+                                         num_subtests != 1 and "s" or "")]
+            if num_failed:
+                details.append("%d failed" % num_failed)
+            if num_errors:
+                details.append("%d error%s"
+                    % (num_errors, num_errors != 1 and "s" or ""))
+            if num_skips:
+                details.append("%d skipped" % num_skips)
+            outcome = "%s (%s)" % (outcome, ', '.join(details))
+        self.stream.write(outcome + "\n")
+        self._test_outcome_written = True
+
+    def addDuration(self, test, elapsed):
+        # Called by unittest itself in Python >=3.12.
+        self._test_duration_added = True
+        self.durations[test._testlib_shortname_] = elapsed
+
+    def stopTest(self, test):
+        if self.coverage is not None and not self._replaying:
+            self.coverage.stop_test(test)
+        if not self._replaying:
+            for hook in _plugin_hooks.test_end:
+                hook(test)
+        if not self._test_outcome_written:
+            # unittest does not report an outcome for a test whose only
+            # failures were in subtests.
+            counts = self._test_subtest_counts or [0, 0, 0, 0]
+            if counts[2]:
+                outcome = "ERROR"
+            elif counts[1]:
+                outcome = "FAIL"
+            else:
+                outcome = "ok"
+            self._writeOutcome(outcome)
+            self._reportResult(test, outcome)
+        if not self._test_duration_added:
+            self.addDuration(test, time.time() - self._test_start_time)
+        unittest.TestResult.stopTest(self, test)
+        rerun = self._test_failed and self._wantsRerun(test)
+        self._test_failed = False
+        if self.fixtures is not None:
+            # The fixtures of a test to rerun are kept for the rerun.
+            self.fixtures.stop_test(test, release=not rerun)
+        summary = self._checkLeaks(test)
+        if summary is not None:
+            self.stream.write("    leaked %s\n" % summary)
+        if self.progress is not None and not self._replaying:
+            self.progress.stop_test(test)
+        stats = getattr(test, "_testlib_load_stats_", None)
+        if stats is not None:
+            self.stream.write("    load: %(workers)s, %(calls)d calls, "
+                              "%(throughput).0f calls/s" % stats)
+            self.stream.write(", p50 %s, p99 %s\n" % (
+                _format_latency(stats["p50"]),
+                _format_latency(stats["p99"])))
+        if rerun:
+            self._startRerun(test)
+
+    def _checkLeaks(self, test):
+        """Check the running test for leaks, if that wasn't done yet.
+
+        Returns a summary of the leaks, or None.
+        """
+        before = self._leak_snapshot_before
+        if before is None:
+            return None
+        self._leak_snapshot_before = None
+        after = _leak_snapshot()
+        growth_from_kind = {}
+        score = 0.0
+        for kind in ("threads", "fds", "objects", "modules"):
+            if before[kind] is None or after[kind] is None:
+                continue
+            growth = after[kind] - before[kind]
+            threshold = self.leak_thresholds.get(kind, 0)
+            if growth > threshold:
+                growth_from_kind[kind] = growth
+                score += float(growth) / max(threshold, 1)
+        if not growth_from_kind:
+            return None
+        top_types = (after["types"] - before["types"]).most_common(3)
+        self.leaks.append((score, test._testlib_shortname_,
+                           growth_from_kind, top_types))
+        return _leak_summary(growth_from_kind, top_types)
 
     def addSuccess(self, test):
+        if self.leak_check == "fail":
+            summary = self._checkLeaks(test)
+            if summary is not None:
+                # Fail the otherwise passing test.
+                ex = test.failureException("Leaked %s" % summary)
+                self.addFailure(test, (ex.__class__, ex, None))
+                self.stream.write("    leaked %s\n" % summary)
+                return
         unittest.TestResult.addSuccess(self, test)
-        self.stream.write("ok\n")
+        self._writeOutcome("ok")
+        self._reportResult(test, "ok")
 
     def addSkip(self, test, err):
-        why = str(err[1])
-        self.skips.append((test, why))
-        self.stream.write("skipped (%s)\n" % why)
+        # "err" is the reason string when called by unittest for a
+        # unittest.SkipTest.
+        if isinstance(err, tuple):
+            why = str(err[1])
+        else:
+            why = str(err)
+        if _is_subtest(test):
+            self._countSubTest(3)
+            return
+        self.skips.append((_TestRecord(test, self.getDescription(test)),
+                           why))
+        self._writeOutcome("skipped (%s)" % why)
+        self._reportResult(test, "skipped", why)
 
     def addError(self, test, err):
         if isinstance(err[1], TestSkipped):
             self.addSkip(test, err)
         else:
             unittest.TestResult.addError(self, test, err)
-            self.stream.write("ERROR\n")
+            self._writeOutcome("ERROR")
+            self._reportResult(test, "ERROR", err)
+            self._checkMaxFail()
+            self._test_failed = True
 
     def addFailure(self, test, err):
         unittest.TestResult.addFailure(self, test, err)
-        self.stream.write("FAIL\n")
+        self._writeOutcome("FAIL")
+        self._reportResult(test, "FAIL", err)
+        self._checkMaxFail()
+        self._test_failed = True
+
+    def failureCount(self):
+        """Return the number of failures and errors, including those of
+        subtests not kept (see `max_subtest_failures`).
+        """
+        return (len(self.errors) + len(self.failures)
+                + self.subtestFailuresNotShown)
+
+    def wasSuccessful(self):
+        return unittest.TestResult.wasSuccessful(self) \
+               and not self.subtestFailuresNotShown
+
+    def _checkMaxFail(self):
+        if self.maxfail is not None and self.failureCount() >= self.maxfail:
+            self.stop()
+
+    def addExpectedFailure(self, test, err):
+        unittest.TestResult.addExpectedFailure(self, test, err)
+        self._writeOutcome("expected failure")
+        self._reportResult(test, "expected failure", err)
+
+    def addUnexpectedSuccess(self, test):
+        unittest.TestResult.addUnexpectedSuccess(self, test)
+        self._writeOutcome("unexpected success")
+        self._reportResult(test, "unexpected success")
+
+    def _countSubTest(self, index):
+        """Count a subtest of the running test by outcome: 0 (passed), 1
+        (failed), 2 (error) or 3 (skipped).
+        """
+        if self._test_subtest_counts is None:
+            self._test_subtest_counts = [0, 0, 0, 0]
+        self._test_subtest_counts[index] += 1
+        self.subtestsRun += 1
+
+    def addSubTest(self, test, subtest, err):
+        if err is None:
+            self._countSubTest(0)
+        elif isinstance(err[1], TestSkipped):
+            self._countSubTest(3)
+        else:
+            if issubclass(err[0], test.failureException):
+                self._countSubTest(1)
+            else:
+                self._countSubTest(2)
+            counts = self._test_subtest_counts
+            if counts[1] + counts[2] <= self.max_subtest_failures:
+                unittest.TestResult.addSubTest(self, test, subtest, err)
+            else:
+                self.subtestFailuresNotShown += 1
+                shortname = getattr(test, "_testlib_shortname_", None)
+                self._subtest_failures_not_shown[shortname] \
+                    = self._subtest_failures_not_shown.get(shortname, 0) + 1
+            self._checkMaxFail()
+            self._test_failed = True
+
+    def _wantsRerun(self, test):
+        """Return true if the given failed test is to be rerun."""
+        return bool(self.rerun_failures) \
+               and getattr(test, "_testlib_shortname_", None) is not None \
+               and test._testlib_shortname_ not in self.reruns
+
+    def _startRerun(self, test):
+        """Start rerunning the given failed test.
+
+        This is called once the test has stopped and reruns a new instance
+        of it (see `_new_testcase()`). If possible the reruns are done in a
+        forked child process, in parallel with the rest of the test run,
+        with its output discarded. Otherwise the test is rerun in this
+        process by `finishReruns()`, i.e. if:
+        - there is no `os.fork()`;
+        - worker threads are running, which could hold locks the child
+          would then wait on forever;
+        - the test uses fixtures (see `uses()`): these are kept for the
+          rerun and only torn down (in this process) after it.
+        """
+        self.reruns[test._testlib_shortname_] = None
+        test = _new_testcase(test)
+        if not hasattr(os, "fork") or threading.active_count() > 1 \
+           or getattr(test, "_testlib_fixtures_", None):
+            self._serial_reruns.append(test)
+            return
+
+        max_children = os.cpu_count() or 1
+        while len(self._pending_reruns) >= max_children:
+            self._finishRerun(*self._pending_reruns.pop(0))
+        self.stream.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.close(rfd)
+                null_fd = os.open(os.devnull, os.O_RDWR)
+                os.dup2(null_fd, 1)
+                os.dup2(null_fd, 2)
+                # Fixtures are never torn down in the child.
+                num_reruns, passed = _rerun_test(test, self.rerun_failures,
+                                                 self.fixtures, release=False)
+                os.write(wfd, ("%d %d" % (num_reruns, passed)).encode())
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(wfd)
+        self._pending_reruns.append((test, pid, rfd))
+
+    def _finishRerun(self, test, pid=None, rfd=None):
+        if pid is None:
+            num_reruns, passed = _rerun_test(test, self.rerun_failures,
+                                             self.fixtures)
+        else:
+            output = b""
+            while True:
+                data = os.read(rfd, 1024)
+                if not data:
+                    break
+                output += data
+            os.close(rfd)
+            os.waitpid(pid, 0)
+            try:
+                num_reruns, passed = [int(n) for n in output.split()]
+            except ValueError:
+                log.warn("could not rerun '%s' (rerun process failed)",
+                         test._testlib_shortname_)
+                return
+        self.reruns[test._testlib_shortname_] = (num_reruns, bool(passed))
+        if not passed:
+            return
+        # Passed on a rerun: this is a flaky test rather than a failure.
+        for errors in (self.errors, self.failures):
+            self.flaky += errors.remove_test(test._testlib_shortname_)
+        self.subtestFailuresNotShown -= self._subtest_failures_not_shown.pop(
+            test._testlib_shortname_, 0)
+
+    def finishReruns(self):
+        """Wait for (or do) the pending reruns of failed tests."""
+        while self._pending_reruns:
+            self._finishRerun(*self._pending_reruns.pop(0))
+        while self._serial_reruns:
+            self._finishRerun(self._serial_reruns.pop(0))
 
     def printSummary(self):
         self.stream.write('\n')
         self.printErrorList('ERROR', self.errors)
         self.printErrorList('FAIL', self.failures)
+        self.printErrorList('FLAKY', self.flaky)
+        if self.leaks:
+            self.stream.write(self.separator1 + '\n')
+            self.stream.write("LEAKS (most first):\n")
+            self.stream.write(self.separator2 + '\n')
+            for score, shortname, growth_from_kind, top_types \
+                    in sorted(self.leaks, key=lambda l: -l[0]):
+                self.stream.write("%s: %s\n" % (
+                    shortname, _leak_summary(growth_from_kind, top_types)))
+            self.stream.write('\n')
+        if self.subtestFailuresNotShown:
+            self.stream.write("(%d more failing subtest%s not shown)\n\n"
+                % (self.subtestFailuresNotShown,
+                   self.subtestFailuresNotShown != 1 and "s" or ""))
 
     def printErrorList(self, flavour, errors):
         for test, err in errors:
             self.stream.write(self.separator1 + '\n')
-            self.stream.write("%s: %s\n"
-                              % (flavour, self.getDescription(test)))
+            description = self.getDescription(test)
+            if flavour == "FLAKY":
+                shortname = (test.test_case if _is_subtest(test)
+                             else test)._testlib_shortname_
+                num_reruns = self.reruns[shortname][0]
+                description += " (passed on rerun %d of %d)" % (
+                    num_reruns, self.rerun_failures)
+            self.stream.write("%s: %s\n" % (flavour, description))
             self.stream.write(self.separator2 + '\n')
             self.stream.write("%s\n" % err)
 
 
+class _RecordingTestResult(unittest.TestResult):
+    """A test result that just records the calls made on it.
+
+    The recorded calls are later replayed on the real result (see
+    `replay()`). This allows a test case to be run in a worker thread
+    while all reporting is done, one test at a time, from the main thread.
+    """
+    def __init__(self, fixtures=None, progress=None, coverage=None):
+        unittest.TestResult.__init__(self)
+        self.fixtures = fixtures
+        self.progress = progress
+        self.coverage = coverage
+        self.calls = []
+
+    def _recorder(name):
+        def record(self, *args):
+            self.calls.append((name, args))
+        record.__name__ = name
+        return record
+    _recordStartTest = _recorder("startTest")
+    def startTest(self, test):
+        # Fixtures are looked up for the running test in its own thread.
+        if self.fixtures is not None:
+            self.fixtures.start_test(test)
+        if self.progress is not None:
+            self.progress.start_test(test)
+        if self.coverage is not None:
+            self.coverage.start_test(test)
+        for hook in _plugin_hooks.test_start:
+            hook(test)
+        self._start_time = time.time()
+        self._recordStartTest(test)
+    _recordStopTest = _recorder("stopTest")
+    def stopTest(self, test):
+        if self.coverage is not None:
+            self.coverage.stop_test(test)
+        for hook in _plugin_hooks.test_end:
+            hook(test)
+        # Record the duration of the test as run, not as replayed.
+        if not hasattr(unittest.TestResult, "addDuration"):
+            self.calls.append(
+                ("addDuration", (test, time.time() - self._start_time)))
+        if self.progress is not None:
+            self.progress.stop_test(test)
+        self._recordStopTest(test)
+    addSuccess = _recorder("addSuccess")
+    addError = _recorder("addError")
+    addFailure = _recorder("addFailure")
+    addSkip = _recorder("addSkip")
+    addSubTest = _recorder("addSubTest")
+    addExpectedFailure = _recorder("addExpectedFailure")
+    addUnexpectedSuccess = _recorder("addUnexpectedSuccess")
+    addDuration = _recorder("addDuration")
+    del _recorder
+
+    def replay(self, result):
+        result._replaying = True
+        try:
+            for name, args in self.calls:
+                getattr(result, name)(*args)
+        finally:
+            result._replaying = False
+        self.calls = []
+
+
+class ThreadedTestSuite(unittest.TestSuite):
+    """A test suite that runs its test cases in a pool of worker threads.
+
+    Test cases of one TestCase class are run concurrently. Class and
+    module fixtures (setUpClass, setUpModule, etc.) are still handled from
+    the calling thread and all tests of a class are finished before the
+    next class is started.
+
+    Each test case runs against its own recording result. Those are
+    replayed on the given result in suite order, so output from the
+    (non-thread-safe) ConsoleTestResult is serialized per test and
+    deterministic. If replaying makes the result stop (e.g. on reaching
+    `ConsoleTestResult.maxfail`) the queued test cases are cancelled; those
+    already running are finished, but not reported (they count as not
+    run).
+
+    Note: this handles class and module fixtures with the same (private)
+    unittest.TestSuite methods as `unittest.TestSuite.run()`, e.g.
+    `_handleModuleFixture()` and `_tearDownPreviousClass()`. The
+    ThreadedTestSuite tests in the testlib test suite cover their use.
+    """
+    def __init__(self, tests=(), num_threads=4):
+        unittest.TestSuite.__init__(self, tests)
+        self.num_threads = num_threads
+
+    def _class_groups(self):
+        """Generate lists of adjacent tests of the same class.
+
+        Yields 2-tuples: (<index of the first test>, <list of tests>).
+        """
+        start = 0
+        group = []
+        for index, test in enumerate(self):
+            if group and (not isinstance(test, unittest.TestCase)
+                          or test.__class__ is not group[0].__class__):
+                yield start, group
+                start = index
+                group = []
+            group.append(test)
+        if group:
+            yield start, group
+
+    def run(self, result, debug=False):
+        from concurrent.futures import ThreadPoolExecutor
+        top_level = False
+        if getattr(result, "_testRunEntered", False) is False:
+            result._testRunEntered = top_level = True
+
+        pool = ThreadPoolExecutor(self.num_threads,
+                                  thread_name_prefix="worker")
+        try:
+            for start, group in self._class_groups():
+                if result.shouldStop:
+                    break
+                first = group[0]
+                if not isinstance(first, unittest.TestCase):
+                    # A nested suite: just run it.
+                    first(result)
+                    self._removeTests(start, 1)
+                    continue
+                self._tearDownPreviousClass(first, result)
+                self._handleModuleFixture(first, result)
+                self._handleClassSetUp(first, result)
+                result._previousTestClass = first.__class__
+                if (getattr(first.__class__, "_classSetupFailed", False)
+                    or getattr(result, "_moduleSetUpFailed", False)):
+                    self._removeTests(start, len(group))
+                    continue
+
+                fixtures = getattr(result, "fixtures", None)
+                progress = getattr(result, "progress", None)
+                coverage = getattr(result, "coverage", None)
+                recorders = [_RecordingTestResult(fixtures, progress, coverage)
+                             for t in group]
+                futures = [pool.submit(t, r)
+                           for t, r in zip(group, recorders)]
+                for future, recorder in zip(futures, recorders):
+                    if future.cancelled():
+                        continue
+                    future.result()
+                    if result.shouldStop:
+                        # Finished after the run was stopped.
+                        continue
+                    recorder.replay(result)
+                    if result.shouldStop:
+                        for f in futures:
+                            f.cancel()
+                self._removeTests(start, len(group))
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        if top_level:
+            self._tearDownPreviousClass(None, result)
+            self._handleModuleTearDown(result)
+            result._testRunEntered = False
+        return result
+
+    def _removeTests(self, start, count):
+        # Drop run tests, as unittest.TestSuite.run() does, so that they
+        # can be freed.
+        if getattr(self, "_cleanup", False):
+            for index in range(start, start + count):
+                self._removeTestAtIndex(index)
+
+
+class _TimingPhaseSuite(unittest.TestSuite):
+    """A test suite for the phase of timing-sensitive tests of a test run.
+
+    The tests are run in the calling thread, with garbage collection
+    disabled, pinned to the given CPU (one reserved for timing phases, see
+    `_timing_cpus()`), if any. Timing phases of concurrent test runs (e.g.
+    of a test suite split over a number of harness processes) are run one
+    at a time: a phase waits for a lock file (one per user) before
+    starting.
+
+    Note that the module and class fixtures (`setUpModule()`,
+    `setUpClass()` and their teardowns) of a module with tests in both
+    phases are run again for the timing phase if other tests run in
+    between (as with any interleaved tests, see `ordered_tests()`).
+    """
+    lock_path = join(tempfile.gettempdir(),
+                     "testlib-%s-timing.lock" % _user_id())
+
+    def __init__(self, tests=(), cpu=None):
+        unittest.TestSuite.__init__(self, tests)
+        self.cpu = cpu
+
+    def run(self, result, debug=False):
+        lock_f = None
+        try:
+            import fcntl
+        except ImportError:
+            log.debug("running the timing phase without a lock: no fcntl")
+        else:
+            try:
+                lock_f = open(self.lock_path, 'a')
+            except EnvironmentError:
+                _, ex, _ = sys.exc_info()
+                log.warn("could not open the timing phase lock file '%s': "
+                         "%s (running the timing phase without a lock)",
+                         self.lock_path, ex)
+        cpus = None
+        gc_was_enabled = gc.isenabled()
+        try:
+            if lock_f is not None:
+                try:
+                    fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except EnvironmentError:
+                    log.info("waiting for the timing phase of another "
+                             "test run")
+                    fcntl.flock(lock_f, fcntl.LOCK_EX)
+            if self.cpu is not None:
+                cpus = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, [self.cpu])
+            gc.collect()
+            gc.disable()
+            return unittest.TestSuite.run(self, result, debug)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+            if cpus is not None:
+                os.sched_setaffinity(0, cpus)
+            if lock_f is not None:
+                lock_f.close()
+
+
 class ConsoleTestRunner(object):
     """A test runner class that displays results on the console.
 
@@ -537,26 +4145,66 @@ class ConsoleTestRunner(object):
     - test "short desc" is it 3-level tag name (e.g. 'foo/bar/baz' where
       that identifies: 'test_foo.py::BarTestCase.test_baz'.
     """
-    def __init__(self, stream=sys.stderr):
+    def __init__(self, stream=sys.stderr, fixtures=None, maxfail=None,
+                 rerun_failures=0, leak_check=None, coverage=None):
         self.stream = stream
+        self.fixtures = fixtures
+        self.maxfail = maxfail
+        self.rerun_failures = rerun_failures
+        self.leak_check = leak_check
+        self.coverage = coverage
 
     def run(self, test_or_suite, test_result_class=ConsoleTestResult):
         """Run the given test case or test suite."""
         result = test_result_class(self.stream)
+        result.fixtures = self.fixtures
+        result.maxfail = self.maxfail
+        result.rerun_failures = self.rerun_failures
+        result.leak_check = self.leak_check
+        result.coverage = self.coverage
+        if isinstance(self.stream, ProgressReporter):
+            result.progress = self.stream
+        # Count up front: unittest.TestSuite drops tests as they are run.
+        num_tests = test_or_suite.countTestCases()
         start_time = time.time()
-        test_or_suite.run(result)
+        if self.coverage is not None:
+            self.coverage.start()
+        result.startTestRun()
+        try:
+            test_or_suite.run(result)
+            if hasattr(result, "finishReruns"):
+                result.finishReruns()
+        finally:
+            try:
+                result.stopTestRun()
+            finally:
+                if self.coverage is not None:
+                    self.coverage.stop()
+                if self.fixtures is not None:
+                    self.fixtures.teardown_all()
         time_taken = time.time() - start_time
 
         result.printSummary()
         self.stream.write(result.separator2 + '\n')
-        self.stream.write("Ran %d test%s in %.3fs\n\n"
-            % (result.testsRun, result.testsRun != 1 and "s" or "",
-               time_taken))
+        subtests_run = getattr(result, "subtestsRun", 0)
+        if subtests_run:
+            self.stream.write("Ran %d test%s (%d subtest%s) in %.3fs\n\n"
+                % (result.testsRun, result.testsRun != 1 and "s" or "",
+                   subtests_run, subtests_run != 1 and "s" or "",
+                   time_taken))
+        else:
+            self.stream.write("Ran %d test%s in %.3fs\n\n"
+                % (result.testsRun, result.testsRun != 1 and "s" or "",
+                   time_taken))
         details = []
         num_skips = len(result.skips)
         if num_skips:
             details.append("%d skip%s"
                 % (num_skips, (num_skips != 1 and "s" or "")))
+        num_flaky = sum(1 for rerun in getattr(result, "reruns", {}).values()
+                        if rerun and rerun[1])
+        if num_flaky:
+            details.append("%d flaky" % num_flaky)
         if not result.wasSuccessful():
             num_failures = len(result.failures)
             if num_failures:
@@ -566,6 +4214,14 @@ class ConsoleTestRunner(object):
             if num_errors:
                 details.append("%d error%s"
                     % (num_errors, (num_errors != 1 and "s" or "")))
+            num_not_shown = getattr(result, "subtestFailuresNotShown", 0)
+            if num_not_shown:
+                details.append("%d more failing subtest%s"
+                    % (num_not_shown, (num_not_shown != 1 and "s" or "")))
+            num_not_run = num_tests - result.testsRun
+            if result.shouldStop and num_not_run > 0:
+                details.append("stopped, %d test%s not run"
+                    % (num_not_run, (num_not_run != 1 and "s" or "")))
             self.stream.write("FAILED (%s)\n" % ', '.join(details))
         elif details:
             self.stream.write("OK (%s)\n" % ', '.join(details))
@@ -577,6 +4233,144 @@ class ConsoleTestRunner(object):
 
 #---- internal support stuff
 
+def _leak_snapshot():
+    """Return a dict of counts of live resources, to compare before and
+    after a test: the number of threads, open file descriptors (None if
+    not known), gc-tracked objects (also by type name in "types") and
+    modules.
+    """
+    gc.collect()
+    count_from_type = collections.Counter(
+        type(obj).__name__ for obj in gc.get_objects())
+    try:
+        num_fds = len(os.listdir("/proc/self/fd"))
+    except EnvironmentError:
+        num_fds = None
+    return {"threads": threading.active_count(), "fds": num_fds,
+            "objects": sum(count_from_type.values()),
+            "types": count_from_type,
+            "modules": len(sys.modules)}
+
+def _leak_summary(growth_from_kind, top_types):
+    """Return a short description of the resources leaked by a test, e.g.
+    "1 threads, 1532 objects (dict +800, list +400, Foo +300)".
+    """
+    parts = []
+    for kind in ("threads", "fds", "objects", "modules"):
+        if kind in growth_from_kind:
+            parts.append("%d %s" % (growth_from_kind[kind], kind))
+    summary = ", ".join(parts)
+    if "objects" in growth_from_kind and top_types:
+        summary += " (%s)" % ", ".join("%s +%d" % t for t in top_types)
+    return summary
+
+def _report_budgeted_tests(tests, budget, history, stream=None):
+    """Return the `budgeted_tests()` and report those left out (to stdout
+    by default).
+    """
+    if stream is None:
+        stream = sys.stdout
+    chosen, left_out = budgeted_tests(tests, budget, history)
+    cost_from_test = _test_costs(tests, history)
+    def cost(tests):
+        return sum(cost_from_test[t] for t in tests)
+    stream.write("Running %d of %d tests (estimated %.1fs of a %gs budget)"
+                 % (len(chosen), len(tests), cost(chosen), budget))
+    if left_out:
+        stream.write(", left out %d (estimated %.1fs):\n"
+                     % (len(left_out), cost(left_out)))
+        # List them all with "-v".
+        num_shown = log.isEnabledFor(logging.INFO) and len(left_out) or 10
+        for test in left_out[:num_shown]:
+            stream.write("    %s\n" % test.shortname())
+        if len(left_out) > num_shown:
+            stream.write("    ... and %d more (use -v to list them all)\n"
+                         % (len(left_out) - num_shown))
+    else:
+        stream.write(".\n")
+    stream.write("\n")
+    return chosen
+
+def _timing_cpus():
+    """Return the CPUs the calling thread may run on and the one of those
+    reserved for timing-sensitive tests (the last one):
+        (<set of CPUs>, <reserved CPU>)
+    or (None, None) if CPU affinity is not supported or there is only one
+    CPU to run on.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None, None
+    cpus = os.sched_getaffinity(0)
+    if len(cpus) < 2:
+        return None, None
+    return cpus, max(cpus)
+
+def _format_seconds(seconds):
+    """Format a number of seconds as "[H:]MM:SS"."""
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%d:%02d:%02d" % (hours, minutes, seconds)
+    return "%d:%02d" % (minutes, seconds)
+
+def _format_latency(seconds):
+    """Format a (short) duration in seconds with a fitting unit."""
+    if seconds < 1e-3:
+        return "%.1fus" % (seconds * 1e6)
+    elif seconds < 1.0:
+        return "%.2fms" % (seconds * 1e3)
+    return "%.2fs" % seconds
+
+def _new_testcase(test):
+    """Return a new instance of the given test case, e.g. to rerun it."""
+    if hasattr(test, "_testlib_test_"):
+        return test._testlib_test_.new_testcase()
+    new = test.__class__(test._testMethodName)
+    for name, value in vars(test).items():
+        if name.startswith("_testlib_"):
+            setattr(new, name, value)
+    return new
+
+def _rerun_test(test, max_reruns, fixtures=None, release=True):
+    """Rerun the given test case until it passes, at most "max_reruns"
+    times.
+
+    The test is run in its own suite, so that class and module fixtures
+    are set up (and torn down) again. The test's `uses()` fixtures are
+    released (see `FixtureManager.stop_test()`) after the last rerun, if
+    "release" is true. Returns a 2-tuple:
+        (<number of reruns>, <passed>)
+    """
+    passed = False
+    for num_reruns in range(1, max_reruns + 1):
+        result = unittest.TestResult()
+        if fixtures is not None:
+            fixtures.start_test(test)
+        try:
+            unittest.TestSuite([test]).run(result)
+        finally:
+            if fixtures is not None:
+                fixtures.stop_test(test, release=False)
+        if result.wasSuccessful():
+            passed = True
+            break
+    if fixtures is not None and release:
+        fixtures.stop_test(test)
+    return num_reruns, passed
+
+def _is_subtest(test):
+    """Return true if the given test is a `TestCase.subTest()` instance."""
+    return hasattr(test, "_subDescription")
+
+def _relpath(path):
+    """Return the given path relative to the current dir, if it is under
+    it, else the absolute path.
+    """
+    relpath = os.path.relpath(path)
+    if relpath.startswith(os.pardir):
+        return abspath(path)
+    return relpath
+
 # Recipe: indent (0.2.1)
 def _indent(s, width=4, skip_first_line=False):
     """_indent(s, [width=4]) -> 's' indented by 'width' spaces
@@ -624,12 +4418,20 @@ def _indent(s, width=4, skip_first_line=False):
 #    return opts, raw_tags
 
 def _parse_opts(args, default_tags):
-    """_parse_opts(args) -> (log_level, action, tags)"""
-    opts, raw_tags = getopt.getopt(args, "hvqdlL:n",
-        ["help", "verbose", "quiet", "debug", "list", "no-default-tags"])
+    """_parse_opts(args) -> (log_level, action, tags, test_opts)
+
+    "test_opts" is a dict of keyword arguments for `test()`.
+    """
+    opts, raw_tags = getopt.getopt(args, "hvqdlL:nx",
+        ["help", "verbose", "quiet", "debug", "list", "no-default-tags",
+         "threads=", "order=", "import-times", "watch", "serve=",
+         "connect=", "maxfail=", "rerun-failures=", "leak-check=",
+         "progress", "budget=", "coverage", "covering=", "update-golden",
+         "isolate-timing"])
     log_level = logging.WARN
     action = "test"
     no_default_tags = False
+    test_opts = {}
     for opt, optarg in opts:
         if opt in ("-h", "--help"):
             action = "help"
@@ -643,6 +4445,50 @@ def _parse_opts(args, default_tags):
             action = "list"
         elif opt in ("-n", "--no-default-tags"):
             no_default_tags = True
+        elif opt == "--threads":
+            test_opts["num_threads"] = _int_from_optarg(opt, optarg)
+        elif opt == "-x":
+            test_opts["maxfail"] = 1
+        elif opt == "--maxfail":
+            test_opts["maxfail"] = _int_from_optarg(opt, optarg)
+            if test_opts["maxfail"] < 1:
+                raise TestError("invalid '--maxfail' value, expected a "
+                                "positive integer: %r" % optarg)
+        elif opt == "--rerun-failures":
+            test_opts["rerun_failures"] = _int_from_optarg(opt, optarg)
+        elif opt == "--leak-check":
+            if optarg not in ("report", "fail"):
+                raise TestError("invalid '--leak-check' value, expected "
+                                "'report' or 'fail': %r" % optarg)
+            test_opts["leak_check"] = optarg
+        elif opt == "--budget":
+            try:
+                test_opts["budget"] = float(optarg)
+            except ValueError:
+                raise TestError("invalid '--budget' value, expected a "
+                                "number of seconds: %r" % optarg)
+        elif opt == "--update-golden":
+            test_opts["update_golden"] = True
+        elif opt == "--coverage":
+            test_opts["coverage"] = True
+        elif opt == "--covering":
+            test_opts.setdefault("covering", []).append(optarg)
+        elif opt == "--progress":
+            test_opts["progress"] = True
+        elif opt == "--isolate-timing":
+            test_opts["isolate_timing"] = True
+        elif opt == "--watch":
+            action = "watch"
+        elif opt in ("--serve", "--connect"):
+            action = opt[2:]
+            test_opts["socket_path"] = optarg
+        elif opt == "--import-times":
+            test_opts["import_times"] = True
+        elif opt == "--order":
+            if optarg not in ("module", "cost"):
+                raise TestError("invalid '--order' value, expected "
+                                "'module' or 'cost': %r" % optarg)
+            test_opts["order"] = optarg
         elif opt == "-L":
             # Optarg is of the form '<logname>:<levelname>', e.g.
             # "codeintel:DEBUG", "codeintel.db:INFO".
@@ -651,28 +4497,41 @@ def _parse_opts(args, default_tags):
             logging.getLogger(lname).setLevel(llevel)
 
     # Clean up the given tags.
-    if no_default_tags:
-        tags = []
-    else:
-        tags = default_tags
+    tags = []
     for raw_tag in raw_tags:
         if splitext(raw_tag)[1] in (".py", ".pyc", ".pyo", ".pyw") \
            and exists(raw_tag):
             # Trim '.py' from user-supplied tags if it looks to be from
             # shell expansion.
             tags.append(splitext(raw_tag)[0])
-        elif '/' in raw_tag:
+        elif '/' in raw_tag and not raw_tag.startswith("re:"):
             # Split one '/' to allow the shortname from the test listing
             # to be used as a filter.
             tags += raw_tag.split('/')
         else:
             tags.append(raw_tag)
+    if default_tags and not no_default_tags:
+        if tags:
+            tags = ['('] + default_tags + [')', "and", '('] + tags + [')']
+        else:
+            tags = default_tags
+    tags = TagExpr(tags)
 
-    return log_level, action, tags
+    return log_level, action, tags, test_opts
+
+def _int_from_optarg(opt, optarg):
+    try:
+        return int(optarg)
+    except ValueError:
+        raise TestError("invalid '%s' value, expected an integer: %r"
+                        % (opt, optarg))
 
 
 def harness(testdir_from_ns={None: os.curdir}, argv=sys.argv,
-            setup_func=None, default_tags=None):
+            setup_func=None, default_tags=None,
+            history_path=".testlib-history.json",
+            recursive=False, includes=None, excludes=None,
+            coverage_path=".testlib-coverage.json", budget=None):
     """Convenience mainline for a test harness "test.py" script.
 
         "testdir_from_ns" (optional) is basically a set of directories in
@@ -686,6 +4545,21 @@ def harness(testdir_from_ns={None: os.curdir}, argv=sys.argv,
             before any tests are run to prepare for the test suite. It
             is not called if no tests will be run.
         "default_tags" (optional)
+        "history_path" (optional) is the path to a file in which per-test
+            data (e.g. durations and failures) is recorded across test
+            runs, for "--order cost", "--budget" and "--progress". Pass
+            None to not record history.
+        "coverage_path" (optional) is the path to the file in which the
+            lines executed by each test are recorded by "--coverage" runs
+            (see `CoverageMap`).
+        "recursive" (optional, default False) can be set true to also
+            gather tests from all subdirs of the given test dirs. Each
+            subdir becomes a sub-namespace, e.g. "foo/unit/parser". See
+            `recursive_testdir_from_ns()` for the "includes" and "excludes"
+            glob pattern lists. (These are only set here, in the harness
+            script: there are no command-line options for them.)
+        "budget" (optional) is a default time budget in seconds for test
+            runs, as for the "--budget" option (which overrides it).
     
     Typically, if you have a number of test_*.py modules you can create
     a test harness, "test.py", for them that looks like this:
@@ -698,24 +4572,56 @@ def harness(testdir_from_ns={None: os.curdir}, argv=sys.argv,
     if not logging.root.handlers:
         logging.basicConfig()
     try:
-        log_level, action, tags = _parse_opts(argv[1:], default_tags or [])
+        log_level, action, tags, test_opts \
+            = _parse_opts(argv[1:], default_tags or [])
     except getopt.error:
         _, ex, _ = sys.exc_info()
         log.error(str(ex) + " (did you need a '--' before a '-TAG' argument?)")
         return 1
+    except TestError:
+        _, ex, _ = sys.exc_info()
+        log.error(str(ex))
+        return 1
     log.setLevel(log_level)
+    if budget is not None:
+        test_opts.setdefault("budget", budget)
 
     if action == "help":
         print(__doc__)
         return 0
-    if action == "list":
-        return list_tests(testdir_from_ns, tags)
-    elif action == "test":
-        result = test(testdir_from_ns, tags, setup_func=setup_func)
-        if result is None:
-            return None
-        return len(result.errors) + len(result.failures)
-    else:
-        raise TestError("unexpected action/mode: '%s'" % action)
+    if recursive:
+        testdir_from_ns = recursive_testdir_from_ns(testdir_from_ns,
+                                                    includes, excludes)
+    try:
+        if action == "list":
+            return list_tests(testdir_from_ns, tags)
+        elif action == "test":
+            result = test(testdir_from_ns, tags, setup_func=setup_func,
+                          history_path=history_path,
+                          coverage_path=coverage_path, **test_opts)
+            if result is None:
+                return None
+            return result.failureCount()
+        elif action == "watch":
+            return watch(testdir_from_ns, tags, setup_func=setup_func,
+                         history_path=history_path,
+                         coverage_path=coverage_path, **test_opts)
+        elif action == "serve":
+            serve(testdir_from_ns, test_opts.pop("socket_path"),
+                  setup_func=setup_func, history_path=history_path,
+                  coverage_path=coverage_path,
+                  **test_opts)
+            return 0
+        elif action == "connect":
+            try:
+                return connect(test_opts["socket_path"], tags)
+            except TestError:
+                _, ex, _ = sys.exc_info()
+                log.error(str(ex))
+                return 1
+        else:
+            raise TestError("unexpected action/mode: '%s'" % action)
+    finally:
+        release_shared_data()
 
 
@@ -24,17 +24,18 @@ setup(name='testlib',
         Intended Audience :: Developers
         License :: OSI Approved :: MIT License
         Operating System :: OS Independent
-        Programming Language :: Python :: 2
-        Programming Language :: Python :: 2.4
-        Programming Language :: Python :: 2.5
-        Programming Language :: Python :: 2.6
-        Programming Language :: Python :: 2.7
         Programming Language :: Python :: 3
-        Programming Language :: Python :: 3.1
+        Programming Language :: Python :: 3 :: Only
+        Programming Language :: Python :: 3.9
+        Programming Language :: Python :: 3.10
+        Programming Language :: Python :: 3.11
+        Programming Language :: Python :: 3.12
+        Programming Language :: Python :: 3.13
         Topic :: Software Development :: Libraries :: Python Modules
         Topic :: Software Development :: Testing
         """.split('\n') if c.strip()],
     keywords='test unittest harness driver',
+    python_requires='>=3.9',
     author='Trent Mick',
     author_email='trentm@gmail.com',
     maintainer='Trent Mick',
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# Copyright (c) 2010 ActiveState Software Inc.
+# License: MIT (http://www.opensource.org/licenses/mit-license.php)
+
+"""Benchmark testlib's own overhead on a synthetic test tree.
+
+Usage:
+    python bench.py [OPTIONS...]
+
+This generates a test tree (in a temp dir) of a number of namespaces,
+each with a number of test modules with deep tag lists, some of which
+use a "test_cases()" hook. Then it times (and reports tests/sec for):
+
+    discover    `tests_from_manifest()` (with the test modules' bytecode
+                cached by the first run)
+    filter      `tests_from_manifest_and_tags()` with a tag expression
+    list        `list_tests()` (output is discarded)
+    run         `ConsoleTestRunner.run()` of all tests (which do nothing)
+
+and the memory allocated per discovered test (using tracemalloc).
+"""
+
+import os
+from os.path import join, abspath, dirname
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import tracemalloc
+import unittest
+import contextlib
+import logging
+
+log = logging.getLogger("bench")
+
+
+def setup():
+    top_dir = dirname(dirname(abspath(__file__)))
+    lib_dir = join(top_dir, "lib")
+    sys.path.insert(0, lib_dir)
+
+
+#---- test tree generation
+
+_testmod_template = '''\
+import unittest
+__tags__ = %(tags)r
+
+%(classes)s
+'''
+
+_testcase_template = '''\
+class %(name)s(unittest.TestCase):
+%(methods)s
+'''
+
+_hook_testmod_template = '''\
+import unittest
+__tags__ = %(tags)r
+
+def test_cases():
+    for i in range(%(num_classes)d):
+        attrs = dict(("test_%%d" %% j, lambda self: None)
+                     for j in range(%(num_tests)d))
+        yield type("Hook%%dTestCase" %% i, (unittest.TestCase,), attrs)
+'''
+
+def gen_test_tree(base_dir, num_namespaces, num_modules, num_classes,
+                  num_tests, num_tags, hook_every=4):
+    """Generate a synthetic test tree and return its "testdir_from_ns"."""
+    testdir_from_ns = {}
+    for n in range(num_namespaces):
+        ns = "ns%d" % n
+        testdir = join(base_dir, ns)
+        os.makedirs(testdir)
+        testdir_from_ns[ns] = testdir
+        for m in range(num_modules):
+            tags = ["tag%d" % ((m + t) % (num_tags * 2))
+                    for t in range(num_tags)]
+            if hook_every and m % hook_every == hook_every - 1:
+                content = _hook_testmod_template % {
+                    "tags": tags, "num_classes": num_classes,
+                    "num_tests": num_tests}
+            else:
+                classes = []
+                for c in range(num_classes):
+                    methods = "".join("    def test_%d(self):\n"
+                                      "        pass\n" % t
+                                      for t in range(num_tests))
+                    classes.append(_testcase_template % {
+                        "name": "Class%dTestCase" % c, "methods": methods})
+                content = _testmod_template % {
+                    "tags": tags, "classes": "\n".join(classes)}
+            f = open(join(testdir, "test_mod%04d.py" % m), 'w')
+            try:
+                f.write(content)
+            finally:
+                f.close()
+    return testdir_from_ns
+
+
+#---- benchmarks
+
+def _timed(func, repeat):
+    """Return the best time of "repeat" calls of func, and its result."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        retval = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, retval
+
+def bench(testdir_from_ns, tags, repeat=3, stream=sys.stdout):
+    import testlib
+
+    # Import once, to write the test modules' bytecode caches.
+    tests = list(testlib.tests_from_manifest(testdir_from_ns))
+    num_tests = len(tests)
+    del tests
+
+    tracemalloc.start()
+    tests = list(testlib.tests_from_manifest(testdir_from_ns))
+    mem_size, mem_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tests
+
+    results = []
+    def report(name, elapsed, count):
+        results.append((name, elapsed, count))
+        stream.write("%-10s %9.3fs %12.0f tests/s\n"
+                     % (name, elapsed, count / elapsed))
+        stream.flush()
+
+    elapsed, tests = _timed(
+        lambda: list(testlib.tests_from_manifest(testdir_from_ns)), repeat)
+    report("discover", elapsed, len(tests))
+
+    elapsed, filtered = _timed(
+        lambda: list(testlib.tests_from_manifest_and_tags(
+            testdir_from_ns, tags)), repeat)
+    report("filter", elapsed, num_tests)
+
+    devnull = open(os.devnull, 'w')
+    try:
+        def list_all():
+            with contextlib.redirect_stdout(devnull):
+                testlib.list_tests(testdir_from_ns, tags)
+        elapsed, _ = _timed(list_all, repeat)
+        report("list", elapsed, num_tests)
+
+        def run_all():
+            suite = unittest.TestSuite(t.testcase for t in tests)
+            runner = testlib.ConsoleTestRunner(devnull)
+            return runner.run(suite)
+        elapsed, result = _timed(run_all, repeat)
+        report("run", elapsed, result.testsRun)
+    finally:
+        devnull.close()
+
+    stream.write("\n%d tests (%d selected by %s), %.0f bytes/test "
+                 "(peak %.0f bytes/test)\n"
+                 % (num_tests, len(filtered), ' '.join(tags),
+                    float(mem_size) / num_tests,
+                    float(mem_peak) / num_tests))
+    return results
+
+
+#---- mainline
+
+def main(argv):
+    parser = optparse.OptionParser(prog="bench", usage="%prog [OPTIONS...]",
+                                   description=__doc__.splitlines()[0])
+    parser.add_option("--namespaces", type="int", default=4,
+                      help="number of namespaces (default 4)")
+    parser.add_option("--modules", type="int", default=250,
+                      help="number of test modules per namespace "
+                           "(default 250)")
+    parser.add_option("--classes", type="int", default=2,
+                      help="number of TestCase classes per module "
+                           "(default 2)")
+    parser.add_option("--tests", type="int", default=5,
+                      help="number of tests per class (default 5)")
+    parser.add_option("--tags", type="int", default=20,
+                      help="number of tags per module (default 20)")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="number of timed runs of each benchmark, the "
+                           "best is reported (default 3)")
+    parser.add_option("-k", "--keep", action="store_true",
+                      help="keep the generated test tree")
+    opts, args = parser.parse_args(argv[1:])
+    tags = args or ["tag1", "and", "not", "tag3"]
+
+    base_dir = tempfile.mkdtemp(prefix="testlib-bench-")
+    try:
+        testdir_from_ns = gen_test_tree(base_dir, opts.namespaces,
+            opts.modules, opts.classes, opts.tests, opts.tags)
+        bench(testdir_from_ns, tags, repeat=opts.repeat)
+    finally:
+        if opts.keep:
+            log.warn("test tree kept in '%s'", base_dir)
+        else:
+            shutil.rmtree(base_dir)
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    setup()
+    sys.exit(main(sys.argv))
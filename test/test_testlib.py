@@ -6,27 +6,1421 @@
 
 import os
 import sys
-from os.path import join, dirname, abspath, exists, splitext, basename
+from os.path import join, dirname, abspath, exists, splitext, basename, \
+    normpath
 import re
 from glob import glob
 from pprint import pprint
 import unittest
 import codecs
+import contextlib
+import io
 import difflib
 import doctest
+import gc
+import shutil
+import signal
+import stat
+import tempfile
+import time
+import textwrap
+import threading
+import array
+import subprocess
 
+import testlib
 from testlib import TestError, TestSkipped, tag
 
-class DocTestsTestCase(unittest.TestCase):
-    def test_api(self):
-        if sys.version_info[:2] < (2,4):
-            raise TestSkipped("no DocFileTest in Python <=2.3")
-        test = doctest.DocFileTest("api.doctests")
-        test.runTest()
 
+class _TestdirMixin(object):
+    """Support for tests that need a scratch test dir with test modules."""
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp(prefix="testlib-test-")
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+    def _write(self, relpath, content):
+        path = join(self.testdir, relpath)
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+        f = open(path, 'w')
+        try:
+            f.write(textwrap.dedent(content))
+        finally:
+            f.close()
+        return path
+
+def _named_testcase(testcase_class, method_name, shortname):
+    """Return a test case with the testlib attributes that a test gathered
+    by the harness has (as used by ConsoleTestResult).
+    """
+    testcase = testcase_class(method_name)
+    testcase._testlib_shortname_ = shortname
+    testcase._testlib_explicit_tags_ = []
+    return testcase
+
+def _apply_golden_diff(a_lines, diff):
+    """Apply the hunks of the given `_golden_diff()` output to the given
+    lines, checking their context. Returns a 2-tuple:
+        (<patched lines>, <whether the diff is complete>)
+    """
+    lines = diff.splitlines(True)[2:]
+    out = []
+    pos = i = 0
+    while i < len(lines):
+        if lines[i].startswith("("):   # more differences not shown
+            return out + a_lines[pos:], False
+        m = re.match(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@$",
+                     lines[i])
+        a_start, a_len, b_start, b_len \
+            = [int(n or 1) for n in m.group(1, 2, 3, 4)]
+        # As in `difflib.unified_diff()`: empty ranges start a line early.
+        a_start -= bool(a_len)
+        b_start -= bool(b_len)
+        assert a_start >= pos
+        out += a_lines[pos:a_start]
+        pos = a_start
+        assert len(out) == b_start
+        i += 1
+        while i < len(lines) and lines[i][0] in " -+":
+            kind, text = lines[i][0], lines[i][1:]
+            i += 1
+            if i < len(lines) and lines[i].startswith("\\ No newline"):
+                text = text[:-1]
+                i += 1
+            if kind != "+":
+                assert a_lines[pos] == text
+                pos += 1
+                a_len -= 1
+            if kind != "-":
+                out.append(text)
+                b_len -= 1
+        assert a_len == b_len == 0
+    return out + a_lines[pos:], True
+
+class DocTestsTestCase(unittest.TestCase):
+    # "api.doctests" is gathered by the harness itself (see `DocTestsTest`).
     def test_internal(self):
         import testlib
         doctest.testmod(testlib)
 
+class DocTestsBlocksTestCase(_TestdirMixin, unittest.TestCase):
+    def setUp(self):
+        _TestdirMixin.setUp(self)
+        self._write("foo.doctests", """
+            Set up:
+
+            >>> x = 1
+
+            Then check it:
+
+            >>> x + 1
+            3
+
+            And again:
+
+            >>> x
+            1
+            """)
+
+    def _run(self, tests):
+        result = unittest.TestResult()
+        unittest.TestSuite([t.testcase for t in tests]).run(result)
+        return result
+
+    def test_blocks(self):
+        tests = list(testlib.tests_from_manifest({"dt": self.testdir}))
+        self.assertEqual([t.shortname() for t in tests],
+            ["dt/foo/doctests/block1", "dt/foo/doctests/block2",
+             "dt/foo/doctests/block3"])
+        tags = tests[1].tags()
+        self.assertTrue("block2" in tags)
+        self.assertTrue("doctests" in tags)
+        self.assertFalse("2" in tags)
+
+    def test_failing_block(self):
+        tests = list(testlib.tests_from_manifest({"dt": self.testdir}))
+        result = self._run(tests)
+        self.assertEqual(result.testsRun, 3)
+        self.assertEqual(len(result.failures), 1)
+        testcase, report = result.failures[0]
+        self.assertTrue(testcase is tests[1].testcase)
+        self.assertTrue("x + 1" in report)
+        self.assertFalse(">>> x\n" in report)
+
+    def test_select_later_block(self):
+        tests = list(testlib.tests_from_manifest_and_tags(
+            {"dt": self.testdir}, ["block3"]))
+        self.assertEqual([t.shortname() for t in tests],
+                         ["dt/foo/doctests/block3"])
+        # Block 1 (defining "x") is run quietly first.
+        result = self._run(tests)
+        self.assertTrue(result.wasSuccessful())
+
+    def test_module_docstring(self):
+        self._write("test_doc.py", '''
+            """Examples.
+
+            >>> double(2)
+            4
+            """
+            __doctests__ = True
+            def double(n):
+                return n * 2
+            ''')
+        tests = [t for t in testlib.tests_from_manifest({"dt": self.testdir})
+                 if t.testmod_name() == "test_doc"]
+        self.assertEqual([t.shortname() for t in tests],
+                         ["dt/doc/docstring/block1"])
+        self.assertTrue("docstring" in tests[0].tags())
+        self.assertTrue(self._run(tests).wasSuccessful())
+
+    def test_concurrent_module_docstring(self):
+        self._write("test_conc.py", '''
+            """Examples.
+
+            >>> x = 1
+
+            Then:
+
+            >>> x += 1
+
+            And:
+
+            >>> x
+            2
+            """
+            import unittest
+            __doctests__ = True
+            __tags__ = ["concurrent"]
+            class ATestCase(unittest.TestCase):
+                def test_a(self): pass
+            ''')
+        tests = [t for t in testlib.tests_from_manifest({"dt": self.testdir})
+                 if t.testmod_name() == "test_conc"]
+        self.assertEqual(len(tests), 4)
+        # The doctest blocks are not run in the thread pool.
+        suite = testlib._suite_from_tests(tests, num_threads=4)
+        self.assertEqual(
+            [(type(s).__name__, s.countTestCases()) for s in suite],
+            [("ThreadedTestSuite", 1), ("TestSuite", 3)])
+        result = testlib.ConsoleTestResult(io.StringIO())
+        suite.run(result)
+        self.assertTrue(result.wasSuccessful())
+
+class FixturesTestCase(_TestdirMixin, unittest.TestCase):
+    def test_lazy_and_torn_down_after_last_user(self):
+        self._write("test_fx.py", """
+            import unittest
+            import testlib
+            events = []
+            @testlib.fixture(scope="module")
+            def fx_res():
+                events.append("build res")
+                yield 42
+                events.append("teardown res")
+            @testlib.fixture()
+            def fx_unused():
+                events.append("build unused")
+            class ATestCase(unittest.TestCase):
+                __fixtures__ = ["fx_res"]
+                def test_a(self):
+                    events.append(testlib.fixture_value("fx_res"))
+                def test_b(self):
+                    events.append(testlib.fixture_value("fx_res"))
+                @testlib.tag("slow")
+                @testlib.uses("fx_unused")
+                def test_c(self):
+                    testlib.fixture_value("fx_unused")
+            class BTestCase(unittest.TestCase):
+                def test_d(self):
+                    events.append("d")
+            """)
+        tests = list(testlib.tests_from_manifest_and_tags(
+            {None: self.testdir}, ["-slow"]))
+        result = self._run(tests)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(tests[0].testmod.events,
+                         ["build res", 42, 42, "teardown res", "d"])
+
+    def test_same_name_in_two_modules(self):
+        for name in ("a", "b"):
+            self._write("test_%s.py" % name, """
+                import unittest
+                import testlib
+                values = []
+                @testlib.fixture(scope="module")
+                def fx_same():
+                    return %r
+                class ATestCase(unittest.TestCase):
+                    __fixtures__ = ["fx_same"]
+                    def test_a(self):
+                        values.append(testlib.fixture_value("fx_same"))
+                """ % name)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        result = self._run(tests)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual([t.testmod.values for t in tests], [["a"], ["b"]])
+
+    def test_kept_for_rerun(self):
+        # Events are logged to a file, as reruns may be in a child process.
+        self._write("test_fx.py", """
+            import os
+            import unittest
+            import testlib
+            log_path = os.path.join(os.path.dirname(__file__), "log")
+            def log(event):
+                with open(log_path, "a") as f:
+                    f.write(event + "\\n")
+            @testlib.fixture(scope="module")
+            def fx_res():
+                log("setup")
+                yield
+                log("teardown")
+            class ATestCase(unittest.TestCase):
+                __fixtures__ = ["fx_res"]
+                def test_a(self):
+                    testlib.fixture_value("fx_res")
+                    with open(log_path) as f:
+                        first = "a" not in f.read().split()
+                    log("a")
+                    self.assertFalse(first)
+                def test_b(self):
+                    testlib.fixture_value("fx_res")
+                    log("b")
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        manager = testlib.FixtureManager(tests)
+        runner = testlib.ConsoleTestRunner(io.StringIO(), fixtures=manager,
+                                           rerun_failures=1)
+        testlib._fixture_manager = manager
+        try:
+            result = runner.run(
+                unittest.TestSuite([t.testcase for t in tests]))
+        finally:
+            testlib._fixture_manager = None
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(result.reruns, {"fx/a/a": (1, True)})
+        with open(join(self.testdir, "log")) as f:
+            self.assertEqual(f.read().split(),
+                             ["setup", "a", "b", "a", "teardown"])
+
+    def _run(self, tests):
+        suite = unittest.TestSuite([t.testcase for t in tests])
+        manager = testlib.FixtureManager(tests)
+        result = testlib.ConsoleTestResult(io.StringIO())
+        result.fixtures = testlib._fixture_manager = manager
+        try:
+            suite.run(result)
+        finally:
+            testlib._fixture_manager = None
+            manager.teardown_all()
+        return result
+
+class OrderedTestsTestCase(_TestdirMixin, unittest.TestCase):
+    def test_classes_are_grouped(self):
+        self._write("test_ord.py", """
+            import unittest
+            class ATestCase(unittest.TestCase):
+                def test_a(self): pass
+            class BTestCase(unittest.TestCase):
+                def test_b(self): pass
+            def test_cases():
+                yield ATestCase
+                yield BTestCase
+                yield ATestCase
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        self.assertEqual([t.shortname() for t in tests],
+                         ["ord/a/a", "ord/b/b", "ord/a/a"])
+        self.assertEqual(
+            [t.shortname() for t in testlib.ordered_tests(tests)],
+            ["ord/a/a", "ord/a/a", "ord/b/b"])
+
+    def test_cost_order(self):
+        self._write("test_slow.py", """
+            import unittest
+            class ATestCase(unittest.TestCase):
+                def test_a(self): pass
+                def test_b(self): pass
+            class BTestCase(unittest.TestCase):
+                def test_c(self): pass
+            """)
+        self._write("test_fast.py", """
+            import unittest
+            class CTestCase(unittest.TestCase):
+                def test_d(self): pass
+                def test_e(self): pass
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        history = testlib.TestHistory(join(self.testdir, "history.json"))
+        for shortname, duration in [("slow/a/a", 2.0), ("slow/a/b", 1.0),
+                                    ("slow/b/c", 0.5), ("fast/c/d", 0.1)]:
+            history.data_from_shortname[shortname] = {"duration": duration}
+        # "fast/c/e" has no recorded duration: it costs the mean (0.9).
+        self.assertEqual(
+            [t.shortname() for t in
+             testlib.ordered_tests(tests, "cost", history)],
+            ["fast/c/d", "fast/c/e", "slow/b/c", "slow/a/a", "slow/a/b"])
+
+class ImportTestModulesTestCase(_TestdirMixin, unittest.TestCase):
+    def setUp(self):
+        _TestdirMixin.setUp(self)
+        self._write("test_ok.py", """
+            import unittest
+            class OkTestCase(unittest.TestCase):
+                def test_ok(self): pass
+            """)
+        self._write("test_pkg/__init__.py", """
+            from test_pkg.helpers import PkgTestCase
+            """)
+        self._write("test_pkg/helpers.py", """
+            import unittest
+            class PkgTestCase(unittest.TestCase):
+                def test_pkg(self): pass
+            """)
+        self._write("test_broken.py", """
+            raise ImportError("no such thing")
+            """)
+        self._write("test_skipped.py", """
+            from testlib import TestSkipped
+            raise TestSkipped("not on this platform")
+            """)
+
+    def tearDown(self):
+        for name in list(sys.modules):
+            if name.startswith("_testlib_impns__") \
+               or name.startswith("test_pkg"):
+                del sys.modules[name]
+        _TestdirMixin.tearDown(self)
+
+    def test_names_and_errors(self):
+        old_path = sys.path[:]
+        old_dir = os.getcwd()
+        import_time_from_path = {}
+        with self.assertLogs("test", "WARNING") as logs:
+            testmods = list(testlib.testmods_from_testdir(
+                self.testdir, "impns", import_time_from_path))
+        self.assertEqual([m.__name__ for m in testmods],
+                         ["_testlib_impns__test_ok",
+                          "_testlib_impns__test_pkg"])
+        self.assertEqual([m._testlib_name_ for m in testmods],
+                         ["test_ok", "test_pkg"])
+        self.assertEqual(testmods[1].PkgTestCase.__module__,
+                         "test_pkg.helpers")
+        self.assertFalse("_testlib_impns__test_broken" in sys.modules)
+        self.assertFalse("_testlib_impns__test_skipped" in sys.modules)
+        self.assertEqual(len(logs.output), 2)
+        self.assertTrue("could not import test module" in logs.output[0])
+        self.assertTrue("not on this platform" in logs.output[1])
+        self.assertEqual(sys.path, old_path)
+        self.assertEqual(os.getcwd(), old_dir)
+        self.assertEqual(
+            sorted(basename(p) for p in import_time_from_path),
+            ["test_broken.py", "test_ok.py", "test_pkg", "test_skipped.py"])
+
+    def test_import_times(self):
+        stream = io.StringIO()
+        with self.assertLogs("test", "WARNING"), \
+             contextlib.redirect_stdout(stream):
+            testlib.test({"impns": self.testdir}, import_times=True)
+        output = stream.getvalue()
+        self.assertTrue("Ran 2 tests" in output)
+        self.assertTrue("Test module import times (slowest first):"
+                        in output)
+        self.assertEqual(len(re.findall(r"^ +\d+\.\d{3}s  ", output, re.M)),
+                         5)
+
+class TagExprTestCase(unittest.TestCase):
+    def test_regex_in_parens(self):
+        win = frozenset(["win32"])
+        self.assertTrue(testlib.TagExpr(["(re:^win)"]).matches(win))
+        expr = testlib.TagExpr(["(re:^(win|mac)[)]?", "or", "x)", "-slow"])
+        self.assertTrue(expr.matches(win))
+        self.assertTrue(expr.matches(frozenset(["x"])))
+        self.assertFalse(expr.matches(frozenset(["mac", "slow"])))
+        self.assertFalse(testlib.TagExpr(["-re:^(a|b)c"]).matches(
+            frozenset(["bc"])))
+        self.assertRaises(TestError, testlib.TagExpr, ["(re:(a)"])
+
+    def test_operator_named_tags(self):
+        self.assertTrue(testlib.TagExpr(["tag:and"]).matches(
+            frozenset(["and"])))
+        self.assertFalse(testlib.TagExpr(["foo", "-tag:not"]).matches(
+            frozenset(["foo", "not"])))
+
+class ThreadedTestSuiteTestCase(_TestdirMixin, unittest.TestCase):
+    def test_replayed_in_order_with_fixtures(self):
+        self._write("test_conc.py", """
+            import threading
+            import time
+            import unittest
+            __tags__ = ["concurrent"]
+            events = []
+            def setUpModule():
+                events.append("setUpModule")
+            def tearDownModule():
+                events.append("tearDownModule")
+            class ATestCase(unittest.TestCase):
+                @classmethod
+                def setUpClass(cls):
+                    events.append("setUpClass A")
+                @classmethod
+                def tearDownClass(cls):
+                    events.append("tearDownClass A")
+                def test_1(self):
+                    time.sleep(0.05)
+                    events.append(threading.current_thread().name)
+                def test_2(self):
+                    events.append(threading.current_thread().name)
+                def test_3(self):
+                    self.fail("boom")
+            class BTestCase(unittest.TestCase):
+                @classmethod
+                def setUpClass(cls):
+                    events.append("setUpClass B")
+                @classmethod
+                def tearDownClass(cls):
+                    events.append("tearDownClass B")
+                def test_4(self):
+                    pass
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        testmod = tests[0].testmod
+        stream = io.StringIO()
+        with contextlib.redirect_stdout(stream):
+            result = testlib.run_tests(tests, num_threads=3)
+        self.assertEqual(result.testsRun, 4)
+        self.assertEqual([r.description for r, _ in result.failures],
+                         ["conc/a/3 [concurrent]"])
+        self.assertEqual(re.findall(r"^(conc/\w+/\d) \S+ \.\.\. (\w+)",
+                                    stream.getvalue(), re.M),
+                         [("conc/a/1", "ok"), ("conc/a/2", "ok"),
+                          ("conc/a/3", "FAIL"), ("conc/b/4", "ok")])
+        events = testmod.events
+        self.assertEqual(events[0:2], ["setUpModule", "setUpClass A"])
+        self.assertTrue(all(e.startswith("worker") for e in events[2:4]))
+        self.assertEqual(events[4:], ["tearDownClass A", "setUpClass B",
+                                      "tearDownClass B", "tearDownModule"])
+
+class RecursiveTestdirTestCase(_TestdirMixin, unittest.TestCase):
+    def test_sub_namespaces(self):
+        test_src = """
+            import unittest
+            class FooTestCase(unittest.TestCase):
+                def test_foo(self): pass
+            """
+        self._write("test_top.py", test_src)
+        self._write("unit/parser/test_parse.py", test_src)
+        self._write("unit/fixtures/test_data.py", test_src)
+        self._write("unit/empty/README", "")
+        testdir_from_ns = testlib.recursive_testdir_from_ns(
+            {"t": self.testdir}, excludes=["fixtures"])
+        self.assertEqual(sorted(testdir_from_ns), ["t", "t/unit/parser"])
+        tests = testlib.tests_from_manifest(testdir_from_ns)
+        self.assertEqual(sorted(t.shortname() for t in tests),
+                         ["t/top/foo/foo", "t/unit/parser/parse/foo/foo"])
+
+    def test_symlink_loop(self):
+        if not hasattr(os, "symlink"):
+            raise TestSkipped("no symlinks on this platform")
+        self._write("sub/test_sub.py", """
+            import unittest
+            class FooTestCase(unittest.TestCase):
+                def test_foo(self): pass
+            """)
+        os.symlink("..", join(self.testdir, "sub", "loop"))
+        os.symlink("nowhere", join(self.testdir, "sub", "dangling"))
+        testdir_from_ns = testlib.recursive_testdir_from_ns(
+            {"t": self.testdir})
+        self.assertEqual(sorted(testdir_from_ns), ["t", "t/sub"])
+
+class ParamsTestCase(_TestdirMixin, unittest.TestCase):
+    def test_cases_are_lazy_tests(self):
+        self._write("cases.jsonl", """
+            {"a": 1, "b": 1, "_name": "one"}
+            {"a": 2, "b": 3, "_tags": ["slow"]}
+            """)
+        self._write("test_p.py", """
+            import unittest
+            import testlib
+            class AddTestCase(unittest.TestCase):
+                @testlib.params([(1, 2, 3), testlib.Param((1, 1, 2),
+                                                          tags=["slow"])])
+                def test_add(self, a, b, expected):
+                    self.assertEqual(a + b, expected)
+                @testlib.params("cases.jsonl")
+                def test_eq(self, a, b):
+                    self.assertEqual(a, b)
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        self.assertEqual([t.shortname() for t in tests],
+            ["p/add/add[0]", "p/add/add[1]", "p/add/eq[one]", "p/add/eq[1]"])
+        selected = list(testlib.tests_from_manifest_and_tags(
+            {None: self.testdir}, ["-slow"]))
+        self.assertEqual([t.shortname() for t in selected],
+                         ["p/add/add[0]", "p/add/eq[one]"])
+        self.assertTrue(selected[0]._testcase is None)
+        result = unittest.TestResult()
+        unittest.TestSuite([t.testcase for t in selected]).run(result)
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(result.testsRun, 2)
+
+class SubTestsTestCase(unittest.TestCase):
+    def test_compact_reporting(self):
+        class LoopTestCase(unittest.TestCase):
+            def test_loop(self):
+                for i in range(100):
+                    with self.subTest(i=i):
+                        self.assertTrue(i % 10)
+        testcase = _named_testcase(LoopTestCase, "test_loop", "foo/loop/loop")
+        stream = io.StringIO()
+        result = testlib.ConsoleTestResult(stream)
+        result.max_subtest_failures = 3
+        testcase.run(result)
+        self.assertEqual(stream.getvalue(),
+            "foo/loop/loop ... FAIL (100 subtests, 10 failed)\n")
+        self.assertEqual(result.subtestsRun, 100)
+        self.assertEqual(len(result.failures), 3)
+        self.assertEqual(result.subtestFailuresNotShown, 7)
+        self.assertEqual(result.failureCount(), 10)
+
+    def test_no_failures_kept(self):
+        class LoopTestCase(unittest.TestCase):
+            def test_loop(self):
+                for i in range(10):
+                    with self.subTest(i=i):
+                        self.assertTrue(i % 5)
+        testcase = _named_testcase(LoopTestCase, "test_loop", "foo/loop/loop")
+        result = testlib.ConsoleTestResult(io.StringIO())
+        result.max_subtest_failures = 0
+        testcase.run(result)
+        self.assertEqual(len(result.failures), 0)
+        self.assertEqual(result.failureCount(), 2)
+        self.assertFalse(result.wasSuccessful())
+
+
+class WatchTestCase(_TestdirMixin, unittest.TestCase):
+    def test_changed_testmod_paths(self):
+        plain_path = self._write("test_plain.py", "")
+        self._write("test_pkg/__init__.py", "")
+        sub_path = self._write("test_pkg/test_sub.py", "")
+        testdir_from_ns = {None: self.testdir}
+        self.assertEqual(
+            testlib._changed_testmod_paths([sub_path], testdir_from_ns),
+            set([join(self.testdir, "test_pkg")]))
+        self.assertEqual(
+            testlib._changed_testmod_paths([plain_path], testdir_from_ns),
+            set([plain_path]))
+        self.assertEqual(testlib._changed_testmod_paths(
+            [join(dirname(self.testdir), "other.py")], testdir_from_ns),
+            set())
+
+    def test_main_not_a_project_module(self):
+        self.assertFalse(testlib._is_project_module(sys.modules["__main__"]))
+
+class ServeTestCase(_TestdirMixin, unittest.TestCase):
+    def setUp(self):
+        if not hasattr(os, "fork") or not hasattr(os, "waitid"):
+            raise TestSkipped("serving test runs requires fork (and these "
+                              "tests waitid)")
+        _TestdirMixin.setUp(self)
+        self._write("test_srv.py", r"""
+            import os
+            import sys
+            import unittest
+            class PidTestCase(unittest.TestCase):
+                def test_pid(self):
+                    pid_path = os.path.join(os.path.dirname(__file__), "pid")
+                    with open(pid_path, "w") as f:
+                        f.write("%d" % os.getpid())
+            class NulTestCase(unittest.TestCase):
+                def test_nul(self):
+                    sys.stdout.write("before\0after\n")
+            class FailTestCase(unittest.TestCase):
+                def test_fail(self):
+                    self.fail("boom")
+            """)
+        self.socket_path = join(self.testdir, "sock")
+        self.status_path = join(self.testdir, "status")
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                sys.stdout = open(os.devnull, "w")
+                # A subprocess of the setup, which has exited (but is not
+                # waited for) before the server starts.
+                procs = []
+                def setup():
+                    procs.append(subprocess.Popen(
+                        [sys.executable, "-c", "import sys; sys.exit(3)"]))
+                    os.waitid(os.P_PID, procs[0].pid,
+                              os.WEXITED | os.WNOWAIT)
+                testlib.serve({"srv": self.testdir}, self.socket_path,
+                              setup_func=setup)
+                with open(self.status_path, "w") as f:
+                    f.write("%d" % procs[0].wait())
+            finally:
+                os._exit(0)
+        for i in range(100):
+            if exists(self.socket_path):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self._stop_server()
+        _TestdirMixin.tearDown(self)
+
+    def _stop_server(self):
+        if self.pid is not None:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+    def test_socket_permissions(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode),
+                         0o600)
+
+    def test_connect(self):
+        stream = io.StringIO()
+        self.assertEqual(testlib.connect(self.socket_path, ["nul"], stream),
+                         0)
+        output = stream.getvalue()
+        self.assertTrue("before\0after\n" in output)
+        self.assertTrue("srv/srv/nul" in output)
+        stream = io.StringIO()
+        self.assertEqual(testlib.connect(self.socket_path, ["srv"], stream),
+                         1)
+        self.assertTrue("boom" in stream.getvalue())
+
+    def test_setup_subprocess_not_reaped(self):
+        stream = io.StringIO()
+        self.assertEqual(testlib.connect(self.socket_path, ["pid"], stream),
+                         0)
+        # Wait for the server to reap the request child.
+        with open(join(self.testdir, "pid")) as f:
+            pid = int(f.read())
+        for i in range(100):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            time.sleep(0.05)
+        self._stop_server()
+        with open(self.status_path) as f:
+            self.assertEqual(f.read(), "3")
+
+class MaxFailTestCase(unittest.TestCase):
+    def test_stop_after_maxfail(self):
+        class FailingTestCase(unittest.TestCase):
+            def test_a(self):
+                self.fail("a")
+            def test_b(self):
+                self.fail("b")
+            def test_c(self):
+                pass
+        suite = unittest.TestSuite()
+        for name in ("test_a", "test_b", "test_c"):
+            testcase = _named_testcase(FailingTestCase, name,
+                                       "foo/failing/" + name[5:])
+            suite.addTest(testcase)
+        stream = io.StringIO()
+        result = testlib.ConsoleTestRunner(stream, maxfail=1).run(suite)
+        self.assertEqual(result.testsRun, 1)
+        self.assertTrue(result.shouldStop)
+        self.assertTrue(stream.getvalue().endswith(
+            "FAILED (1 failure, stopped, 2 tests not run)\n"))
+
+    def test_running_threads_not_reported(self):
+        b_started = threading.Event()
+        class FailingTestCase(unittest.TestCase):
+            def test_a(self):
+                b_started.wait(5)
+                self.fail("a")
+            def test_b(self):
+                b_started.set()
+                time.sleep(0.2)
+                self.fail("b")
+        suite = testlib.ThreadedTestSuite(num_threads=2)
+        for name in ("test_a", "test_b"):
+            testcase = _named_testcase(FailingTestCase, name,
+                                       "foo/failing/" + name[5:])
+            suite.addTest(testcase)
+        stream = io.StringIO()
+        result = testlib.ConsoleTestRunner(stream, maxfail=1).run(suite)
+        self.assertEqual(result.testsRun, 1)
+        self.assertEqual(len(result.failures), 1)
+        self.assertFalse("foo/failing/b" in stream.getvalue())
+        self.assertTrue(stream.getvalue().endswith(
+            "FAILED (1 failure, stopped, 1 test not run)\n"))
+
+
+class RerunFailuresTestCase(_TestdirMixin, unittest.TestCase):
+    def test_flaky(self):
+        attempts = []
+        class FlakyTestCase(unittest.TestCase):
+            def test_flaky(self):
+                attempts.append(1)
+                self.assertTrue(len(attempts) > 1)
+        testcase = _named_testcase(FlakyTestCase, "test_flaky",
+                                   "foo/flaky/flaky")
+        stream = io.StringIO()
+        runner = testlib.ConsoleTestRunner(stream, rerun_failures=2)
+        result = runner.run(unittest.TestSuite([testcase]))
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(len(result.flaky), 1)
+        self.assertEqual(result.reruns, {"foo/flaky/flaky": (1, True)})
+        self.assertTrue(stream.getvalue().endswith("OK (1 flaky)\n"))
+
+    def test_rerun_new_instance_after_stop(self):
+        # Runs are logged to a file, as reruns may be in a child process.
+        log_path = join(tempfile.mkdtemp(prefix="testlib-test-"), "log")
+        self.addCleanup(shutil.rmtree, dirname(log_path))
+        class FlakyTestCase(unittest.TestCase):
+            def test_sub(self):
+                with open(log_path, "a") as f:
+                    f.write("%d\n" % id(self))
+                with open(log_path) as f:
+                    first = len(f.readlines()) == 1
+                for i in range(2):
+                    with self.subTest(i=i):
+                        self.assertFalse(first and i == 0)
+        testcase = _named_testcase(FlakyTestCase, "test_sub", "foo/flaky/sub")
+        stream = io.StringIO()
+        runner = testlib.ConsoleTestRunner(stream, rerun_failures=2)
+        result = runner.run(unittest.TestSuite([testcase]))
+        self.assertTrue(result.wasSuccessful())
+        self.assertEqual(result.reruns, {"foo/flaky/sub": (1, True)})
+        with open(log_path) as f:
+            ids = f.read().split()
+        self.assertEqual(len(ids), 2)
+        self.assertNotEqual(ids[0], ids[1])
+
+    def test_harness_records_history(self):
+        self._write("test_fl.py", """
+            import unittest
+            attempts = []
+            class ATestCase(unittest.TestCase):
+                def test_flaky(self):
+                    attempts.append(1)
+                    self.assertTrue(len(attempts) > 1)
+            """)
+        history_path = join(self.testdir, "history.json")
+        with contextlib.redirect_stdout(io.StringIO()), \
+             contextlib.redirect_stderr(io.StringIO()):
+            retval = testlib.harness({None: self.testdir},
+                                     ["test.py", "--rerun-failures", "1"],
+                                     history_path=history_path)
+        self.assertEqual(retval, 0)
+        data = testlib.TestHistory(history_path).data_from_shortname
+        self.assertEqual(data["fl/a/flaky"]["flaky"], 1)
+
+
+class LeakCheckTestCase(unittest.TestCase):
+    def test_leaking_test(self):
+        cache = []
+        class LeakingTestCase(unittest.TestCase):
+            def test_leak(self):
+                cache.extend([i] for i in range(2000))
+        testcase = _named_testcase(LeakingTestCase, "test_leak",
+                                   "foo/leaking/leak")
+        stream = io.StringIO()
+        result = testlib.ConsoleTestResult(stream)
+        result.leak_check = "fail"
+        result.maxfail = 1
+        testcase.run(result)
+        self.assertEqual(len(result.leaks), 1)
+        score, test, growth_from_kind, top_types = result.leaks[0]
+        self.assertTrue("objects" in growth_from_kind)
+        # Python <3.11 also has the test outcome's lists alive.
+        self.assertEqual(top_types[0][0], "list")
+        self.assertTrue(2000 <= top_types[0][1] < 2010)
+        self.assertEqual(len(result.failures), 1)
+        self.assertTrue(result.shouldStop)
+        self.assertTrue(stream.getvalue().startswith(
+            "foo/leaking/leak ... FAIL\n    leaked "))
+
+
+class ProgressReporterTestCase(_TestdirMixin, unittest.TestCase):
+    def test_plain_progress_lines(self):
+        class StubTest(object):
+            def __init__(self, shortname):
+                self._testlib_shortname_ = shortname
+            def shortname(self):
+                return self._testlib_shortname_
+        tests = [StubTest("foo/a/a"), StubTest("foo/a/b")]
+        history = testlib.TestHistory(join(self.testdir, "history.json"))
+        history.data_from_shortname = {"foo/a/a": {"duration": 1.0},
+                                       "foo/a/b": {"duration": 3.0}}
+        stream = io.StringIO()
+        progress = testlib.ProgressReporter(stream, tests, history,
+                                            interval=0)
+        progress.start_test(tests[0])
+        progress.stop_test(tests[0])
+        # Pretend the first test took half its expected duration.
+        progress._completed_time = 0.5
+        self.assertEqual(progress.eta(), 1.5)
+        lines = stream.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("progress: 0/2 tests, "))
+        self.assertTrue(lines[0].endswith(" | foo/a/a"))
+        self.assertTrue(lines[1].startswith("progress: 1/2 tests, "))
+
+
+class FailureRecordsTestCase(unittest.TestCase):
+    def test_spilled_failures(self):
+        class FailingTestCase(unittest.TestCase):
+            def test_fail(self):
+                self.fail("failure %d" % self.n)
+        result = testlib.ConsoleTestResult(io.StringIO())
+        result.failures.max_memory = 100
+        for n in range(5):
+            testcase = _named_testcase(FailingTestCase, "test_fail",
+                                       "foo/failing/fail%d" % n)
+            testcase.n = n
+            testcase.run(result)
+        self.assertEqual(len(result.failures), 5)
+        self.assertTrue(result.failures._spill_file is not None)
+        for n, (record, err) in enumerate(result.failures):
+            self.assertEqual(record.description, "foo/failing/fail%d" % n)
+            self.assertTrue(("failure %d" % n) in err)
+        self.assertEqual([r.description for r, e in result.failures[-2:]],
+                         ["foo/failing/fail3", "foo/failing/fail4"])
+        self.assertTrue("failure 4" in result.failures[-1][1])
+        combined = result.errors + result.failures + []
+        self.assertEqual(len(combined), 5)
+        self.assertEqual(combined[4], result.failures[4])
+        self.assertEqual(len([] + result.failures), 5)
+
+
+class BudgetedTestsTestCase(_TestdirMixin, unittest.TestCase):
+    def test_budget(self):
+        class StubTest(object):
+            def __init__(self, shortname, testmod):
+                self._shortname = shortname
+                self.testmod = testmod
+            def shortname(self):
+                return self._shortname
+        mod_a, mod_b = object(), object()
+        tests = [StubTest("a/x/slow", mod_a), StubTest("a/x/fast", mod_a),
+                 StubTest("a/x/failing", mod_a), StubTest("b/x/b", mod_b)]
+        now = time.time()
+        history = testlib.TestHistory(join(self.testdir, "history.json"))
+        history.data_from_shortname = {
+            "a/x/slow": {"duration": 5.0, "last_run": now},
+            "a/x/fast": {"duration": 0.1, "last_run": now},
+            "a/x/failing": {"duration": 2.0, "last_run": now,
+                            "last_failure": now},
+            "b/x/b": {"duration": 1.0, "last_run": now},
+        }
+        chosen, left_out = testlib.budgeted_tests(tests, 3.5, history)
+        self.assertEqual([t.shortname() for t in chosen],
+                         ["a/x/fast", "a/x/failing", "b/x/b"])
+        self.assertEqual([t.shortname() for t in left_out], ["a/x/slow"])
+
+    def test_harness_budget(self):
+        self._write("test_bud.py", """
+            import unittest
+            class ATestCase(unittest.TestCase):
+                def test_slow(self): pass
+                def test_fast(self): pass
+            """)
+        history_path = join(self.testdir, "history.json")
+        history = testlib.TestHistory(history_path)
+        history.data_from_shortname = {
+            "bud/a/slow": {"duration": 5.0, "last_run": time.time()},
+            "bud/a/fast": {"duration": 0.1, "last_run": time.time()},
+        }
+        history.save()
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), \
+             contextlib.redirect_stderr(io.StringIO()):
+            retval = testlib.harness({None: self.testdir}, ["test.py"],
+                                     history_path=history_path, budget=1)
+        self.assertEqual(retval, 0)
+        self.assertTrue(stdout.getvalue().startswith(
+            "Running 1 of 2 tests (estimated 0.1s of a 1s budget)"))
+
+
+class CoverageTestCase(_TestdirMixin, unittest.TestCase):
+    def test_collect_and_query(self):
+        src_path = self._write("src.py", """\
+            def f(x):
+                if x:
+                    return 1
+                return 2
+            """)
+        namespace = {}
+        with open(src_path) as f:
+            exec(compile(f.read(), src_path, "exec"), namespace)
+        class CoveredTestCase(unittest.TestCase):
+            def test_true(self):
+                namespace["f"](True)
+            def test_false(self):
+                namespace["f"](False)
+        collector = testlib.CoverageCollector()
+        collector.start()
+        try:
+            for name in ("test_true", "test_false"):
+                testcase = _named_testcase(CoveredTestCase, name,
+                                           "foo/covered/" + name[5:])
+                collector.start_test(testcase)
+                testcase.run(unittest.TestResult())
+                collector.stop_test(testcase)
+        finally:
+            collector.stop()
+        src_path = normpath(abspath(src_path))
+        self.assertEqual(
+            collector.lines_from_shortname["foo/covered/true"][src_path],
+            "2-3")
+        self.assertEqual(
+            collector.lines_from_shortname["foo/covered/false"][src_path],
+            "2,4")
+
+        map_path = join(self.testdir, "coverage.json")
+        coverage_map = testlib.CoverageMap(map_path)
+        coverage_map.update(collector.lines_from_shortname)
+        coverage_map.save()
+        coverage_map = testlib.CoverageMap(map_path)
+        self.assertEqual(coverage_map.covered_lines()[src_path],
+                         set([2, 3, 4]))
+        self.assertEqual(coverage_map.tests_covering([src_path]),
+                         set(["foo/covered/true", "foo/covered/false"]))
+        self.assertEqual(
+            coverage_map.tests_covering([], {src_path: [4]}),
+            set(["foo/covered/false"]))
+
+    def test_stop_restores_tracer(self):
+        def tracer(frame, event, arg):
+            return None
+        old_trace = sys.gettrace()
+        sys.settrace(tracer)
+        try:
+            collector = testlib.CoverageCollector()
+            collector.start()
+            collector.stop()
+            self.assertTrue(sys.gettrace() is tracer)
+        finally:
+            sys.settrace(old_trace)
+
+    def test_covering_without_map(self):
+        self.assertRaises(testlib.TestError, testlib.test,
+                          {None: self.testdir}, covering=["src.py"],
+                          coverage_path=None)
+
+class GoldenTestCase(_TestdirMixin, unittest.TestCase):
+    def test_assert_golden(self):
+        lines = ["line %d\n" % i for i in range(5000)]
+        golden_path = self._write("golden.txt", ''.join(lines))
+        testlib.assert_golden(''.join(lines), golden_path)
+
+        lines[10] = "changed\n"
+        del lines[3000]
+        actual_path = self._write("actual.txt", ''.join(lines))
+        try:
+            testlib.assert_golden_file(actual_path, golden_path)
+        except AssertionError as ex:
+            diff = str(ex).split(":\n", 1)[1]
+        else:
+            self.fail("assert_golden_file() did not fail")
+        with open(golden_path) as f:
+            expected = ''.join(difflib.unified_diff(
+                f.readlines(), lines, golden_path, actual_path))
+        self.assertEqual(diff, expected)
+
+    def _diff(self, a, b, max_regions=10, context=3):
+        return testlib._golden_diff(a.encode(), b.encode(), "a", "b",
+                                    max_regions, context)
+
+    def test_diff_applies(self):
+        import random
+        rng = random.Random(0)
+        old_window = testlib._GOLDEN_DIFF_WINDOW
+        try:
+            for n in range(500):
+                # Few distinct lines, for many equally good alignments.
+                a = [rng.choice("abc") + "\n"
+                     for i in range(rng.randint(0, 40))]
+                b = list(a)
+                for i in range(rng.randint(1, 5)):
+                    k = rng.randint(0, len(b))
+                    b[k:k + rng.randint(0, 2)] = [
+                        rng.choice("abcd") + "\n"
+                        for j in range(rng.randint(0, 2))]
+                for lines in (a, b):
+                    if lines and rng.random() < 0.2:
+                        lines[-1] = lines[-1][:-1]
+                if a == b:
+                    continue
+                testlib._GOLDEN_DIFF_WINDOW = rng.choice([3, 8, 1000])
+                diff = self._diff(''.join(a), ''.join(b), 1000,
+                                  rng.choice([0, 1, 3]))
+                patched, complete = _apply_golden_diff(a, diff)
+                if complete:
+                    self.assertEqual(patched, b)
+                else:
+                    self.assertTrue("not diffed" in diff)
+        finally:
+            testlib._GOLDEN_DIFF_WINDOW = old_window
+
+    def test_diff_repeated_lines(self):
+        self.assertEqual(self._diff("x\n" * 5, "x\n" * 6),
+                         "--- a\n+++ b\n@@ -3,3 +3,4 @@\n x\n x\n x\n+x\n")
+        self.assertEqual(self._diff("a\nx\nx\nb\n", "a\nx\nb\nx\n"),
+            "--- a\n+++ b\n@@ -1,4 +1,4 @@\n a\n x\n+b\n x\n-b\n")
+
+    def test_diff_no_newline_at_end(self):
+        self.assertEqual(self._diff("a\nb", "a\nb\n"),
+            "--- a\n+++ b\n@@ -1,2 +1,2 @@\n a\n"
+            "-b\n\\ No newline at end of file\n+b\n")
+
+    def test_diff_max_regions(self):
+        a = ''.join("%d\n" % i for i in range(100))
+        b = a.replace("\n10\n", "\nx\n").replace("\n50\n", "\ny\n") \
+             .replace("\n90\n", "\nz\n")
+        self.assertEqual(self._diff(a, b, max_regions=2, context=1),
+            "--- a\n+++ b\n"
+            "@@ -10,3 +10,3 @@\n 9\n-10\n+x\n 11\n"
+            "@@ -50,3 +50,3 @@\n 49\n-50\n+y\n 51\n"
+            "(more differences not shown)\n")
+
+    def test_update_golden(self):
+        golden_path = self._write("golden.txt", "old\n")
+        self._write("test_gold.py", """
+            import unittest
+            import testlib
+            class GoldTestCase(unittest.TestCase):
+                def test_gold(self):
+                    testlib.assert_golden("new\\n", %r)
+            """ % golden_path)
+        with contextlib.redirect_stdout(io.StringIO()), \
+             contextlib.redirect_stderr(io.StringIO()):
+            result = testlib.test({None: self.testdir}, update_golden=True)
+        self.assertTrue(result.wasSuccessful())
+        testlib.assert_golden("new\n", golden_path)
+        # Only for that run.
+        self.assertRaises(AssertionError, testlib.assert_golden, "newer\n",
+                          golden_path)
+
+class PluginTestCase(_TestdirMixin, unittest.TestCase):
+    def test_hooks(self):
+        self._write("test_a.py", """
+            import unittest
+            class ATestCase(unittest.TestCase):
+                def test_pass(self):
+                    pass
+                def test_fail(self):
+                    self.fail("boom")
+            """)
+        self._write("test_b.py", """
+            import unittest
+            class BTestCase(unittest.TestCase):
+                def test_skip(self):
+                    self.skipTest("why")
+            """)
+        events = []
+        class RecordingPlugin(testlib.Plugin):
+            def discovered(self, tests):
+                events.append(("discovered", len(tests)))
+            def module_start(self, ns, testmod_name):
+                events.append(("module_start", testmod_name))
+            def module_end(self, ns, testmod_name):
+                events.append(("module_end", testmod_name))
+            def test_result(self, testcase, outcome, err):
+                events.append((testcase._testMethodName, outcome))
+            def suite_end(self, result):
+                events.append(("suite_end", result.testsRun))
+        plugin = RecordingPlugin()
+        testlib.register_plugin(plugin)
+        try:
+            self.assertEqual(testlib._plugin_hooks.test_start, ())
+            tests = list(testlib.tests_from_manifest({None: self.testdir}))
+            with contextlib.redirect_stdout(io.StringIO()):
+                testlib.run_tests(tests)
+        finally:
+            testlib.unregister_plugin(plugin)
+        self.assertEqual(events, [
+            ("discovered", 3),
+            ("module_start", "test_a"),
+            ("test_fail", "FAIL"),
+            ("test_pass", "ok"),
+            ("module_end", "test_a"),
+            ("module_start", "test_b"),
+            ("test_skip", "skipped"),
+            ("module_end", "test_b"),
+            ("suite_end", 3),
+        ])
+
+    def test_hook_threads(self):
+        self._write("test_conc.py", """
+            import unittest
+            __tags__ = ["concurrent"]
+            class ATestCase(unittest.TestCase):
+                def test_a(self): pass
+                def test_b(self): pass
+            """)
+        main_thread = threading.current_thread()
+        events = set()
+        class ThreadsPlugin(testlib.Plugin):
+            def _record(self, hook):
+                events.add((hook, threading.current_thread() is main_thread))
+            def suite_start(self, result):
+                self._record("suite_start")
+            def module_start(self, ns, testmod_name):
+                self._record("module_start")
+            def test_start(self, testcase):
+                self._record("test_start")
+            def test_end(self, testcase):
+                self._record("test_end")
+            def test_result(self, testcase, outcome, err):
+                self._record("test_result")
+        plugin = ThreadsPlugin()
+        testlib.register_plugin(plugin)
+        try:
+            tests = list(testlib.tests_from_manifest({None: self.testdir}))
+            with contextlib.redirect_stdout(io.StringIO()):
+                testlib.run_tests(tests, num_threads=2)
+        finally:
+            testlib.unregister_plugin(plugin)
+        self.assertEqual(events, set([
+            ("suite_start", True), ("module_start", True),
+            ("test_start", False), ("test_end", False),
+            ("test_result", True)]))
+
+    def test_tests_kept_after_run(self):
+        self._write("test_conc.py", """
+            import unittest
+            import testlib
+            __tags__ = ["concurrent"]
+            class ATestCase(unittest.TestCase):
+                def test_a(self): pass
+                @testlib.params([(1,), (2,)])
+                def test_p(self, n): pass
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        testcases = []
+        class TestcasesPlugin(testlib.Plugin):
+            def suite_end(self, result):
+                testcases.append([t.testcase for t in tests])
+        plugin = TestcasesPlugin()
+        testlib.register_plugin(plugin)
+        try:
+            for i in range(2):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = testlib.run_tests(tests, num_threads=2)
+                self.assertTrue(result.wasSuccessful())
+                self.assertEqual(result.testsRun, 3)
+        finally:
+            testlib.unregister_plugin(plugin)
+        self.assertTrue(None not in testcases[0])
+        self.assertEqual(testcases[0], testcases[1])
+
+    def test_no_hooks_for_reruns(self):
+        # Hook calls are logged to a file, as reruns may be in a child
+        # process.
+        log_path = join(self.testdir, "log")
+        def log(line):
+            with open(log_path, "a") as f:
+                f.write(line + "\n")
+        class FlakyTestCase(unittest.TestCase):
+            def test_flaky(self):
+                log("run")
+                with open(log_path) as f:
+                    self.assertTrue(f.read().count("run") > 1)
+        class LoggingPlugin(testlib.Plugin):
+            def test_start(self, testcase):
+                log("test_start")
+            def test_result(self, testcase, outcome, err):
+                log("test_result " + outcome)
+        plugin = LoggingPlugin()
+        testlib.register_plugin(plugin)
+        try:
+            runner = testlib.ConsoleTestRunner(io.StringIO(),
+                                               rerun_failures=1)
+            result = runner.run(_named_testcase(
+                FlakyTestCase, "test_flaky", "foo/flaky/flaky"))
+        finally:
+            testlib.unregister_plugin(plugin)
+        self.assertEqual(len(result.flaky), 1)
+        with open(log_path) as f:
+            self.assertEqual(f.read().split("\n"),
+                ["test_start", "run", "test_result FAIL", "run", ""])
+
+    def test_suite_end_when_interrupted(self):
+        class InterruptedSuite(unittest.TestSuite):
+            def run(self, result):
+                raise KeyboardInterrupt
+        events = []
+        class RecordingPlugin(testlib.Plugin):
+            def suite_end(self, result):
+                events.append("suite_end")
+        plugin = RecordingPlugin()
+        testlib.register_plugin(plugin)
+        try:
+            runner = testlib.ConsoleTestRunner(io.StringIO())
+            self.assertRaises(KeyboardInterrupt, runner.run,
+                              InterruptedSuite())
+        finally:
+            testlib.unregister_plugin(plugin)
+        self.assertEqual(events, ["suite_end"])
+
+class IsolateTimingTestCase(_TestdirMixin, unittest.TestCase):
+    def test_timing_phase_runs_last(self):
+        self._write("test_timing.py", """
+            import gc
+            import unittest
+            import testlib
+            events = []
+            def setUpModule():
+                events.append("setUpModule")
+            def tearDownModule():
+                events.append("tearDownModule")
+            class ATestCase(unittest.TestCase):
+                @testlib.timedtest(10)
+                def test_a_timed(self):
+                    events.append(("timed", gc.isenabled()))
+                def test_b_plain(self):
+                    events.append(("plain", gc.isenabled()))
+                @testlib.tag("timing")
+                def test_c_tagged(self):
+                    events.append(("tagged", gc.isenabled()))
+            """)
+        self._write("test_untimed.py", """
+            import unittest
+            class BTestCase(unittest.TestCase):
+                def test_plain(self): pass
+            """)
+        tests = list(testlib.tests_from_manifest({None: self.testdir}))
+        self.assertEqual([t.testmod_name() for t in tests],
+                         ["test_timing"] * 3 + ["test_untimed"])
+        self.assertTrue("timing" in tests[0].tags())
+        self.assertEqual(tests[0].testcase.test_a_timed.__name__,
+                         "test_a_timed")
+        testmod = tests[0].testmod
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = testlib.run_tests(tests, isolate_timing=True)
+        self.assertTrue(result.wasSuccessful())
+        # Module fixtures are run again, as another module ran in between.
+        self.assertEqual(testmod.events,
+            ["setUpModule", ("plain", True), "tearDownModule",
+             "setUpModule", ("timed", False), ("tagged", False),
+             "tearDownModule"])
+        self.assertTrue(gc.isenabled())
+
+    def _run_recording_cpus(self, timed):
+        testdir = timed and "timed" or "plain"
+        self._write(join(testdir, "test_cpus.py"), """
+            import fcntl
+            import os
+            import unittest
+            import testlib
+            events = []
+            def lock_held():
+                with open(testlib._TimingPhaseSuite.lock_path, 'a') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        return True
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    return False
+            class ATestCase(unittest.TestCase):
+                def test_plain(self):
+                    events.append(("plain", os.sched_getaffinity(0),
+                                   lock_held()))
+                if %r:
+                    @testlib.timedtest(10)
+                    def test_timed(self):
+                        events.append(("timed", os.sched_getaffinity(0),
+                                       lock_held()))
+            """ % timed)
+        tests = list(testlib.tests_from_manifest(
+            {None: join(self.testdir, testdir)}))
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = testlib.run_tests(tests, isolate_timing=True)
+        self.assertTrue(result.wasSuccessful())
+        return tests[0].testmod.events
+
+    def test_cpu_reserved_and_locked(self):
+        if not hasattr(os, "sched_getaffinity"):
+            raise TestSkipped("no CPU affinity support")
+        try:
+            import fcntl
+        except ImportError:
+            raise TestSkipped("no fcntl")
+        old_lock_path = testlib._TimingPhaseSuite.lock_path
+        testlib._TimingPhaseSuite.lock_path = join(self.testdir, "lock")
+        try:
+            cpus = os.sched_getaffinity(0)
+            events = self._run_recording_cpus(True)
+            self.assertEqual([e[0] for e in events], ["plain", "timed"])
+            self.assertEqual([e[2] for e in events], [False, True])
+            if len(cpus) > 1:
+                self.assertEqual(events[0][1], cpus - set([max(cpus)]))
+                self.assertEqual(events[1][1], set([max(cpus)]))
+                # Also reserved by a run without timing tests.
+                events = self._run_recording_cpus(False)
+                self.assertEqual(events[0][1], cpus - set([max(cpus)]))
+            self.assertEqual(os.sched_getaffinity(0), cpus)
+        finally:
+            testlib._TimingPhaseSuite.lock_path = old_lock_path
+
+class SharedDataTestCase(unittest.TestCase):
+    def test_share_data(self):
+        name = "testlib-test-%d" % os.getpid()
+        testlib.share_data(name, lambda: array.array("d", range(1000)))
+        try:
+            view = testlib.shared_data(name, "d")
+            self.assertTrue(view.readonly)
+            self.assertEqual(view[999], 999.0)
+            del view
+            # Another process maps the data without loading it.
+            output = subprocess.check_output([sys.executable, "-c", """\
+import sys
+sys.path.insert(0, %r)
+import testlib
+testlib.share_data(%r, lambda: 1/0)
+print(testlib.shared_data(%r, "d")[10])
+""" % (dirname(testlib.__file__), name, name)])
+            self.assertEqual(output.strip(), b"10.0")
+            path = testlib._shared_data_from_name[name].path
+        finally:
+            testlib.release_shared_data()
+        self.assertFalse(exists(path))
+        os.remove(path + ".lock")
 
+class ConcurrentTestCase(unittest.TestCase):
+    def test_load_stats_and_failures(self):
+        class LoadTestCase(unittest.TestCase):
+            @testlib.concurrent(4, calls=50)
+            def test_ok(self):
+                pass
+            @testlib.concurrent(2, calls=5, processes=True)
+            def test_fail(self):
+                self.fail("boom")
+            @testlib.concurrent(2, min_throughput=1e15)
+            def test_slow(self):
+                pass
+        suite = unittest.TestSuite()
+        for name in ("test_ok", "test_fail", "test_slow"):
+            testcase = _named_testcase(LoadTestCase, name,
+                                       "foo/load/" + name[5:])
+            suite.addTest(testcase)
+        stream = io.StringIO()
+        result = testlib.ConsoleTestRunner(stream).run(suite)
+        self.assertEqual(result.testsRun, 3)
+        self.assertEqual([r.description for r, _ in result.failures],
+                         ["foo/load/fail", "foo/load/slow"])
+        self.assertTrue("boom" in result.failures[0][1])
+        self.assertTrue("below the minimum" in result.failures[1][1])
+        self.assertTrue(re.search(r"load: 4 threads, 200 calls, \d+ "
+                                  r"calls/s, p50 \S+, p99 \S+",
+                                  stream.getvalue()))
 
+    def test_no_processes_in_worker_threads(self):
+        class LoadTestCase(unittest.TestCase):
+            @testlib.concurrent(2, processes=True)
+            def test_procs(self):
+                pass
+        suite = testlib.ThreadedTestSuite(num_threads=2)
+        suite.addTest(_named_testcase(LoadTestCase, "test_procs",
+                                      "foo/load/procs"))
+        result = testlib.ConsoleTestRunner(io.StringIO()).run(suite)
+        self.assertEqual(len(result.errors), 1)
+        self.assertTrue("in a worker thread" in result.errors[0][1])